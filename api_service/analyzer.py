@@ -16,7 +16,8 @@ class Analyzer(object):
         self.initialize_utilization_jobs()
 
     def initialize_utilization_jobs(self):
-        self.jobs.add_job("utilization_node_cpu", "utilization.sizing_analyzer.node_cpu_job", {"schedule_at": "12:30"})
-        self.jobs.add_job("utilization_node_memory", "utilization.sizing_analyzer.node_memory_job", {"schedule_at": "12:30"})
-        self.jobs.add_job("utilization_container_cpu", "utilization.sizing_analyzer.container_cpu_job", {"schedule_at": "12:30"})
-        self.jobs.add_job("utilization_container_memory", "utilization.sizing_analyzer.container_memory_job", {"schedule_at": "12:30"})
+        # the four analyses run in parallel in a single job, with their settings queries prefetched
+        for job_name in ["utilization_node_cpu", "utilization_node_memory",
+                         "utilization_container_cpu", "utilization_container_memory"]:
+            self.jobs.remove_job(job_name)
+        self.jobs.add_job("utilization_sizing", "utilization.sizing_analyzer.sizing_job", {"schedule_at": "12:30"})
@@ -306,6 +306,11 @@ def get_task_status(session_id):
     return response
 
 
+@app.route("/sizing-sessions/stats")
+def get_sizing_session_stats():
+    return jsonify(Analyzer().bop.get_stats())
+
+
 # @app.route("/modify-slo", methods=["GET"])
 # def modification_form():
 #     return render_template("modification_form.html", apps=configdb.applications.find())
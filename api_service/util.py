@@ -1,4 +1,10 @@
-from functools import lru_cache
+import hashlib
+import json
+import os
+import threading
+import time
+import weakref
+from types import MappingProxyType
 
 import bson
 from flask.json import JSONEncoder
@@ -9,7 +15,7 @@ from werkzeug.routing import BaseConverter, ValidationError
 import numpy as np
 import pandas as pd
 import state.apps as apps
-from scipy.spatial.distance import euclidean
+from scipy.spatial import cKDTree
 
 from api_service.db import configdb, metricdb
 from config import get_config
@@ -22,6 +28,7 @@ nodetype_collection = config.get("ANALYZER", "NODETYPE_COLLECTION")
 app_collection = config.get("ANALYZER", "APP_COLLECTION")
 my_region = config.get("ANALYZER", "MY_REGION")
 cost_type = config.get("ANALYZER", "COST_TYPE")
+nodetype_refresh_interval = config.getint("ANALYZER", "NODETYPE_REFRESH_INTERVAL_SECOND")
 
 DEFAULT_CLOCK_SPEED = 2.3
 DEFAULT_NET_PERF = 'Low'
@@ -110,9 +117,17 @@ def shape_service_placement(deploy_json):
     return result
 
 
-@lru_cache(maxsize=1)
 def get_all_nodetypes(region=my_region):
+    """ Get all nodetypes of the current catalog snapshot as a read-only map.
+    """
+    return get_nodetype_catalog(region).nodetype_map
+
+
+def fetch_nodetypes(region):
     """ Get all nodetypes from the database and convert them into a map.
+    Returns:
+        nodetype_map (dict): map of nodetype name to nodetype document
+        version (str): digest of the nodetype document
     """
     region_filter = {'region': region}
     nodetype_list = configdb[nodetype_collection].find_one(region_filter)
@@ -125,18 +140,163 @@ def get_all_nodetypes(region=my_region):
     for nodetype in nodetype_list['data']:
         nodetype_map[nodetype['name']] = nodetype
 
-    return nodetype_map
+    version = hashlib.sha1(json.dumps(nodetype_list['data'], sort_keys=True, default=str).encode()).hexdigest()
+    return nodetype_map, version
 
 
-def get_feature_bounds(normalized=False):
-    nodetype_map = get_all_nodetypes()
+def freeze(obj):
+    """ Make a read-only copy of nested dicts and lists.
+    """
+    if isinstance(obj, dict):
+        return MappingProxyType({k: freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+class NodetypeCatalog():
+    """ Immutable snapshot of the nodetypes of a region, with their feature matrices and spatial index.
+        Row i of raw_features and normalized_features belongs to names[i]; the rows are read-only.
+        A snapshot is never modified, so it is shared by all sessions without copies; a changed
+        nodetype document results in a new snapshot with a new version.
+    """
 
-    if normalized:
-        features = [encode_nodetype(k) for k in nodetype_map]
-    else:
-        features = [get_raw_features(k) for k in nodetype_map]
+    def __init__(self, nodetype_map, version=None):
+        self.nodetype_map = freeze(nodetype_map)
+        self.version = version
+        self.names = list(nodetype_map.keys())
+        self.positions = {name: i for i, name in enumerate(self.names)}
+
+        self.raw_features = np.array([nodetype_raw_features(nodetype_map[name]) for name in self.names],
+                                     dtype=float)
+        # normalizing each feature variable by its maximum value
+        self.normalized_features = self.raw_features / self.raw_features.max(axis=0)
+        self.raw_features.flags.writeable = False
+        self.normalized_features.flags.writeable = False
+        self.tree = cKDTree(self.normalized_features)
+
+    def position(self, nodetype_name):
+        position = self.positions.get(nodetype_name)
+        if position is None:
+            raise KeyError(
+                f'Cannot find instance type in the database: name={nodetype_name}')
+        return position
 
-    return get_bounds(features)
+    def get_raw_features(self, nodetype_name):
+        return self.raw_features[self.position(nodetype_name)]
+
+    def encode(self, nodetype_name):
+        return self.normalized_features[self.position(nodetype_name)]
+
+    def get_feature_bounds(self, normalized=False):
+        return get_bounds(self.normalized_features if normalized else self.raw_features)
+
+    def nearest(self, feature_vector, available_nodetypes=None, k=None):
+        """ Find the k available nodetypes closest to a normalized feature vector.
+        Args:
+            feature_vector: vector in the normalized feature space
+            available_nodetypes: nodetype names to consider; all nodetypes if None
+            k: number of nodetypes to return; all the available ones if None
+        Returns:
+            candidate_rank (list of tuples): sorted list of (euclidean distance, nodetype)
+        """
+        if available_nodetypes is None:
+            mask = np.ones(len(self.names), dtype=bool)
+        else:
+            mask = np.zeros(len(self.names), dtype=bool)
+            mask[[self.position(n) for n in available_nodetypes]] = True
+        num_available = int(mask.sum())
+        k = num_available if k is None else min(k, num_available)
+        if k == 0:
+            return []
+
+        # widen the query until it covers k available nodetypes
+        num_queried = k
+        while True:
+            num_queried = min(num_queried, len(self.names))
+            distances, positions = self.tree.query(feature_vector, k=num_queried)
+            distances, positions = np.atleast_1d(distances), np.atleast_1d(positions)
+            available = mask[positions]
+            if available.sum() >= k or num_queried == len(self.names):
+                break
+            num_queried *= 2
+
+        candidate_rank = sorted((float(d), self.names[i])
+                                for d, i in zip(distances[available], positions[available]))
+        return candidate_rank[:k]
+
+
+class NodetypeCatalogCache():
+    """ Current catalog snapshot of each region. The first lookup of a region loads its snapshot;
+        a background thread then checks the nodetype documents every refresh_interval seconds
+        and swaps in a new snapshot when a document has changed.
+        Older snapshots stay available by version for as long as something, e.g. a sizing session, holds them.
+    """
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.catalogs = {}
+        self.snapshots = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        self._refresher_pid = None
+
+    def get(self, region, version=None):
+        """ Get the snapshot of the given version if it's still held, or the current snapshot otherwise.
+        """
+        if version is not None:
+            catalog = self.snapshots.get((region, version))
+            if catalog is not None:
+                return catalog
+
+        catalog = self.catalogs.get(region)
+        if catalog is None:
+            with self._lock:
+                catalog = self.catalogs.get(region)
+                if catalog is None:
+                    catalog = NodetypeCatalog(*fetch_nodetypes(region))
+                    logger.info(f"Loaded nodetype catalog of {region}: {len(catalog.names)} nodetypes, "
+                                f"version {catalog.version}")
+                    self.catalogs[region] = catalog
+                    self.snapshots[(region, catalog.version)] = catalog
+        self.ensure_refresher()
+        return catalog
+
+    def ensure_refresher(self):
+        # threads do not survive a fork, so each process runs its own refresher
+        if self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid != os.getpid():
+                self._refresher_pid = os.getpid()
+                threading.Thread(target=self.refresh_loop, daemon=True).start()
+
+    def refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            for region in list(self.catalogs):
+                try:
+                    self.refresh(region)
+                except Exception as e:
+                    logger.warning(f"Failed to refresh nodetype catalog of {region}: {e}")
+
+    def refresh(self, region):
+        nodetype_map, version = fetch_nodetypes(region)
+        if version != self.catalogs[region].version:
+            catalog = NodetypeCatalog(nodetype_map, version)
+            self.catalogs[region] = catalog
+            self.snapshots[(region, version)] = catalog
+            logger.info(f"Refreshed nodetype catalog of {region} to version {version}")
+
+
+_catalog_cache = NodetypeCatalogCache(nodetype_refresh_interval)
+
+
+def get_nodetype_catalog(region=my_region, version=None):
+    return _catalog_cache.get(region, version)
+
+
+def get_feature_bounds(normalized=False):
+    return get_nodetype_catalog().get_feature_bounds(normalized)
 
 
 def get_bounds(vectors):
@@ -146,17 +306,15 @@ def get_bounds(vectors):
     return list(zip(vectors.min(axis=0), vectors.max(axis=0)))
 
 
-@lru_cache(maxsize=16)
 def get_raw_features(nodetype_name):
-    """ for each instance type, get a vector of raw feature values from the database
-        TODO: improve query efficiency by precomputing & caching all feature vectors
+    """ for each instance type, get a vector of raw feature values from the nodetype catalog
     """
-    nodetype_map = get_all_nodetypes()
-    nodetype = nodetype_map.get(nodetype_name)
-    if nodetype is None:
-        raise KeyError(
-            f'Cannot find instance type in the database: name={nodetype_name}')
+    return get_nodetype_catalog().get_raw_features(nodetype_name)
 
+
+def nodetype_raw_features(nodetype):
+    """ compute the vector of raw feature values of a nodetype document
+    """
     vcpu = nodetype['cpuConfig']['vCPU']
     clock_speed = nodetype['cpuConfig']['clockSpeed']['value']
     mem_size = nodetype['memoryConfig']['size']['value']
@@ -179,35 +337,30 @@ def get_raw_features(nodetype_name):
     return feature_vector
 
 
-@lru_cache(maxsize=16)
 def encode_nodetype(nodetype):
     """ convert each node type to a normalized feature vector
     """
-    raw_features = get_raw_features(nodetype)
-    raw_feature_bounds = np.array(get_feature_bounds(normalized=False))
-    # normalizing each feature variable by its maximum value
-    normalized_feature = np.divide(raw_features, raw_feature_bounds[:, 1])
-    # logger.debug(f"Encoded feature vector for {nodetype}: {features_normalized}")
-
-    return normalized_feature
+    return get_nodetype_catalog().encode(nodetype)
 
 
-def decode_nodetype(feature_vector, available_nodetypes):
+def decode_nodetype(feature_vector, available_nodetypes, k=None):
     """ convert a candidate solution recommended by the optimizer into a list VM node type sorted by distance
         Args:
             feature_vector: candidate solution in a vector space
+            available_nodetypes: nodetypes the candidate can be decoded into
+            k: number of closest nodetypes to return; all available nodetypes if None
         Returns:
             candidate_rank (list of tuples): sorted list of (euclidean distance, available nodetypes)
                 i.e. [(0.353, 'nodetype1'), (0.526, 'nodetype2), ...]
     """
 
-    return sorted([(euclidean(encode_nodetype(nodetype), feature_vector), nodetype)
-                   for nodetype in available_nodetypes])
+    return get_nodetype_catalog().nearest(feature_vector, available_nodetypes, k)
 
 
 # get from configdb the price (hourly cost) of an nodetype
-def get_price(nodetype_name):
-    nodetype_map = get_all_nodetypes()
+def get_price(nodetype_name, nodetype_map=None):
+    if nodetype_map is None:
+        nodetype_map = get_all_nodetypes()
     nodetype = nodetype_map.get(nodetype_name)
 
     if nodetype is None:
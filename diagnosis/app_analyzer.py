@@ -1,4 +1,4 @@
-import math
+import heapq
 import time
 import requests
 import sys
@@ -7,6 +7,7 @@ import nanotime
 import json
 import logging
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from math import isnan
 from pandas import to_datetime
 from uuid import uuid1
@@ -27,6 +28,10 @@ WINDOW = int(config.get("ANALYZER", "CORRELATION_WINDOW_SECOND"))
 INTERVAL = int(config.get("ANALYZER", "DIAGNOSIS_INTERVAL_SECOND"))
 DELAY_INTERVAL = int(config.get("ANALYZER", "DELAY_INTERVAL_SECOND"))
 AVERAGE_WINDOW = int(config.get("ANALYZER", "AVERAGE_WINDOW_SECOND"))
+DIAGNOSIS_WORKERS = int(config.get("ANALYZER", "DIAGNOSIS_WORKERS"))
+DIAGNOSIS_PROCESSES = int(config.get("ANALYZER", "DIAGNOSIS_PROCESSES"))
+TOP_FEATURES = int(config.get("ANALYZER", "TOP_FEATURES"))
+WRITE_ALL_FEATURE_RESULTS = config.getboolean("ANALYZER", "WRITE_ALL_FEATURE_RESULTS")
 severity_compute_type = config.get("ANALYZER", "SEVERITY_COMPUTE_TYPE")
 if severity_compute_type == "AREA":
     DIAGNOSIS_THRESHOLD = float(config.get("ANALYZER", "AREA_THRESHOLD"))
@@ -39,6 +44,7 @@ class DiagnosisTracker(object):
     def __init__(self, config):
         self.config = config
         self.apps = {}
+        self.scheduler = DiagnosisScheduler(DIAGNOSIS_WORKERS)
         self.recover()
 
     def recover(self):
@@ -53,24 +59,131 @@ class DiagnosisTracker(object):
             logger.info("App id %s is not found in diagnosis tracker, skipping stop" % app_id)
             return
 
-        analyzer, thread = self.apps[app_id]
+        analyzer = self.apps[app_id]
         logger.info("Signaling app %s diagnosis loop to stop..." % app_id)
         analyzer.stop_loop()
+        self.scheduler.remove_app(app_id)
         del(self.apps[app_id])
 
     def run_new_app(self, app_id, app_config):
         if app_id in self.apps:
-            self.logger.warning("App id %s is already running in diagnosis, skipping as we don't support update")
+            logger.warning("App id %s is already running in diagnosis, skipping as we don't support update" % app_id)
             return
 
         batch_window = WINDOW * NANOSECONDS_PER_SECOND
         sliding_interval = INTERVAL * NANOSECONDS_PER_SECOND
         delay_interval = DELAY_INTERVAL * NANOSECONDS_PER_SECOND
-        self.logger.info("Starting diagnosis for app id %s, config: %s" % (app_id, str(app_config)))
+        logger.info("Starting diagnosis for app id %s, config: %s" % (app_id, str(app_config)))
         analyzer = AppAnalyzer(self.config, app_id, app_config, batch_window, sliding_interval, delay_interval)
-        thread = threading.Thread(target=analyzer.run_loop)
-        self.apps[app_id] = (analyzer, thread)
-        thread.start()
+        self.apps[app_id] = analyzer
+        self.scheduler.add_app(analyzer)
+
+
+class DiagnosisScheduler(object):
+    """ Runs the diagnosis cycles of all apps on a bounded pool of worker threads.
+        The cycles of every app are due on the same grid of sliding intervals, so the apps query the
+        same time windows and share the results of their common queries. Due cycles start earliest
+        deadline first; a cycle that could not start before the next one of its app is skipped.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # heap of (due time, sequence, app id)
+        self.queue = []
+        self.sequence = 0
+        self.analyzers = {}
+        self.running = set()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def now_nano(self):
+        return nanotime.now().nanoseconds()
+
+    def add_app(self, analyzer):
+        with self.condition:
+            self.analyzers[analyzer.app_id] = analyzer
+            now = self.now_nano()
+            self.push(now - now % analyzer.sliding_interval, analyzer.app_id)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run_loop, daemon=True)
+                self.thread.start()
+
+    def remove_app(self, app_id):
+        with self.condition:
+            self.analyzers.pop(app_id, None)
+
+    def push(self, due_time, app_id):
+        self.sequence += 1
+        heapq.heappush(self.queue, (due_time, self.sequence, app_id))
+        self.condition.notify()
+
+    def run_loop(self):
+        with self.condition:
+            while True:
+                if len(self.running) >= self.workers or not self.queue:
+                    self.condition.wait()
+                    continue
+                due_time, _, app_id = self.queue[0]
+                now = self.now_nano()
+                if due_time > now:
+                    self.condition.wait((due_time - now) / NANOSECONDS_PER_SECOND)
+                    continue
+
+                heapq.heappop(self.queue)
+                analyzer = self.analyzers.get(app_id)
+                if analyzer is None:
+                    continue
+                if app_id in self.running:
+                    # the last cycle of a replaced analyzer of the app is still running
+                    self.push(due_time + analyzer.sliding_interval, app_id)
+                    continue
+                missed = (now - due_time) // analyzer.sliding_interval
+                if missed > 0:
+                    logger.warning("Skipping %d missed diagnosis cycles of app %s" % (missed, app_id))
+                    due_time += missed * analyzer.sliding_interval
+                self.running.add(app_id)
+                try:
+                    self.pool.submit(self.run_cycle, analyzer, due_time)
+                except RuntimeError:
+                    # the pool is shut down when the interpreter exits
+                    logger.info("Diagnosis worker pool is shut down, stopping the diagnosis scheduler")
+                    return
+
+    def run_cycle(self, analyzer, due_time):
+        try:
+            analyzer.run_cycle(due_time - analyzer.delay_interval)
+        except Exception:
+            logger.exception("Diagnosis cycle of app %s failed" % analyzer.app_id)
+        finally:
+            with self.condition:
+                self.running.discard(analyzer.app_id)
+                if self.analyzers.get(analyzer.app_id) is analyzer:
+                    self.push(due_time + analyzer.sliding_interval, analyzer.app_id)
+                else:
+                    self.condition.notify()
+
+
+_result_influx_client = None
+_result_influx_client_lock = threading.Lock()
+
+
+def get_result_influx_client():
+    """ InfluxDB client of the diagnosis results, shared by all the app analyzers.
+    """
+    global _result_influx_client
+    with _result_influx_client_lock:
+        if _result_influx_client is None:
+            influx_db = config.get("INFLUXDB", "RESULT_DB_NAME")
+            _result_influx_client = InfluxDBClient(
+                config.get("INFLUXDB", "HOST"),
+                config.get("INFLUXDB", "PORT"),
+                config.get("INFLUXDB", "USERNAME"),
+                config.get("INFLUXDB", "PASSWORD"),
+                influx_db)
+            _result_influx_client.create_database(influx_db)
+            _result_influx_client.create_retention_policy('result_policy', '3w', 1, default=True)
+        return _result_influx_client
+
 
 # Diagnosis States
 NO_APP_METRICS = 0
@@ -119,6 +232,7 @@ class AppAnalyzer(object):
         self.logger.propagate = False
         self.config = config
         self.stop = False
+        self.app_last_incident = None
         self.app_id = app_id
         self.app_config = app_config
         self.batch_window = batch_window
@@ -131,17 +245,7 @@ class AppAnalyzer(object):
             self.app_id)
         self.features_selector = FeaturesSelector(config, self.app_id)
         self.diagnosis_generator = DiagnosisGenerator(config, app_config, self.app_id)
-        influx_host = config.get("INFLUXDB", "HOST")
-        influx_port = config.get("INFLUXDB", "PORT")
-        influx_db = config.get("INFLUXDB", "RESULT_DB_NAME")
-        self.influx_client = InfluxDBClient(
-            influx_host,
-            influx_port,
-            config.get("INFLUXDB", "USERNAME"),
-            config.get("INFLUXDB", "PASSWORD"),
-            influx_db)
-        self.influx_client.create_database(influx_db)
-        self.influx_client.create_retention_policy('result_policy', '3w', 1, default=True)
+        self.influx_client = get_result_influx_client()
 
     def diagnosis_cycle(self, start_time, end_time):
         results = DiagnosisResults()
@@ -186,7 +290,12 @@ class AppAnalyzer(object):
         results.incident_doc = incident_doc
 
         self.logger.debug("Feature selector starting to process derived metrics..")
-        filtered_metrics = self.features_selector.process_metrics(derived_metrics)
+        # All the significant derived metrics, or only the top k ones if the others aren't written
+        top_k = None if WRITE_ALL_FEATURE_RESULTS else TOP_FEATURES
+        if DIAGNOSIS_PROCESSES > 0:
+            filtered_metrics = self.features_selector.process_metrics_in_process(derived_metrics, top_k=top_k)
+        else:
+            filtered_metrics = self.features_selector.process_metrics(derived_metrics, top_k=top_k)
         if not filtered_metrics:
             self.logger.info("All %d features have been filtered." % self.features_selector.num_features)
             results.state = METRICS_ALL_FILTERED
@@ -196,9 +305,9 @@ class AppAnalyzer(object):
         self.write_results(filtered_metrics, end_time, self.app_id, app_name, self.metrics_consumer.deployment_id)
         self.logger.debug("Filtered metrics writing completed")
 
-        # Sort top k derived metrics based on conficent score
-        sorted_metrics = sorted(filtered_metrics, key=lambda x: self.convert_nan(
-            x.confidence_score), reverse=True)[:10]
+        # Top k derived metrics, ranked by confidence score
+        sorted_metrics = self.features_selector.rank_features(filtered_metrics, TOP_FEATURES)
+
         self.logger.info("Top related metrics for incident %s for application %s:" %
                     (incident_id, app_name))
         self.print_sorted_metrics(sorted_metrics)
@@ -222,31 +331,37 @@ class AppAnalyzer(object):
     def stop_loop(self):
         self.stop = True
 
+    def run_cycle(self, end_time):
+        """ Run a diagnosis cycle for the window ending at end_time, and write or resolve the incident
+            of the app accordingly.
+        """
+        start_time = end_time - self.batch_window
+        self.logger.info("Diagnosis cycle start: %f, end: %f", start_time, end_time)
+        start_run_time = self.now_nano()
+        diagnosis_results = self.diagnosis_cycle(start_time, end_time)
+        if diagnosis_results.state == APP_DIAGNOSED:
+            if self.app_last_incident:
+                self.logger.info("Skipping writing diagnosis results as app is diaganoised already.")
+            else:
+                self.app_last_incident = diagnosis_results.incident_doc
+                diagnosis_results.write_results()
+        else:
+            if self.app_last_incident:
+                self.app_last_incident["state"] = "Resolved"
+                if resultstate.update_incident(self.app_last_incident["incident_id"], self.app_last_incident) == False:
+                    self.logger.info("Unable to set app's last incident to resolved state")
+
+            self.app_last_incident = None
+
+        diagnosis_time = self.now_nano() - start_run_time
+        self.logger.info("Diagnosis cycle took %s with result state %s" % (diagnosis_time, diagnosis_results.state_string()))
+        return diagnosis_time
+
     def run_loop(self):
         self.logger.info("Starting live diagnosis run for application %s" % self.app_id)
-        app_last_incident = None
         while self.stop != True:
             end_time =  self.now_nano() - self.delay_interval
-            start_time = end_time - self.batch_window
-            self.logger.info("Diagnosis cycle start: %f, end: %f", start_time, end_time)
-            start_run_time = self.now_nano()
-            diagnosis_results = self.diagnosis_cycle(start_time, end_time)
-            if diagnosis_results.state == APP_DIAGNOSED:
-                if app_last_incident:
-                    self.logger.info("Skipping writing diagnosis results as app is diaganoised already.")
-                else:
-                    app_last_incident = diagnosis_results.incident_doc
-                    diagnosis_results.write_results()
-            else:
-                if app_last_incident:
-                    app_last_incident["state"] = "Resolved"
-                    if resultstate.update_incident(app_last_incident["incident_id"], app_last_incident) == False:
-                        self.logger.info("Unable to set app's last incident to resolved state")
-
-                app_last_incident = None
-
-            diagnosis_time = self.now_nano() - start_run_time
-            self.logger.info("Diagnosis cycle took %s with result state %s" % (diagnosis_time, diagnosis_results.state_string()))
+            diagnosis_time = self.run_cycle(end_time)
             sleep_time = ((self.sliding_interval - diagnosis_time) * 1.) / (NANOSECONDS_PER_SECOND * 1.)
             if sleep_time > 0.:
                 self.logger.info("Sleeping for %f before next cycle" % sleep_time)
@@ -273,11 +388,6 @@ class AppAnalyzer(object):
             end_time += sliding_interval
             it += 1
 
-    def convert_nan(self, value):
-        if math.isnan(value):
-            return 0.0
-        return value
-
     def write_results(self, metrics, end_time, app_id, app_name, deployment_id):
         points_json = []
         for metric in metrics:
@@ -1,14 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
 from influxdb import DataFrameClient
 import json
+import numpy as np
 import pandas as pd
 import math
 import requests
 import logging
+import threading
+import time
 
 from config import get_config
+from diagnosis.metrics_writer import MetricsWriter
 
 config = get_config()
 SAMPLE_INTERVAL = int(config.get("ANALYZER", "SAMPLE_INTERVAL_SECOND"))
+QUERY_WORKERS = int(config.get("ANALYZER", "QUERY_WORKERS"))
+QUERY_CACHE_SECOND = int(config.get("ANALYZER", "QUERY_CACHE_SECOND"))
 NANOSECONDS_PER_SECOND = 1000000000
 END_TIME = 1511980800000000000
 WINDOW = 300
@@ -68,11 +75,143 @@ class WindowState(object):
             num_severe = len([p for p in self.values if p[2] > 0.0])
             return 100. * (num_severe/len(self.values))
 
+    def compute_derived_values(self, times, values,
+                compute_type=config.get("ANALYZER", "SEVERITY_COMPUTE_TYPE")):
+        """ Vectorized compute_derived_value over a whole series, continuing from the current window.
+            Gives the same values as calling compute_derived_value on each sample in order, and leaves
+            the window as it would; the sums over each window are accumulated in the same order.
+        Args:
+            times(numpy 1d array): sample times in nanoseconds
+            values(numpy 1d array): sample values
+        Returns:
+            derived values(numpy 1d array), one per sample
+        """
+        times = np.asarray(times, dtype=np.int64)
+        values = np.nan_to_num(np.asarray(values, dtype=float))
+        if len(times) == 0:
+            return np.zeros(0)
+
+        prev_times = np.asarray([p[0] for p in self.values[-1:]], dtype=np.int64)
+        if np.any(np.diff(np.concatenate((prev_times, times))) < 0):
+            # the window trimming assumes nondecreasing times; fall back to the sample by sample version
+            return np.array([self.compute_derived_value(t, v, compute_type) for t, v in zip(times, values)])
+
+        # fill the gaps of two sample intervals or more with the last value before them
+        # (the first sample is preceded by the last one in the window, if any)
+        gaps = np.diff(np.concatenate((prev_times, times)))
+        if len(prev_times) == 0:
+            gaps = np.concatenate(([0], gaps))
+        num_fills = np.where(gaps >= 2 * self.sample_interval, gaps // self.sample_interval - 1, 0)
+        num_fills = num_fills.astype(np.int64)
+
+        window_times = np.asarray([p[0] for p in self.values], dtype=np.int64)
+        window_values = np.asarray([p[1] for p in self.values], dtype=float)
+        fill_from_times = np.concatenate((window_times[-1:], times[:-1]))
+        fill_from_values = np.concatenate((window_values[-1:], values[:-1]))
+        if len(prev_times) == 0:
+            fill_from_times = np.concatenate(([0], fill_from_times))
+            fill_from_values = np.concatenate(([0.], fill_from_values))
+
+        # each sample is preceded by its fills
+        counts = num_fills + 1
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        is_sample = offsets == np.repeat(num_fills, counts)
+        all_times = np.where(is_sample, np.repeat(times, counts),
+                             np.repeat(fill_from_times, counts) + (offsets + 1) * self.sample_interval)
+        all_values = np.where(is_sample, np.repeat(values, counts), np.repeat(fill_from_values, counts))
+
+        all_times = np.concatenate((window_times, all_times))
+        all_values = np.concatenate((window_values, all_values))
+        all_severities = np.maximum(all_values - self.threshold, 0.0)
+        sample_idx = len(window_times) + np.flatnonzero(is_sample)
+
+        # the window of each sample starts at the first point at or after its window_begin_time
+        starts = np.searchsorted(all_times, times - self.window + 1, side='left')
+        lengths = sample_idx - starts + 1
+
+        totals = np.zeros(len(times))
+        severity_totals = np.zeros(len(times))
+        num_severe = np.zeros(len(times), dtype=np.int64)
+        for offset in range(lengths.max()):
+            in_window = offset < lengths
+            idx = starts[in_window] + offset
+            totals[in_window] += all_values[idx]
+            severity_totals[in_window] += all_severities[idx]
+            num_severe[in_window] += all_severities[idx] > 0.0
+
+        derived_values = np.zeros(len(times))
+        valid = (lengths >= self.total_count) & (totals != 0.0)
+        if compute_type == "AREA":
+            derived_values[valid] = 100. * (severity_totals[valid] / totals[valid])
+        else:
+            derived_values[valid] = 100. * (num_severe[valid] / lengths[valid])
+
+        self.values = list(zip(all_times[starts[-1]:].tolist(), all_values[starts[-1]:].tolist(),
+                               all_severities[starts[-1]:].tolist()))
+        return derived_values
+
+class MetricWindow(object):
+    """ Derived values of a metric over the correlation window, with the window state of each group,
+        kept across diagnosis cycles so that each cycle only derives the samples since the last one.
+        Samples arriving after their time has been processed are not picked up, as with the delay
+        interval of the analyzer loop.
+    """
+    def __init__(self, group_name):
+        self.group_name = group_name
+        self.df = None
+        # { group name -> WindowState }
+        self.group_states = {}
+
+    def append(self, df, start_time):
+        """ Append newly derived rows and drop the rows at or before start_time.
+        Returns: the derived rows in the window, or None if there are none
+        """
+        if df is not None and len(df) > 0:
+            self.df = df if self.df is None else pd.concat((self.df, df))
+        if self.df is None:
+            return None
+
+        self.df = self.df.loc[self.df.index.asi8 > start_time]
+        # groups that left the window start over from a fresh state if they come back
+        groups = set(self.df[self.group_name].unique())
+        self.group_states = {name: state for name, state in self.group_states.items() if name in groups}
+        if len(self.df) == 0:
+            self.df = None
+        return self.df
+
+def bucket_means(bucket_times, times, values, columns=None, num_columns=1):
+    """ Average the samples of one or more series over the sampling intervals starting at bucket_times.
+    Args:
+        bucket_times(numpy 1d array): sorted bucket start times in nanoseconds
+        times, values(numpy 1d arrays): sample times in nanoseconds and sample values
+        columns(numpy 1d array): series of each sample, all samples are of a single series if None
+    Returns:
+        numpy 2d array of the mean of each bucket (row) and series (column); NaN for empty buckets
+    """
+    num_buckets = len(bucket_times)
+    if columns is None:
+        columns = np.zeros(len(times), dtype=np.int64)
+
+    # each sample falls in the last bucket starting at or before it, if within its interval
+    buckets = np.searchsorted(bucket_times, times, side='right') - 1
+    matched = buckets >= 0
+    matched[matched] = times[matched] < bucket_times[buckets[matched]] + SAMPLE_INTERVAL * NANOSECONDS_PER_SECOND
+    cells = columns[matched] * num_buckets + buckets[matched]
+    counts = np.bincount(cells, minlength=num_columns * num_buckets)
+    sums = np.bincount(cells, weights=values[matched], minlength=num_columns * num_buckets)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return means.reshape(num_columns, num_buckets).T
+
 class MetricResult(object):
-    def __init__(self, df, raw_metric_name, metric_name, resource_type, node_name,
+    def __init__(self, times, values, raw_metric_name, metric_name, resource_type, node_name,
                  observation_window, threshold, threshold_type,
                  threshold_unit, pod_name=None):
-        self.df = df
+        # samples of the feature, times in nanoseconds
+        self.times = times
+        self.values = values
+        # column of the feature in the aligned values of its MetricsResults
+        self.column = None
         self.metric_name = metric_name
         self.raw_metric_name = raw_metric_name
         self.node_name = node_name
@@ -88,7 +227,7 @@ class MetricResult(object):
         self.threshold_unit = threshold_unit
 
 class MetricsResults(object):
-    def __init__(self, influx_client, is_derived=False):
+    def __init__(self, metrics_writer, is_derived=False):
         # for now, app and input data are either both raw or both derived.
         self.is_derived = is_derived
         self.app_metric = None
@@ -100,29 +239,40 @@ class MetricsResults(object):
         # { derived metric name -> { node name -> { pod name -> metric result } } }
         self.container_metrics = {}
 
-        self.influx_client = influx_client
+        # all metric results in column order, and { (metric name, node name, pod name) -> column }
+        self.features = []
+        self.feature_keys = {}
+
+        # feature values averaged over each time bucket (row) for each feature (column), set by align
+        self.bucket_times = None
+        self.values = None
+
+        # writes the derived metrics back to influxdb
+        self.metrics_writer = metrics_writer
 
     def set_app_metric(self, app_metric, metric_name):
         if self.is_derived:
-            self.influx_client.write_points(app_metric, metric_name)
+            self.metrics_writer.write_points(app_metric, metric_name)
         self.app_metric = app_metric
 
-    def add_node_metric(self, raw_metric_name, metric_name, node_name, df, resource_type,
+    def add_feature(self, result):
+        result.column = len(self.features)
+        self.features.append(result)
+        self.feature_keys[(result.metric_name, result.node_name, result.pod_name)] = result.column
+
+    def add_node_metric(self, raw_metric_name, metric_name, node_name, times, values, resource_type,
                         observation_window, threshold, threshold_type,
                         threshold_unit):
         if metric_name not in self.node_metrics:
             self.node_metrics[metric_name] = {}
 
-        result = MetricResult(df, raw_metric_name, metric_name, resource_type, \
+        result = MetricResult(times, values, raw_metric_name, metric_name, resource_type, \
                               node_name, observation_window, \
                               threshold, threshold_type, threshold_unit)
         self.node_metrics[metric_name][node_name] = result
+        self.add_feature(result)
 
-        if self.is_derived:
-            tags = {"resource_type": resource_type, "deployment_id": self.deployment_id}
-            self.influx_client.write_points(df.interpolate(), metric_name, tags)
-
-    def add_container_metric(self, raw_metric_name, metric_name, node_name, pod_name, df,
+    def add_container_metric(self, raw_metric_name, metric_name, node_name, pod_name, times, values,
                              resource_type, observation_window, threshold,
                              threshold_type, threshold_unit):
         if metric_name not in self.container_metrics:
@@ -132,29 +282,138 @@ class MetricsResults(object):
         if node_name not in nodes:
             nodes[node_name] = {}
 
-        nodes[node_name][pod_name] = MetricResult(df, raw_metric_name,
+        result = MetricResult(times, values, raw_metric_name,
                 metric_name, resource_type, node_name, observation_window,
                 threshold, threshold_type, threshold_unit, pod_name)
-        if self.is_derived:
-            tags = {"resource_type": resource_type, "deployment_id": self.deployment_id}
-            self.influx_client.write_points(df.interpolate(), metric_name, tags)
-
-    def add_metric(self, raw_metric_name, metric_name, is_container_metric, dfg, resource_type,
-                  observation_window, threshold, threshold_type, threshold_unit):
-        for df in dfg:
+        nodes[node_name][pod_name] = result
+        self.add_feature(result)
+
+    def add_metric(self, raw_metric_name, metric_name, is_container_metric, df, group_name, resource_type,
+                  observation_window, threshold, threshold_type, threshold_unit, write_after=None):
+        """ Add a feature for each group of the metric dataframe, in the order of the group names.
+            Derived metrics are written back to influxdb, except the rows up to write_after if given,
+            which were written by a previous call.
+        """
+        codes, group_names = pd.factorize(df[group_name], sort=True)
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+        times = df.index.asi8[order]
+        values = df["value"].values[order].astype(float)
+        if is_container_metric:
+            node_names = df["nodename"].values[order]
+        # rows without a group name have code -1 and are sorted before the others
+        bounds = np.searchsorted(codes, np.arange(len(group_names) + 1))
+        for i, name in enumerate(group_names):
+            group = slice(bounds[i], bounds[i + 1])
             if is_container_metric:
-                node_col = df[1]["nodename"]
-                if len(node_col) > 0:
-                    nodename = node_col[0]
-                    self.add_container_metric(raw_metric_name,
-                        metric_name, nodename, df[0], df[1], resource_type,
-                        observation_window, threshold, threshold_type,
-                        threshold_unit)
+                self.add_container_metric(raw_metric_name,
+                    metric_name, node_names[bounds[i]], name, times[group], values[group], resource_type,
+                    observation_window, threshold, threshold_type,
+                    threshold_unit)
             else:
-                self.add_node_metric(raw_metric_name, metric_name, df[0], df[1], resource_type,
-                                     observation_window, threshold, threshold_type,
+                self.add_node_metric(raw_metric_name, metric_name, name, times[group], values[group],
+                                     resource_type, observation_window, threshold, threshold_type,
                                      threshold_unit)
 
+        if self.is_derived:
+            if df["value"].isnull().any():
+                df = df.assign(value=df.groupby(group_name)["value"].transform(lambda v: v.interpolate()))
+            if write_after is not None:
+                df = df[df.index.asi8 > write_after]
+            if len(df) > 0:
+                tags = {"resource_type": resource_type, "deployment_id": self.deployment_id}
+                self.metrics_writer.write_points(df, metric_name, tags)
+
+    def align(self, time_buckets):
+        """ Average the values of all features over the sampling intervals starting at time_buckets,
+            into the values matrix with a row per time bucket and a column per feature.
+        """
+        self.bucket_times = pd.DatetimeIndex(time_buckets).asi8
+        if not self.features:
+            self.values = np.zeros((len(self.bucket_times), 0))
+            return self.values
+        lengths = [len(result.times) for result in self.features]
+        self.values = bucket_means(
+            self.bucket_times,
+            np.concatenate([result.times for result in self.features]),
+            np.concatenate([result.values for result in self.features]),
+            np.repeat(np.arange(len(self.features)), lengths),
+            len(self.features))
+        return self.values
+
+
+_query_pool = None
+_query_pool_lock = threading.Lock()
+# { (influx client id, query) -> (future of the query result, expiration time) }
+_recent_queries = {}
+_recent_queries_lock = threading.Lock()
+_influx_clients = {}
+_metrics_writers = {}
+_influx_clients_lock = threading.Lock()
+
+
+def get_query_pool():
+    """ Thread pool bounding the raw metrics queries in flight across all metrics consumers.
+    """
+    global _query_pool
+    with _query_pool_lock:
+        if _query_pool is None:
+            _query_pool = ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+        return _query_pool
+
+
+def submit_query(influx_client, query):
+    """ Run a query on the shared query pool. An identical query submitted within QUERY_CACHE_SECOND
+        shares its result, as all the apps diagnosed in the same cycle query the same metrics.
+    Returns: the future of the query result, to be used read-only
+    """
+    key = (id(influx_client), query)
+    now = time.time()
+    with _recent_queries_lock:
+        for expired_key in [k for k, (_, expiration) in _recent_queries.items() if expiration <= now]:
+            del _recent_queries[expired_key]
+        if key in _recent_queries:
+            return _recent_queries[key][0]
+        future = get_query_pool().submit(influx_client.query, query)
+        _recent_queries[key] = (future, now + QUERY_CACHE_SECOND)
+
+    def forget_failed_query(future):
+        if future.exception() is not None:
+            with _recent_queries_lock:
+                if _recent_queries.get(key, (None,))[0] is future:
+                    del _recent_queries[key]
+    future.add_done_callback(forget_failed_query)
+    return future
+
+
+def get_influx_client(database, create=False):
+    """ DataFrameClient of an InfluxDB database, shared by all metrics consumers.
+        With create, the database is created with the retention policy of the derived metrics.
+    """
+    with _influx_clients_lock:
+        if database not in _influx_clients:
+            influx_client = DataFrameClient(
+                config.get("INFLUXDB", "HOST"),
+                config.get("INFLUXDB", "PORT"),
+                config.get("INFLUXDB", "USERNAME"),
+                config.get("INFLUXDB", "PASSWORD"),
+                database)
+            if create:
+                influx_client.create_database(database)
+                influx_client.create_retention_policy('derived_metric_policy', '5w', 1, default=True)
+            _influx_clients[database] = influx_client
+        return _influx_clients[database]
+
+
+def get_metrics_writer(database):
+    """ MetricsWriter of an InfluxDB database, shared by all metrics consumers.
+    """
+    influx_client = get_influx_client(database, create=True)
+    with _influx_clients_lock:
+        if database not in _metrics_writers:
+            _metrics_writers[database] = MetricsWriter(influx_client, database)
+        return _metrics_writers[database]
+
 
 class MetricsConsumer(object):
     def __init__(self, app_slo, app_config_file, config_file, app_id):
@@ -172,35 +431,19 @@ class MetricsConsumer(object):
 
         self.group_keys = {"intel/docker": "io.kubernetes.pod.name"}
         self.default_group_key = "nodename"
-        influx_host = config.get("INFLUXDB", "HOST")
-        influx_port = config.get("INFLUXDB", "PORT")
-        influx_user = config.get("INFLUXDB", "USERNAME")
-        influx_password = config.get("INFLUXDB", "PASSWORD")
-        self.influx_client = DataFrameClient(
-            influx_host,
-            influx_port,
-            influx_user,
-            influx_password,
-            config.get("INFLUXDB", "RAW_DB_NAME"))
-        self.app_influx_client = DataFrameClient(
-            influx_host,
-            influx_port,
-            influx_user,
-            influx_password,
-            config.get("INFLUXDB", "APP_DB_NAME"))
+        self.influx_client = get_influx_client(config.get("INFLUXDB", "RAW_DB_NAME"))
+        self.app_influx_client = get_influx_client(config.get("INFLUXDB", "APP_DB_NAME"))
         self.deployment_id = ''
 
         derived_db = config.get("INFLUXDB", "DERIVED_METRIC_DB_NAME")
-        self.derived_influx_client = DataFrameClient(
-            influx_host,
-            influx_port,
-            influx_user,
-            influx_password,
-            derived_db)
-        self.derived_influx_client.create_database(derived_db)
-        self.derived_influx_client.create_retention_policy('derived_metric_policy', '5w', 1, default=True)
+        self.derived_influx_client = get_influx_client(derived_db, create=True)
+        self.derived_metrics_writer = get_metrics_writer(derived_db)
         self.logger = logging.getLogger(app_id)
 
+        # { derived metric name -> MetricWindow }, kept between calls of get_derived_metrics
+        self.metric_windows = {}
+        self.last_end_time = None
+
     def get_app_threshold(self):
         threshold_config = self.app_metric_config["threshold"]
         value = float(threshold_config["value"])
@@ -245,17 +488,14 @@ class MetricsConsumer(object):
                 self.get_app_threshold(),
                 SAMPLE_INTERVAL,
             )
-            df[metric_name]["value"] = df[metric_name].apply(
-                lambda row: slo_state.compute_derived_value(
-                    row.name.value,
-                    row.value
-                ),
-                axis=1,
+            df[metric_name]["value"] = slo_state.compute_derived_values(
+                df[metric_name].index.asi8,
+                df[metric_name]["value"].values,
             )
         return df[metric_name]
 
     def get_raw_metrics(self, start_time, end_time, app_metric=None):
-        metrics_result = MetricsResults(self.derived_influx_client, is_derived=False)
+        metrics_result = MetricsResults(self.derived_metrics_writer, is_derived=False)
         if app_metric is not None:
             metrics_result.set_app_metric(app_metric,
                                           self.app_metric_config["metric"]["name"])
@@ -299,9 +539,8 @@ class MetricsConsumer(object):
                     continue
 
             df = raw_metrics[metric_source]
-            dfg = df.groupby(group_name)
             metrics_result.add_metric(
-                metric_source, metric_source, is_container_metric, dfg,
+                metric_source, metric_source, is_container_metric, df, group_name,
                 metric_config["resource"], metric_config["analysis"]["observation_window_sec"],
                 metric_config["threshold"]["value"], metric_config["threshold"]["type"],
                 metric_config["threshold"]["unit"])
@@ -309,16 +548,23 @@ class MetricsConsumer(object):
 
 
     def get_derived_metrics(self, start_time, end_time, app_metric=None):
-        derived_metrics_result = MetricsResults(self.derived_influx_client, is_derived=True)
+        derived_metrics_result = MetricsResults(self.derived_metrics_writer, is_derived=True)
         if app_metric is not None:
             derived_metrics_result.set_app_metric(app_metric,
                 self.app_metric_config["metric"]["name"] + "/" +
                 self.app_metric_config["type"])
-        node_metric_keys = "value,nodename,deploymentId"
-        container_metric_keys = "value,\"io.kubernetes.pod.name\",nodename,deploymentId"
-        time_filter = "WHERE time > %d AND time <= %d" % (start_time, end_time)
+
+        # Continue the windows of the last call if this one overlaps it and moves forward,
+        # so only the raw samples after the last end time are queried and derived.
+        if self.last_end_time is None or not start_time <= self.last_end_time < end_time:
+            self.metric_windows = {}
+            query_start_time = start_time
+        else:
+            query_start_time = self.last_end_time
+        time_filter = "WHERE time > %d AND time <= %d" % (query_start_time, end_time)
 
         self.logger.info("Start processing infrastructure metrics")
+        metric_plans = []
         for metric_config in self.config:
             metric_source = str(metric_config["metric_name"])
             group_name = self.default_group_key
@@ -334,127 +580,174 @@ class MetricsConsumer(object):
             if metric_source.startswith("/"):
                 metric_source = metric_source[1:]
 
-            # construct tags_filter if needed for this metric
-            tags_filter = None
-            if "tags" in metric_config:
-                tags = metric_config["tags"]
-                tags_filter = " AND " .join(["\"%s\"='%s'" % (k, v) for k, v in tags.items()])
-
-            # fetch raw metric values from influxdb
-            raw_metrics = None
-            if is_container_metric:
-                raw_metrics_query = ("SELECT %s FROM \"%s\" %s" %
-                    (container_metric_keys, metric_source, time_filter))
-            else:
-                raw_metrics_query = ("SELECT %s FROM \"%s\" %s" %
-                    (node_metric_keys, metric_source, time_filter))
-            if tags_filter:
-                raw_metrics_query += (" AND %s" % (tags_filter))
-            self.logger.debug("raw metrics for derived metrics query = %s" % (raw_metrics_query))
-            raw_metrics = self.influx_client.query(raw_metrics_query)
-            self.logger.debug("raw metrics query completed")
-            if len(raw_metrics) == 0:
-                self.logger.info("Unable to find data for %s; skipping this metric..." %
-                      (metric_source))
-                continue
-            metric_df = raw_metrics[metric_source]
-            metric_group_states = {}
-            self.deployment_id = metric_df.loc[:,"deploymentId"][0]
-            # fetch normalizer metric values if normalization is needed
-            normalizer_metrics = None
+            normalizer = None
             if "normalizer" in metric_config:
                 normalizer = str(metric_config["normalizer"])
                 new_metric_name = metric_source + "_normalized/" + metric_type
                 if normalizer.startswith("/"):
                     normalizer = normalizer[1:]
 
-                if is_container_metric:
-                    normalizer_metrics_query = ("SELECT %s FROM \"%s\" %s" %
-                        (container_metric_keys, normalizer, time_filter))
-                else:
-                    normalizer_metrics_query = ("SELECT %s FROM \"%s\" %s" %
-                        (node_metric_keys, normalizer, time_filter))
-                if tags_filter:
-                    normalizer_metrics_query += (" AND %s" % (tags_filter))
-                self.logger.debug("normalizer metrics query = %s" % (normalizer_metrics_query))
-                normalizer_metrics = self.influx_client.query(normalizer_metrics_query)
-                if len(normalizer_metrics) == 0:
-                    self.logger.info("Unable to find data for normalizer %s; skipping metric %s..." %
-                          (normalizer, metric_source))
-                    continue
-                normalizer_df = normalizer_metrics[normalizer]
-                if normalizer_df["value"].max() == 0:
-                    self.logger.info("All zero values in normalizer %s, skipping metric %s..." %
-                          (normalizer, metric_source))
-                    continue
-
-            self.logger.debug("Converting raw metric %s\n  into derived metric %s" %
-                  (metric_source, new_metric_name))
+            raw_metrics_query = self.raw_metrics_query(
+                metric_config, metric_source, is_container_metric, time_filter)
+            normalizer_metrics_query = None
+            if normalizer is not None:
+                normalizer_metrics_query = self.raw_metrics_query(
+                    metric_config, normalizer, is_container_metric, time_filter)
+            metric_plans.append((metric_config, metric_source, new_metric_name, normalizer, group_name,
+                                 is_container_metric, raw_metrics_query, normalizer_metrics_query))
+
+        # run the distinct queries of all metrics concurrently, then derive each metric from their results
+        queries = set(plan[6] for plan in metric_plans) | \
+            set(plan[7] for plan in metric_plans if plan[7] is not None)
+        query_results = self.query_all(queries)
+
+        for (metric_config, metric_source, new_metric_name, normalizer, group_name,
+             is_container_metric, raw_metrics_query, normalizer_metrics_query) in metric_plans:
+            if new_metric_name not in self.metric_windows:
+                self.metric_windows[new_metric_name] = MetricWindow(group_name)
+            metric_window = self.metric_windows[new_metric_name]
 
-            # process metric values for each group
-            # metric_group_name = nodename for node metrics, pod.name for container metrics
-            for metric_group_name in raw_metrics[metric_source][group_name].unique():
-                if not metric_group_name or metric_group_name == "":
-                    self.logger.info("Unable to find %s in metric %s" %
-                          (metric_group_name, metric_source))
-                    continue
-                if metric_group_name not in metric_group_states:
-                    new_state = WindowState(
-                        metric_config["observation_window_sec"],
-                        metric_config["threshold"]["value"],
-                        SAMPLE_INTERVAL,
-                    )
-                    metric_group_states[metric_group_name] = new_state
-
-                metric_group_ind = metric_df.loc[
-                    metric_df[group_name] == metric_group_name].index
-
-                # perform normalization if needed for raw metrics in each group
-                if normalizer_metrics:
-                    normalizer_group_ind = normalizer_df.loc[
-                            normalizer_df[group_name] == metric_group_name].index
-
-                    if normalizer_df.loc[normalizer_group_ind,"value"].max() == 0:
-                        self.logger.debug("Normalizer metric has all zeros for group %s; " %
-                              (metric_group_name) +
-                              "dropping this group from the raw metric...")
-                        metric_df = metric_df.drop(metric_group_ind)
-                        continue
-
-                    if len(normalizer_group_ind) != len(metric_group_ind):
-                        self.logger.warning("Normalizer does not have equal length as raw metric; " +
-                              "adjusting...")
-                        minlen = min(len(metric_group_ind), len(normalizer_group_ind))
-                        metric_group_ind = metric_group_ind[:minlen]
-                        normalizer_group_ind = normalizer_group_ind[:minlen]
-
-                    metric_df.loc[metric_group_ind,"value"] = (
-                        metric_df.loc[metric_group_ind,"value"] /
-                        normalizer_df.loc[normalizer_group_ind,"value"].data
-                    )
-
-                # compute derived metric values using configured threshold info
-                self.logger.debug("raw metric before applying threshold for group %s" % (metric_group_name))
-                self.logger.debug(metric_df.loc[metric_group_ind,[group_name,"value"]].to_string(index=False))
-                metric_df.loc[metric_group_ind,"value"] = metric_df.loc[metric_group_ind].apply(
-                    lambda row: metric_group_states[row[group_name]].compute_derived_value(
-                        row.name.value,
-                        row.value
-                        ),
-                    axis=1,
-                )
-                self.logger.debug("derived metric after applying threshold for group %s" % (metric_group_name))
-                self.logger.debug(metric_df.loc[metric_group_ind,[group_name,"value"]].to_string(index=False))
+            normalizer_metrics = None
+            if normalizer_metrics_query is not None:
+                normalizer_metrics = query_results[normalizer_metrics_query]
+            metric_df = self.derive_metric(metric_config, metric_source, new_metric_name, normalizer,
+                                           group_name, query_results[raw_metrics_query],
+                                           normalizer_metrics, metric_window)
+            metric_df = metric_window.append(metric_df, start_time)
+            if metric_df is None:
+                continue
 
-            metric_dfg = metric_df.groupby(group_name)
+            self.deployment_id = metric_df.loc[:,"deploymentId"][0]
             derived_metrics_result.add_metric(
-                metric_source, new_metric_name, is_container_metric, metric_dfg,
+                metric_source, new_metric_name, is_container_metric, metric_df, group_name,
                 metric_config["resource"], metric_config["observation_window_sec"],
                 metric_config["threshold"]["value"], metric_config["threshold"]["type"],
-                metric_config["threshold"]["unit"])
+                metric_config["threshold"]["unit"], write_after=query_start_time)
 
+        self.last_end_time = end_time
         return derived_metrics_result
 
+    def raw_metrics_query(self, metric_config, metric_source, is_container_metric, time_filter):
+        node_metric_keys = "value,nodename,deploymentId"
+        container_metric_keys = "value,\"io.kubernetes.pod.name\",nodename,deploymentId"
+        if is_container_metric:
+            query = ("SELECT %s FROM \"%s\" %s" %
+                (container_metric_keys, metric_source, time_filter))
+        else:
+            query = ("SELECT %s FROM \"%s\" %s" %
+                (node_metric_keys, metric_source, time_filter))
+
+        # construct tags_filter if needed for this metric
+        if "tags" in metric_config:
+            tags = metric_config["tags"]
+            tags_filter = " AND " .join(["\"%s\"='%s'" % (k, v) for k, v in tags.items()])
+            query += (" AND %s" % (tags_filter))
+        return query
+
+    def query_all(self, queries):
+        """ Run the raw metrics queries on the shared query pool, sharing recent identical queries.
+        Returns: { query -> query result }
+        """
+        futures = {}
+        for query in queries:
+            self.logger.debug("raw metrics for derived metrics query = %s" % (query))
+            futures[query] = submit_query(self.influx_client, query)
+        results = {query: future.result() for query, future in futures.items()}
+        self.logger.debug("%d raw metrics queries completed" % len(results))
+        return results
+
+    def normalize(self, metric_df, normalizer_df, group_name, metric_source, normalizer):
+        """ Divide each sample of metric_df by the sample of normalizer_df with the same group and time.
+            The groups whose normalizer values are all zeros, and the samples without a normalizer
+            sample, are dropped.
+        """
+        normalizer_max = normalizer_df.groupby(group_name)["value"].max()
+        zero_groups = normalizer_max.index[normalizer_max == 0]
+        if len(zero_groups) > 0:
+            self.logger.debug("Normalizer metric has all zeros for groups %s; " % list(zero_groups) +
+                  "dropping these groups from the raw metric...")
+            normalizer_df = normalizer_df.loc[~normalizer_df[group_name].isin(zero_groups)]
+
+        normalizer_values = pd.Series(
+            normalizer_df["value"].values,
+            index=pd.MultiIndex.from_arrays([normalizer_df[group_name].values, normalizer_df.index.asi8]))
+        normalizer_values = normalizer_values[~normalizer_values.index.duplicated()]
+        divisors = normalizer_values.reindex(
+            pd.MultiIndex.from_arrays([metric_df[group_name].values, metric_df.index.asi8])).values
+        matched = ~np.isnan(divisors)
+        if not matched.all():
+            self.logger.debug("%d samples of %s have no %s sample at the same time; dropping them..." %
+                  ((~matched).sum(), metric_source, normalizer))
+        return metric_df.loc[matched].assign(value=metric_df["value"].values[matched] / divisors[matched])
+
+    def derive_metric(self, metric_config, metric_source, new_metric_name, normalizer,
+                      group_name, raw_metrics, normalizer_metrics, metric_window):
+        """ Convert the raw samples of a metric into derived values, continuing the window state
+            of each group in metric_window.
+        Returns: the derived metric dataframe, or None if there is no data to derive
+        """
+        if len(raw_metrics) == 0:
+            self.logger.info("Unable to find data for %s; skipping this metric..." %
+                  (metric_source))
+            return None
+        metric_df = raw_metrics[metric_source]
+        # check normalizer metric values if normalization is needed
+        if normalizer is not None:
+            if len(normalizer_metrics) == 0:
+                self.logger.info("Unable to find data for normalizer %s; skipping metric %s..." %
+                      (normalizer, metric_source))
+                return None
+            normalizer_df = normalizer_metrics[normalizer]
+            if normalizer_df["value"].max() == 0:
+                self.logger.info("All zero values in normalizer %s, skipping metric %s..." %
+                      (normalizer, metric_source))
+                return None
+
+        self.logger.debug("Converting raw metric %s\n  into derived metric %s" %
+              (metric_source, new_metric_name))
+
+        # metric_group_name = nodename for node metrics, pod.name for container metrics
+        has_group = metric_df[group_name].notnull() & (metric_df[group_name] != "")
+        if not has_group.all():
+            self.logger.info("Unable to find %s in %d samples of metric %s; dropping them..." %
+                  (group_name, (~has_group).sum(), metric_source))
+            metric_df = metric_df.loc[has_group]
+
+        # perform normalization if needed, dividing each raw sample by the normalizer sample
+        # of the same group and time
+        if normalizer is not None:
+            metric_df = self.normalize(metric_df, normalizer_df, group_name, metric_source, normalizer)
+
+        # compute derived metric values of each group using configured threshold info;
+        # the rows are sorted by group, keeping the time order within each group
+        codes, metric_group_names = pd.factorize(metric_df[group_name])
+        order = np.argsort(codes, kind="stable")
+        metric_df = metric_df.iloc[order]
+        bounds = np.searchsorted(codes[order], np.arange(len(metric_group_names) + 1))
+        times = metric_df.index.asi8
+        values = metric_df["value"].values.astype(float)
+        derived_values = np.empty(len(values))
+        metric_group_states = metric_window.group_states
+        for i, metric_group_name in enumerate(metric_group_names):
+            if metric_group_name not in metric_group_states:
+                metric_group_states[metric_group_name] = WindowState(
+                    metric_config["observation_window_sec"],
+                    metric_config["threshold"]["value"],
+                    SAMPLE_INTERVAL,
+                )
+            group = slice(bounds[i], bounds[i + 1])
+            derived_values[group] = metric_group_states[metric_group_name].compute_derived_values(
+                times[group], values[group])
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("raw metric before applying threshold")
+            self.logger.debug(metric_df[[group_name,"value"]].to_string())
+        metric_df = metric_df.assign(value=derived_values)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("derived metric after applying threshold")
+            self.logger.debug(metric_df[[group_name,"value"]].to_string())
+        return metric_df
+
 
 if __name__ == '__main__':
     dm = MetricsConsumer(
@@ -1,17 +1,107 @@
-import time
-from collections import namedtuple
+import heapq
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import logging
+from math import isnan
 
-from diagnosis.derived_metrics import MetricsResults
+from diagnosis.derived_metrics import MetricResult, MetricsResults, NANOSECONDS_PER_SECOND, bucket_means
 from config import get_config
+import numpy as np
 import pandas as pd
-from numpy import NaN, mean
-from scipy.stats.stats import pearsonr
+from numpy import NaN
+from scipy.special import betainc
 
 config = get_config()
 WINDOW = int(config.get("ANALYZER", "CORRELATION_WINDOW_SECOND"))
 DIAGNOSIS_INTERVAL = int(config.get("ANALYZER", "DIAGNOSIS_INTERVAL_SECOND"))
 SAMPLE_INTERVAL = int(config.get("ANALYZER", "SAMPLE_INTERVAL_SECOND"))
+DIAGNOSIS_PROCESSES = int(config.get("ANALYZER", "DIAGNOSIS_PROCESSES"))
+# number of features whose correlations are computed at once when ranking the top features
+RANK_CHUNK_SIZE = 256
+# the feature samples passed to the worker processes are memory mapped from a file in this directory,
+# a tmpfs where available so they are never written to disk
+SHARED_SAMPLES_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    """ Pool of worker processes selecting the features of the diagnosis cycles of all apps.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=DIAGNOSIS_PROCESSES)
+        return _process_pool
+
+
+def reset_process_pool(pool):
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+
+
+def select_shared_features(app_id, samples_path, lengths, observation_windows, app_metric, top_k):
+    """ Select features in a worker process, from the feature samples written to the memory mapped
+        file samples_path by FeaturesSelector.process_metrics_in_process.
+    Returns: [(column, average, correlation, p-value, confidence score)] of the selected features
+    """
+    buffer = np.memmap(samples_path, dtype=np.uint8, mode="r")
+    try:
+        return _select_features(app_id, buffer, lengths, observation_windows, app_metric, top_k)
+    finally:
+        # the arrays on the mapped file are released once _select_features returns
+        del buffer
+
+
+def _select_features(app_id, buffer, lengths, observation_windows, app_metric, top_k):
+    num_samples = sum(lengths)
+    times = np.ndarray(num_samples, dtype=np.int64, buffer=buffer)
+    values = np.ndarray(num_samples, dtype=np.float64, buffer=buffer, offset=8 * num_samples)
+    metrics = MetricsResults(None)
+    metrics.app_metric = app_metric
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    for i, observation_window in enumerate(observation_windows):
+        samples = slice(offsets[i], offsets[i + 1])
+        metrics.add_feature(MetricResult(times[samples], values[samples], None, None, None, None,
+                                         observation_window, None, None, None))
+    selected = FeaturesSelector(config, app_id).process_metrics(metrics, top_k=top_k)
+    return [(result.column, result.average, result.correlation, result.corr_p_value,
+             result.confidence_score) for result in selected]
+
+
+
+def pearson_correlations(x, y):
+    """ Pearson correlation of each column of x with y, and its two-sided p-value as given by
+        scipy.stats.pearsonr, over the rows where neither the column nor y is NaN.
+    Args:
+        x(numpy 2d array): one feature per column
+        y(numpy 1d array): one value per row of x
+    Returns:
+        (correlations, p-values), numpy 1d arrays with one value per column;
+        NaN for the columns with less than 3 rows to compare or a constant series
+    """
+    valid = ~np.isnan(x) & ~np.isnan(y)[:, None]
+    x = np.where(valid, x, 0.)
+    y = np.where(valid, y[:, None], 0.)
+    n = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = np.where(valid, x - x.sum(axis=0) / n, 0.)
+        y = np.where(valid, y - y.sum(axis=0) / n, 0.)
+        r = np.einsum('ij,ij->j', x, y) / np.sqrt(np.einsum('ij,ij->j', x, x) * np.einsum('ij,ij->j', y, y))
+        r = np.clip(r, -1., 1.)
+        # r follows a beta distribution on [-1, 1] with both shapes n/2 - 1 under no correlation
+        a = n / 2. - 1.
+        p_values = 2. * betainc(a, a, (1. - np.abs(r)) / 2.)
+    r[n < 3] = NaN
+    p_values[n < 3] = NaN
+    return r, p_values
+
 
 class FeaturesSelector(object):
     def __init__(self, config, app_id):
@@ -21,17 +111,23 @@ class FeaturesSelector(object):
         else:
             self.average_threshold = float(config.get("ANALYZER", "FREQUENCY_THRESHOLD"))
         self.num_features = 0
+        self.app_id = app_id
         self.logger = logging.getLogger(app_id)
         return
 
-    def compute_averages(self, metric_results):
+    def compute_averages(self, metrics, metric_results):
         """ Get the average value over time window for each feature. """
-        for result in metric_results:
-            observation_end = result.df.index[-1]
-            observation_start = observation_end - \
-                    pd.Timedelta(seconds=result.observation_window)
-            observation_window_df = result.df.loc[result.df.index >= observation_start]
-            result.average = observation_window_df.mean(axis=0)[0]
+        if not metric_results:
+            return metric_results
+        columns = [result.column for result in metric_results]
+        observation_windows = np.array([result.observation_window for result in metric_results])
+        observation_starts = metrics.bucket_times[-1] - observation_windows * NANOSECONDS_PER_SECOND
+        values = metrics.values[:, columns]
+        in_window = (metrics.bucket_times[:, None] >= observation_starts) & ~np.isnan(values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            averages = np.where(in_window, values, 0.).sum(axis=0) / in_window.sum(axis=0)
+        for result, average in zip(metric_results, averages):
+            result.average = average
         return metric_results
 
     def filter_features(self, metric_results, filter_type="average"):
@@ -50,10 +146,15 @@ class FeaturesSelector(object):
         return [result for result in metric_results
                                 if result.corr_p_value < threshold]
 
-    def compute_correlations(self, app_df, metric_results):
-        for result in metric_results:
-            result.correlation, result.corr_p_value = pearsonr(result.df.iloc[:,0].interpolate(),
-                                                               app_df.iloc[:,0].interpolate())
+    def compute_correlations(self, app_df, metrics, metric_results):
+        if not metric_results:
+            return metric_results
+        app_values = app_df.iloc[:,0].interpolate().values
+        features = pd.DataFrame(
+            metrics.values[:, [result.column for result in metric_results]]).interpolate().values
+        correlations, p_values = pearson_correlations(features, app_values)
+        for result, correlation, p_value in zip(metric_results, correlations, p_values):
+            result.correlation, result.corr_p_value = correlation, p_value
         return metric_results
 
     def compute_confidence_score(self, metric_results):
@@ -61,33 +162,72 @@ class FeaturesSelector(object):
             result.confidence_score = (result.average * result.correlation)
         return metric_results
 
-    def process_metrics(self, metrics):
-        metric_results = [metrics.node_metrics[metric_name][node_name] for
-                      metric_name in metrics.node_metrics
-                      for node_name in metrics.node_metrics[metric_name]] \
-                        + \
-                    [metrics.container_metrics[metric_name][node_name][pod_name]
-                        for metric_name in metrics.container_metrics
-                        for node_name in metrics.container_metrics[metric_name]
-                        for pod_name in metrics.container_metrics[metric_name][node_name]]
+    def select_top_features(self, app_df, metrics, metric_results, top_k):
+        """ Get the top_k features by confidence score, highest first, among those with a significant
+            correlation. As a correlation is at most 1 in absolute value, a feature cannot score above
+            its average: features are scored in chunks by decreasing average, and the rest are skipped
+            once the k-th best score is above the next average.
+        """
+        threshold = float(config.get("ANALYZER", "CORR_SIGNIF_THRESHOLD"))
+        order = sorted(range(len(metric_results)), key=lambda i: metric_results[i].average, reverse=True)
+        # min-heap of the top (score, -position, result); ties keep the original order
+        top = []
+        num_scored = 0
+        num_significant = 0
+        for start in range(0, len(order), RANK_CHUNK_SIZE):
+            if len(top) == top_k and metric_results[order[start]].average < top[0][0]:
+                break
+            positions = order[start:start + RANK_CHUNK_SIZE]
+            chunk = self.compute_correlations(app_df, metrics, [metric_results[i] for i in positions])
+            num_scored += len(chunk)
+            for position, result in zip(positions, chunk):
+                if not result.corr_p_value < threshold:
+                    continue
+                num_significant += 1
+                result.confidence_score = result.average * result.correlation
+                score = 0.0 if isnan(result.confidence_score) else result.confidence_score
+                if len(top) < top_k:
+                    heapq.heappush(top, (score, -position, result))
+                elif (score, -position) > top[0][:2]:
+                    heapq.heapreplace(top, (score, -position, result))
 
+        self.logger.info("Filtered %d of %d scored features with correlation significance threshold %s; "
+                         "skipped %d features that cannot rank in the top %d" %
+                         (num_scored - num_significant, num_scored, threshold,
+                          len(metric_results) - num_scored, top_k))
+        return [result for _, _, result in sorted(top, key=lambda item: item[:2], reverse=True)]
+
+    def rank_features(self, metric_results, top_k):
+        """ Get the top_k features by confidence score, highest first; ties keep the original order,
+            and features without a score rank as a zero score, like select_top_features does.
+        """
+        return heapq.nlargest(top_k, metric_results, key=lambda result: (
+            0.0 if isnan(result.confidence_score) else result.confidence_score))
+
+    def process_metrics(self, metrics, top_k=None):
+        """ Select the features related to the app metric.
+            Returns all the selected features, or only the top_k of them by confidence score if given.
+        """
+        metric_results = metrics.features
         self.num_features = len(metric_results)
         start_time = metrics.app_metric.index[0]
         time_buckets = [start_time + pd.Timedelta(seconds=s)
                         for s in range(0, WINDOW, SAMPLE_INTERVAL)]
 
         app_df = self.match_timestamps(time_buckets, metrics.app_metric)
-        for metric_result in metric_results:
-            metric_result.df = self.match_timestamps(time_buckets, metric_result.df)
+        metrics.align(time_buckets)
 
-        metric_results = self.compute_averages(metric_results)
+        metric_results = self.compute_averages(metrics, metric_results)
         l = len(metric_results)
         metric_results = self.filter_features(metric_results, filter_type="average")
         self.logger.info("Filtered %d of %d features with average threshold %s%%" %
               (l - len(metric_results),
                l,
                self.average_threshold))
-        metric_results = self.compute_correlations(app_df, metric_results)
+        if top_k is not None:
+            return self.select_top_features(app_df, metrics, metric_results, top_k)
+
+        metric_results = self.compute_correlations(app_df, metrics, metric_results)
         l = len(metric_results)
         metric_results = self.filter_features(metric_results, filter_type="correlation")
         self.logger.info("Filtered %d of %d features with correlation significance threshold %s" %
@@ -98,27 +238,51 @@ class FeaturesSelector(object):
 
         return metric_results
 
+    def process_metrics_in_process(self, metrics, top_k=None):
+        """ Same as process_metrics, run in the shared worker process pool so the feature selection
+            of several apps is not serialized by the GIL. The samples of the features are passed
+            through a memory mapped file, and only the selected features come back.
+        """
+        features = metrics.features
+        self.num_features = len(features)
+        lengths = [len(result.times) for result in features]
+        num_samples = sum(lengths)
+        if num_samples == 0:
+            return self.process_metrics(metrics, top_k)
+
+        fd, samples_path = tempfile.mkstemp(prefix="features-", dir=SHARED_SAMPLES_DIR)
+        os.close(fd)
+        try:
+            buffer = np.memmap(samples_path, dtype=np.uint8, mode="w+", shape=16 * num_samples)
+            times = np.ndarray(num_samples, dtype=np.int64, buffer=buffer)
+            times[:] = np.concatenate([result.times for result in features])
+            values = np.ndarray(num_samples, dtype=np.float64, buffer=buffer, offset=8 * num_samples)
+            values[:] = np.concatenate([result.values for result in features])
+            buffer.flush()
+            del buffer, times, values
+
+            pool = get_process_pool()
+            try:
+                selected = pool.submit(select_shared_features, self.app_id, samples_path, lengths,
+                                       [result.observation_window for result in features],
+                                       metrics.app_metric, top_k).result()
+            except BrokenProcessPool:
+                self.logger.warning("Feature selection process pool is broken, selecting features in this process")
+                reset_process_pool(pool)
+                return self.process_metrics(metrics, top_k)
+        finally:
+            os.unlink(samples_path)
+
+        metric_results = []
+        for column, average, correlation, p_value, confidence_score in selected:
+            result = features[column]
+            result.average, result.correlation, result.corr_p_value, result.confidence_score = \
+                average, correlation, p_value, confidence_score
+            metric_results.append(result)
+        return metric_results
+
     def match_timestamps(self, time_buckets, df):
         """ Get the average for a measurement value for each sampling interval. """
-        matched_data = []
-        timestamps = df.index
-        i = 0
-        for time_bucket in time_buckets:
-            bucket_data = []
-            while True:
-                if i >= len(timestamps) - 1:
-                    break
-                ts = timestamps[i]
-                if ts < time_bucket + pd.Timedelta(seconds=SAMPLE_INTERVAL) and ts >= time_bucket:
-                    bucket_data.append(df.loc[ts]['value'])
-                    i += 1
-                elif ts >= time_bucket + pd.Timedelta(seconds=SAMPLE_INTERVAL):
-                    break
-                else:
-                    # the timestamp is before the bucket.
-                    i += 1
-            if not bucket_data:
-                matched_data.append(NaN)
-            else:
-                matched_data.append(mean(bucket_data))
+        matched_data = bucket_means(pd.DatetimeIndex(time_buckets).asi8, df.index.asi8,
+                                    df['value'].values.astype(float))[:, 0]
         return pd.DataFrame(data=matched_data, index=time_buckets)
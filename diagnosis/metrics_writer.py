@@ -0,0 +1,113 @@
+import queue
+import threading
+import time
+
+from config import get_config
+from logger import get_logger
+
+config = get_config()
+WRITE_QUEUE_SIZE = int(config.get("ANALYZER", "WRITE_QUEUE_SIZE"))
+WRITE_BATCH_SIZE = int(config.get("ANALYZER", "WRITE_BATCH_SIZE"))
+WRITE_MAX_RETRIES = int(config.get("ANALYZER", "WRITE_MAX_RETRIES"))
+WRITE_RETRY_BACKOFF = float(config.get("ANALYZER", "WRITE_RETRY_BACKOFF_SECOND"))
+
+logger = get_logger(__name__, log_level=("ANALYZER", "LOGLEVEL"))
+
+
+class MetricsWriter(object):
+    """ Writes dataframes of metric points to an InfluxDB database in the background.
+        Queued dataframes are converted to line protocol and written in batches of up to batch_size
+        points across measurements, retrying failed writes with exponential backoff.
+        When the queue is full, new dataframes are dropped instead of blocking the caller.
+    """
+
+    def __init__(self, influx_client, database, queue_size=WRITE_QUEUE_SIZE, batch_size=WRITE_BATCH_SIZE,
+                 max_retries=WRITE_MAX_RETRIES, retry_backoff=WRITE_RETRY_BACKOFF):
+        self.influx_client = influx_client
+        self.database = database
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stats = {"written": 0, "dropped": 0, "failed": 0}
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def write_points(self, df, measurement, tags=None):
+        """ Queue the points of a dataframe to be written to measurement, with the same arguments as
+            DataFrameClient.write_points.
+        Returns: False if the queue is full and the points were dropped
+        """
+        self.start()
+        try:
+            self.queue.put_nowait((df, measurement, tags))
+        except queue.Full:
+            with self.lock:
+                self.stats["dropped"] += len(df)
+            logger.warning("Metrics write queue of %s is full, dropping %d points of %s" %
+                           (self.database, len(df), measurement))
+            return False
+        return True
+
+    def flush(self):
+        """ Wait until all the queued points are written or have failed.
+        """
+        self.queue.join()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, queued=self.queue.qsize(), queue_size=self.queue.maxsize)
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            lines = self.convert(*items[0])
+            # keep filling full batches while there are queued dataframes, then write what is left
+            while True:
+                while len(lines) >= self.batch_size:
+                    self.write_batch(lines[:self.batch_size])
+                    lines = lines[self.batch_size:]
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+                lines += self.convert(*items[-1])
+
+            if lines:
+                self.write_batch(lines)
+            for _ in items:
+                self.queue.task_done()
+
+    def convert(self, df, measurement, tags):
+        try:
+            return self.influx_client._convert_dataframe_to_lines(df, measurement, global_tags=tags)
+        except Exception:
+            logger.exception("Unable to convert points of %s to line protocol, skipping them" % measurement)
+            with self.lock:
+                self.stats["failed"] += len(df)
+            return []
+
+    def write_batch(self, lines):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.influx_client.write(lines, params={"db": self.database}, protocol="line")
+                with self.lock:
+                    self.stats["written"] += len(lines)
+                return True
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error("Unable to write %d points to %s after %d attempts: %s" %
+                                 (len(lines), self.database, attempt + 1, e))
+                    with self.lock:
+                        self.stats["failed"] += len(lines)
+                    return False
+                backoff = self.retry_backoff * 2 ** attempt
+                logger.warning("Writing %d points to %s failed: %s; retrying in %.2f seconds" %
+                               (len(lines), self.database, e, backoff))
+                time.sleep(backoff)
@@ -1,10 +1,79 @@
+import re
+import threading
+import time
 from unittest import TestCase
+from unittest.mock import patch
 
+import numpy as np
+import pandas as pd
+from influxdb import DataFrameClient
+from scipy.stats import pearsonr
+
+from config import get_config
+from diagnosis.app_analyzer import DiagnosisScheduler
+from diagnosis.derived_metrics import NANOSECONDS_PER_SECOND, SAMPLE_INTERVAL, MetricsConsumer, MetricsResults, \
+    WindowState, submit_query
+from diagnosis.features_selector import FeaturesSelector, get_process_pool, pearson_correlations
+from diagnosis.metrics_writer import MetricsWriter
 from logger import get_logger
 
+config = get_config()
 logger = get_logger(__name__, log_level=("TEST", "LOGLEVEL"))
 
 
+def make_node_metric(num_nodes):
+    """ Returns: an app metric, and a node metric partly correlated with it on each node """
+    times = 10 ** 18 + np.arange(60) * SAMPLE_INTERVAL * NANOSECONDS_PER_SECOND
+    index = pd.to_datetime(times, unit="ns", utc=True)
+    app_metric = pd.DataFrame({"value": np.random.rand(60) * 100}, index=index)
+    df = pd.DataFrame({"value": np.concatenate([app_metric["value"].values * np.random.rand() +
+                                                np.random.rand(60) * 200 for _ in range(num_nodes)]),
+                       "nodename": np.repeat(["node-%03d" % i for i in range(num_nodes)], 60)},
+                      index=index.append([index] * (num_nodes - 1)))
+    return app_metric, df
+
+
+def make_metrics_consumer(measurements):
+    """ Returns: a MetricsConsumer querying the raw measurements from { measurement -> dataframe },
+        and the list of its queries """
+    queries = []
+
+    class FakeInfluxClient(DataFrameClient):
+        def __init__(self, *args):
+            pass
+
+        def create_database(self, *args):
+            pass
+
+        def create_retention_policy(self, *args, **kwargs):
+            pass
+
+        def write(self, *args, **kwargs):
+            pass
+
+        def query(self, query):
+            queries.append(query)
+            measurement = re.search(r'FROM "([^"]+)"', query).group(1)
+            start, end = map(int, re.search(r"time > (\d+) AND time <= (\d+)", query).groups())
+            df = measurements[measurement]
+            df = df.loc[(df.index.asi8 > start) & (df.index.asi8 <= end)].copy()
+            return {measurement: df} if len(df) > 0 else {}
+
+    with patch("diagnosis.derived_metrics.DataFrameClient", FakeInfluxClient), \
+            patch.dict("diagnosis.derived_metrics._influx_clients", clear=True), \
+            patch.dict("diagnosis.derived_metrics._metrics_writers", clear=True):
+        consumer = MetricsConsumer({}, "./diagnosis/derived_slo_metric_config.json",
+                                   "./diagnosis/derived_metrics_config.json", "test_app_id")
+    return consumer, queries
+
+
+def make_metrics_results(app_metric, df):
+    results = MetricsResults(None)
+    results.app_metric = app_metric
+    results.add_metric("metric", "metric/type", False, df, "nodename", "cpu", 60, 80, "UB", "percent")
+    return results
+
+
 class AppAnalyzerTest(TestCase):
     def testAnalyzerUsingRawMetrics(self):
         """ Assert that the analyzer receives raw data for the app
@@ -25,6 +94,49 @@ class AppAnalyzerTest(TestCase):
         """ Same as above but for frequency calculation type. """
         pass
 
+    def testDiagnosisScheduler(self):
+        """ Assert that the scheduler runs the cycles of all apps on the
+        interval grid, at most workers at a time, and stops scheduling
+        the cycles of removed apps. """
+        interval = NANOSECONDS_PER_SECOND // 5
+        cycles = []
+        lock = threading.Lock()
+        running = [0, 0]
+
+        class FakeAnalyzer(object):
+            def __init__(self, app_id):
+                self.app_id = app_id
+                self.sliding_interval = interval
+                self.delay_interval = 7
+
+            def run_cycle(self, end_time):
+                with lock:
+                    running[0] += 1
+                    running[1] = max(running)
+                    cycles.append((self.app_id, end_time))
+                time.sleep(0.02)
+                with lock:
+                    running[0] -= 1
+
+        scheduler = DiagnosisScheduler(2)
+        for i in range(5):
+            scheduler.add_app(FakeAnalyzer("app-%d" % i))
+        time.sleep(0.5)
+        scheduler.remove_app("app-0")
+        time.sleep(0.1)
+        with lock:
+            num_cycles = len([app_id for app_id, _ in cycles if app_id == "app-0"])
+        time.sleep(0.3)
+
+        self.assertEqual(running[1], 2)
+        self.assertEqual(set(app_id for app_id, _ in cycles), set("app-%d" % i for i in range(5)))
+        self.assertTrue(all((end_time + 7) % interval == 0 for _, end_time in cycles))
+        self.assertEqual(len([app_id for app_id, _ in cycles if app_id == "app-0"]), num_cycles)
+        for i in range(1, 5):
+            end_times = [end_time for app_id, end_time in cycles if app_id == "app-%d" % i]
+            self.assertGreaterEqual(len(end_times), 3)
+            self.assertEqual(set(np.diff(end_times)), {interval})
+
     def testAllMetricsFiltered(self):
         """ Assert that AppAnalyzer logs the appropriate information
         and continues without throwing an error. """
@@ -50,11 +162,196 @@ class MetricsConsumerTest(TestCase):
         """ Same as above for derived data. """
         pass
 
+    def testSubmitQueryCoalescing(self):
+        """ Assert that identical queries submitted close together share
+        a single query, and that failed queries are not shared. """
+        queries = []
+
+        class FakeInfluxClient(object):
+            def query(self, query):
+                queries.append(query)
+                time.sleep(0.05)
+                if "fail" in query:
+                    raise Exception("timeout")
+                return {"result": query}
+
+        influx_client = FakeInfluxClient()
+        with patch.dict("diagnosis.derived_metrics._recent_queries", clear=True):
+            futures = [submit_query(influx_client, query) for query in ["a", "b", "a", "fail", "a"]]
+            self.assertEqual([future.result()["result"] for future in futures[:3]], ["a", "b", "a"])
+            self.assertIsNotNone(futures[3].exception())
+            submit_query(influx_client, "fail").exception()
+            self.assertIs(submit_query(FakeInfluxClient(), "a").result()["result"], "a")
+
+        self.assertIs(futures[0], futures[2])
+        self.assertIs(futures[0], futures[4])
+        self.assertEqual(sorted(queries), ["a", "a", "b", "fail", "fail"])
+
     def testWriteDerivedMetrics(self):
         """ Assert that MetricsConsumer can write derived metrics
         to influx. """
         pass
 
+    def testGetDerivedMetricsIncrementally(self):
+        """ Assert that consecutive diagnosis cycles only query the raw
+        samples after the last cycle, give the derived values of a
+        window state running over all the samples, and write each
+        derived sample back once. """
+        metric_source = "intel/procfs/cpu/utilization_percentage"
+        times = 10 ** 18 + np.arange(200) * SAMPLE_INTERVAL * NANOSECONDS_PER_SECOND
+        raw_df = pd.DataFrame({"value": np.random.rand(200) * 100, "nodename": "node-1",
+                               "deploymentId": "deployment"},
+                              index=pd.to_datetime(times, unit="ns", utc=True))
+        consumer, queries = make_metrics_consumer({metric_source: raw_df})
+        consumer.config = consumer.config[:1]
+
+        window = 300 * NANOSECONDS_PER_SECOND
+        interval = 30 * NANOSECONDS_PER_SECOND
+        written = []
+        with patch.object(consumer.derived_metrics_writer, "write_points",
+                          lambda df, measurement, tags: written.append(df)):
+            for end_time in range(int(times[100]), int(times[-1]), interval):
+                results = consumer.get_derived_metrics(end_time - window, end_time)
+        self.assertIn("WHERE time > %d AND time <= %d" % (end_time - interval, end_time), queries[-1])
+
+        state = WindowState(60, 80, SAMPLE_INTERVAL)
+        expected = state.compute_derived_values(times, raw_df["value"].values)
+        in_window = (times > end_time - window) & (times <= end_time)
+        result = results.node_metrics[metric_source + "/over_utilization"]["node-1"]
+        np.testing.assert_array_equal(result.times, times[in_window])
+        np.testing.assert_array_equal(result.values, expected[in_window])
+
+        # the window state starts with the samples of the first cycle
+        written = pd.concat(written)
+        in_cycles = (times > int(times[100]) - window) & (times <= end_time)
+        np.testing.assert_array_equal(written.index.asi8, times[in_cycles])
+        expected_written = WindowState(60, 80, SAMPLE_INTERVAL).compute_derived_values(
+            times[in_cycles], raw_df["value"].values[in_cycles])
+        np.testing.assert_array_equal(written["value"].values, expected_written)
+
+    def testGetNormalizedDerivedMetrics(self):
+        """ Assert that each raw sample is normalized by the normalizer
+        sample of the same node and time, and that the nodes with an all
+        zeros or no normalizer are dropped. """
+        times = 10 ** 18 + np.arange(30) * SAMPLE_INTERVAL * NANOSECONDS_PER_SECOND
+        index = pd.to_datetime(times, unit="ns", utc=True)
+        raw_df = pd.DataFrame({"value": np.random.rand(90) * 10,
+                               "nodename": np.repeat(["node-1", "node-2", "node-3"], 30),
+                               "deploymentId": "deployment"},
+                              index=index.append([index, index])).sort_index(kind="stable")
+        normalizer_df = pd.DataFrame({"value": np.concatenate((np.random.rand(29) * 100, np.zeros(30))),
+                                      "nodename": np.repeat(["node-1", "node-2"], [29, 30]),
+                                      "deploymentId": "deployment"},
+                                     index=index.delete(7).append(index)).sort_index(kind="stable")
+        consumer, _ = make_metrics_consumer({"intel/psutil/net/all/errin": raw_df,
+                                             "intel/psutil/net/all/packets_recv": normalizer_df})
+        consumer.config = [metric_config for metric_config in consumer.config
+                           if metric_config["metric_name"] == "intel/psutil/net/all/errin"]
+
+        results = consumer.get_derived_metrics(int(times[0]) - 1, int(times[-1]))
+
+        node_metrics = results.node_metrics["intel/psutil/net/all/errin_normalized/resource_bottleneck"]
+        self.assertEqual(list(node_metrics.keys()), ["node-1"])
+        node_1 = raw_df["nodename"] == "node-1"
+        raw_values = raw_df.loc[node_1, "value"].values
+        normalizer_values = normalizer_df.loc[normalizer_df["nodename"] == "node-1", "value"].values
+        normalized_values = np.delete(raw_values, 7) / normalizer_values
+        expected = WindowState(60, 0.01, SAMPLE_INTERVAL).compute_derived_values(
+            np.delete(times, 7), normalized_values)
+        np.testing.assert_array_equal(node_metrics["node-1"].times, np.delete(times, 7))
+        np.testing.assert_array_equal(node_metrics["node-1"].values, expected)
+
+    def testAlignContainerMetrics(self):
+        """ Assert that the container metrics are stored as one feature
+        per pod, indexed by metric, node and pod, and aligned into a
+        column per feature. """
+        times = 10 ** 18 + np.arange(60) * SAMPLE_INTERVAL * NANOSECONDS_PER_SECOND
+        pod_names = np.array(["pod-b", "pod-a", None])[np.arange(60) % 3]
+        df = pd.DataFrame({"value": np.random.rand(60), "io.kubernetes.pod.name": pod_names,
+                           "nodename": np.where(pod_names == "pod-a", "node-1", "node-2")},
+                          index=pd.to_datetime(times, unit="ns", utc=True))
+
+        results = MetricsResults(None)
+        results.add_metric("intel/docker/stats/cgroups/cpu_stats/cpu_usage/total",
+                           "intel/docker/stats/cgroups/cpu_stats/cpu_usage/total/over_utilization",
+                           True, df, "io.kubernetes.pod.name", "cpu", 60, 80, "UB", "percent")
+        time_buckets = list(df.index[::6])
+        values = results.align(time_buckets)
+
+        self.assertEqual([(result.node_name, result.pod_name) for result in results.features],
+                         [("node-1", "pod-a"), ("node-2", "pod-b")])
+        self.assertEqual(sorted(results.feature_keys.values()), [0, 1])
+        self.assertEqual(values.shape, (len(time_buckets), 2))
+        selector = FeaturesSelector(config, "test_app_id")
+        for result in results.features:
+            pod_df = df.loc[df["io.kubernetes.pod.name"] == result.pod_name]
+            self.assertIs(results.container_metrics[result.metric_name][result.node_name][result.pod_name],
+                          result)
+            np.testing.assert_array_equal(result.times, pod_df.index.asi8)
+            np.testing.assert_allclose(values[:, result.column],
+                                       selector.match_timestamps(time_buckets, pod_df).iloc[:, 0].values)
+
+
+class MetricsWriterTest(TestCase):
+    def testBatchedWritesWithRetries(self):
+        """ Assert that queued dataframes of several measurements are
+        written together in batches, that failed writes are retried and
+        that dataframes are dropped when the queue is full. """
+        batches = []
+        failures = [Exception("timeout")]
+
+        class FakeInfluxClient(DataFrameClient):
+            def write(self, data, params=None, expected_response_code=204, protocol="json"):
+                if failures:
+                    raise failures.pop()
+                batches.append((list(data), params, protocol))
+
+        index = pd.to_datetime(10 ** 18 + np.arange(30) * NANOSECONDS_PER_SECOND, unit="ns", utc=True)
+        writer = MetricsWriter(FakeInfluxClient(), "derivedmetrics", queue_size=3, batch_size=50,
+                               retry_backoff=0.01)
+        # hold the writer thread back until all the dataframes are queued
+        paused = threading.Event()
+        writer.thread = threading.Thread(target=paused.wait, daemon=True)
+        writer.thread.start()
+        results = [writer.write_points(pd.DataFrame({"value": np.random.rand(30)}, index=index),
+                                       "metric-%d" % i, {"deployment_id": "deployment"}) for i in range(4)]
+        threading.Thread(target=writer.run, daemon=True).start()
+        writer.flush()
+        paused.set()
+
+        self.assertEqual(results, [True, True, True, False])
+        self.assertEqual([len(lines) for lines, _, _ in batches], [50, 40])
+        self.assertEqual(set(protocol for _, _, protocol in batches), {"line"})
+        self.assertEqual(batches[0][1], {"db": "derivedmetrics"})
+        self.assertTrue(batches[0][0][0].startswith("metric-0,deployment_id=deployment value="))
+        self.assertTrue(batches[1][0][-1].startswith("metric-2,"))
+        self.assertEqual(writer.get_stats(), {"written": 90, "dropped": 30, "failed": 0,
+                                              "queued": 0, "queue_size": 3})
+
+
+class WindowStateTest(TestCase):
+    def testComputeDerivedValues(self):
+        """ Assert that the vectorized derived values, computed over a
+        series in two parts, are identical to computing them sample by
+        sample, including gap-filling, missing values and the window left
+        at the end. """
+        sample_interval = 5
+        steps = np.array([1, 1, 1, 2, 1, 3, 1, 1, 0, 17, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1] * 5)
+        times = 10 ** 18 + np.cumsum(steps) * sample_interval * NANOSECONDS_PER_SECOND
+        values = np.random.rand(len(times)) * 10
+        values[::7] = np.nan
+        values[::5] = 0.
+
+        for compute_type in ["AREA", "FREQUENCY"]:
+            state, vectorized_state = WindowState(30, 5, sample_interval), WindowState(30, 5, sample_interval)
+            expected = [state.compute_derived_value(int(t), v, compute_type) for t, v in zip(times, values)]
+            derived_values = np.concatenate(
+                (vectorized_state.compute_derived_values(times[:42], values[:42], compute_type),
+                 vectorized_state.compute_derived_values(times[42:], values[42:], compute_type)))
+
+            np.testing.assert_array_equal(derived_values, expected)
+            self.assertEqual([tuple(p) for p in vectorized_state.values], [tuple(p) for p in state.values])
+
 
 class DiagnosisGeneratorTest(TestCase):
     def testMapProblems(self):
@@ -75,7 +372,84 @@ class FeaturesSelectorTest(TestCase):
         """ Assert that the result of
         features_selector.match_timestamps() is Dataframe with
         data bucketed by the analyzer sample interval. """
-        pass
+        interval = pd.Timedelta(seconds=SAMPLE_INTERVAL)
+        start_time = pd.Timestamp(10 ** 18, tz="UTC")
+        time_buckets = [start_time + i * interval for i in range(60)]
+        offsets = np.sort(np.random.randint(-20, 70 * SAMPLE_INTERVAL * 1000, 150))
+        timestamps = pd.to_datetime(10 ** 18 + offsets * 10 ** 6, unit="ns", utc=True)
+        df = pd.DataFrame({"value": np.random.rand(150)}, index=timestamps)
+        df["value"].values[::11] = np.nan
+
+        matched_df = FeaturesSelector(config, "test_app_id").match_timestamps(time_buckets, df)
+
+        self.assertEqual(list(matched_df.index), time_buckets)
+        for time_bucket, matched_value in zip(time_buckets, matched_df.iloc[:, 0]):
+            in_bucket = (df.index >= time_bucket) & (df.index < time_bucket + interval)
+            if in_bucket.any():
+                np.testing.assert_allclose(matched_value, np.mean(df["value"].values[in_bucket]))
+            else:
+                self.assertTrue(np.isnan(matched_value))
+
+    def testPearsonCorrelations(self):
+        """ Assert that the correlations and p-values of all features,
+        computed at once over the rows without missing values, match
+        scipy's pearsonr on each feature. """
+        y = np.random.rand(60)
+        x = np.column_stack([y * np.random.rand() + np.random.rand(60) * i for i in range(8)])
+        x[:5, 2] = np.nan
+        x[::3, 3] = np.nan
+        y[10] = np.nan
+        x[:, 4] = 1.
+        x[2:, 5] = np.nan
+
+        correlations, p_values = pearson_correlations(x, y)
+
+        for i in range(4):
+            valid = ~np.isnan(x[:, i]) & ~np.isnan(y)
+            expected = pearsonr(x[valid, i], y[valid])
+            np.testing.assert_allclose([correlations[i], p_values[i]], expected, rtol=1e-7, atol=1e-12)
+        self.assertTrue(np.isnan(correlations[4:6]).all())
+        self.assertTrue(np.isnan(p_values[4:6]).all())
+
+    def testSelectTopFeatures(self):
+        """ Assert that the top k features, scored by decreasing average
+        with an early cutoff, are the first k of all the selected
+        features sorted by confidence score. """
+        app_metric, df = make_node_metric(300)
+
+        selected = FeaturesSelector(config, "test_app_id").process_metrics(
+            make_metrics_results(app_metric, df), top_k=None)
+        expected = sorted(selected, key=lambda result: result.confidence_score, reverse=True)[:10]
+        with patch("diagnosis.features_selector.RANK_CHUNK_SIZE", 8):
+            top = FeaturesSelector(config, "test_app_id").process_metrics(
+                make_metrics_results(app_metric, df), top_k=10)
+
+        self.assertGreater(len(selected), 10)
+        self.assertEqual([result.node_name for result in top], [result.node_name for result in expected])
+        self.assertEqual([result.confidence_score for result in top],
+                         [result.confidence_score for result in expected])
+        ranked = FeaturesSelector(config, "test_app_id").rank_features(selected, 10)
+        self.assertEqual([result.node_name for result in ranked], [result.node_name for result in expected])
+
+    def testProcessMetricsInProcess(self):
+        """ Assert that selecting the features in a worker process, with
+        their samples in a memory mapped file, gives the same features and
+        scores as selecting them in this process. """
+        app_metric, df = make_node_metric(50)
+
+        expected = FeaturesSelector(config, "test_app_id").process_metrics(
+            make_metrics_results(app_metric, df), top_k=10)
+        with patch("diagnosis.features_selector.DIAGNOSIS_PROCESSES", 2), \
+                patch("diagnosis.features_selector._process_pool", None):
+            top = FeaturesSelector(config, "test_app_id").process_metrics_in_process(
+                make_metrics_results(app_metric, df), top_k=10)
+            get_process_pool().shutdown()
+
+        self.assertGreater(len(expected), 0)
+        self.assertEqual([(result.node_name, result.average, result.correlation, result.corr_p_value,
+                           result.confidence_score) for result in top],
+                         [(result.node_name, result.average, result.correlation, result.corr_p_value,
+                           result.confidence_score) for result in expected])
 
     def testFilterFeaturesCorrelation(self):
         """ Assert that if features are above the threshold for
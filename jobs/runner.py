@@ -200,6 +200,18 @@ class JobsRunner(object):
         self.job_states[job_name] = job_state
         self.schedule_job(job_state)
 
+    def remove_job(self, job_name):
+        """
+        Removes a job from the schedule and from the stored job states, e.g. when it's been replaced by another job.
+        """
+        if job_name not in self.job_states:
+            return
+
+        schedule.clear(job_name)
+        del self.job_states[job_name]
+        jobs.delete_job_state(job_name)
+        self.logger.info("Removed job %s" % job_name)
+
     def schedule_job(self, job_state):
         schedule.every(1).days.at(job_state.schedule_at).do(self._submit_job, job_state).tag(job_state.job_name)
         #schedule.every(5).seconds.do(self._submit_job, job_state).tag(job_state.job_name)
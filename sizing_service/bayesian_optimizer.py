@@ -1,17 +1,27 @@
 from __future__ import division, print_function
 
+import copy
+
 import numpy as np
 from config import get_config
 from logger import get_logger
+from scipy.linalg import cho_solve, cholesky, solve_triangular
 from scipy.optimize import minimize
 from scipy.stats import norm
 from sklearn.gaussian_process import GaussianProcessRegressor
-from sklearn.gaussian_process.kernels import Matern
+from sklearn.gaussian_process.kernels import (RBF, ConstantKernel, Matern, Product,
+                                              Sum, WhiteKernel)
 from sklearn.preprocessing import scale
 
 config = get_config()
 random_samples = config.getint("BAYESIAN_OPTIMIZER", "RANDOM_SAMPLES")
 random_seeds = config.getint("BAYESIAN_OPTIMIZER", "RANDOM_SEEDS")
+gp_refit_interval = config.getint("BAYESIAN_OPTIMIZER", "GP_REFIT_INTERVAL")
+gp_likelihood_drift = config.getfloat("BAYESIAN_OPTIMIZER", "GP_LIKELIHOOD_DRIFT")
+shared_kernel = config.getboolean("BAYESIAN_OPTIMIZER", "SHARED_KERNEL")
+
+# lower bound of the posterior std used when differentiating the acquisition functions
+MIN_STD = 1e-12
 
 logger = get_logger(__name__, log_level=("BAYESIAN_OPTIMIZER", "LOGLEVEL"))
 
@@ -71,9 +81,15 @@ class UtilityFunction(object):
         """ Compute the cdf under constraint_upper (i.e. P(c(x) < constraint_upper)) to modulate the ei(x).
             where c(x) is the estimated marginal distribution of the Gaussian process.
         """
-        ei = UtilityFunction._ei(x, gp_objective, xi)
-
-        mean, std = gp_constraint.predict(x, return_std=True)
+        if UtilityFunction._shares_kernel(gp_objective, gp_constraint):
+            # a single kernel evaluation serves both gaussian processes
+            (obj_mean, obj_std), (mean, std) = UtilityFunction._predict_shared(x, [gp_objective, gp_constraint])
+            y_max = gp_objective.y_train_.max()
+            z = (obj_mean - y_max - xi) / obj_std
+            ei = (obj_mean - y_max - xi) * norm.cdf(z) + obj_std * norm.pdf(z)
+        else:
+            ei = UtilityFunction._ei(x, gp_objective, xi)
+            mean, std = gp_constraint.predict(x, return_std=True)
         z = (constraint_upper - mean) / std
 
         cumulative_probabiliy = norm.cdf(z)
@@ -86,17 +102,239 @@ class UtilityFunction(object):
         z = (mean - y_max - xi) / std
         return norm.cdf(z)
 
+    @staticmethod
+    def _shares_kernel(gp_objective, gp_constraint):
+        """ Check if both gaussian processes come from one shared-kernel fit
+            (see get_fitted_shared_gaussian_processors).
+        """
+        L = getattr(gp_objective, 'L_', None)
+        return L is not None and L is getattr(gp_constraint, 'L_', None)
 
-def acq_max(utility, bounds):
+    @staticmethod
+    def _predict_shared(x, gps):
+        """ Compute the posterior mean and std of gaussian processes sharing their kernel, X_train and
+            Cholesky factor, as gp.predict does, with a single kernel evaluation.
+        Returns:
+            list of (mean, std), one per gaussian process
+        """
+        gp = gps[0]
+        k_trans = gp.kernel_(x, gp.X_train_)
+        v = solve_triangular(gp.L_, k_trans.T, lower=True, check_finite=False)
+        var = gp.kernel_.diag(x).copy()
+        var -= np.einsum('ij,ij->j', v, v)
+        var[var < 0] = 0.
+        std = np.sqrt(var)
+
+        posteriors = []
+        for gp in gps:
+            y_train_mean = getattr(gp, '_y_train_mean', 0.)
+            y_train_std = getattr(gp, '_y_train_std', 1.)
+            posteriors.append((y_train_std * k_trans.dot(gp.alpha_) + y_train_mean, y_train_std * std))
+        return posteriors
+
+    def supports_gradient(self):
+        """ Check if the analytic gradient is available for the kernels of the fitted gaussian processes.
+        """
+        gps = [self.gp_objective]
+        if self.kind == 'cei':
+            gps.append(self.gp_constraint)
+        try:
+            for gp in gps:
+                UtilityFunction._stationary_kernel(gp.kernel_)
+        except NotImplementedError:
+            return False
+        return True
+
+    def utility_and_gradient(self, x):
+        """ Compute the acquisition function and its analytic gradient w.r.t. each row of x.
+        Returns:
+            ys(numpy 1d array): acquisition values, one per row of x
+            dys(numpy 2d array): gradient of the acquisition value of each row of x
+        """
+        gp_objective = self.gp_objective
+        gp_constraint = self.gp_constraint
+        constraint_upper = self.constraint_upper
+        xi, kappa = self.xi, self.kappa
+
+        if self.kind == 'ucb':
+            return UtilityFunction._ucb_and_gradient(x, gp_objective, kappa)
+        if self.kind == 'ei':
+            return UtilityFunction._ei_and_gradient(x, gp_objective, xi)
+        if self.kind == 'cei':
+            assert gp_constraint is not None, 'gaussian processor for constraint must be provided'
+            assert constraint_upper is not None, 'constraint_upper must be provided'
+            return UtilityFunction._cei_and_gradient(x, gp_objective, xi, gp_constraint, constraint_upper)
+        if self.kind == 'poi':
+            return UtilityFunction._poi_and_gradient(x, gp_objective, xi)
+
+    def condition_on_mean(self, x):
+        """ Kriging believer: condition the gaussian processes on their own posterior mean at x,
+            as if x had been sampled, while keeping the kernel hyperparameters fixed.
+            The posterior std around x shrinks, so the next acquisition maximum moves elsewhere.
+            Gaussian processes sharing their Cholesky factor keep sharing the extended one.
+        Returns:
+            UtilityFunction: a new utility function over the conditioned gaussian processes
+        """
+        x = np.atleast_2d(x)
+        extended = {}
+
+        def condition(gp):
+            if gp is None:
+                return None
+            if id(gp.L_) not in extended:
+                X_train = np.vstack((gp.X_train_, x))
+                L = extend_cholesky(gp.kernel_, gp.L_, gp.X_train_, X_train, gp.alpha)
+                extended[id(gp.L_)] = X_train, L
+            X_train, L = extended[id(gp.L_)]
+            # posterior mean at x in the space of y_train_
+            y_train = np.append(gp.y_train_, gp.kernel_(x, gp.X_train_).dot(gp.alpha_))
+
+            gp_conditioned = copy.copy(gp)
+            gp_conditioned.X_train_ = X_train
+            gp_conditioned.y_train_ = y_train
+            gp_conditioned.L_ = L
+            gp_conditioned.alpha_ = cho_solve((L, True), y_train)
+            # drop the inverse of K of gp, cached by predict(return_std=True) of scikit-learn before 0.23
+            gp_conditioned._K_inv = None
+            return gp_conditioned
+
+        return UtilityFunction(self.kind, condition(self.gp_objective), condition(self.gp_constraint),
+                               constraint_upper=self.constraint_upper, xi=self.xi, kappa=self.kappa)
+
+    @staticmethod
+    def _ucb_and_gradient(x, gp_objective, kappa):
+        mean, std, d_mean, d_std = UtilityFunction._posterior_and_gradient(x, gp_objective)
+        return mean + kappa * std, d_mean + kappa * d_std
+
+    @staticmethod
+    def _ei_and_gradient(x, gp_objective, xi, kernel_terms=None):
+        y_max = gp_objective.y_train_.max()
+        mean, std, d_mean, d_std = UtilityFunction._posterior_and_gradient(x, gp_objective, kernel_terms)
+        z = (mean - y_max - xi) / std
+        cdf, pdf = norm.cdf(z), norm.pdf(z)
+        ei = (mean - y_max - xi) * cdf + std * pdf
+        return ei, cdf[:, None] * d_mean + pdf[:, None] * d_std
+
+    @staticmethod
+    def _cei_and_gradient(x, gp_objective, xi, gp_constraint, constraint_upper):
+        kernel_terms = None
+        if UtilityFunction._shares_kernel(gp_objective, gp_constraint):
+            kernel_terms = UtilityFunction._kernel_terms(x, gp_objective)
+        ei, d_ei = UtilityFunction._ei_and_gradient(x, gp_objective, xi, kernel_terms)
+
+        mean, std, d_mean, d_std = UtilityFunction._posterior_and_gradient(x, gp_constraint, kernel_terms)
+        z = (constraint_upper - mean) / std
+        cumulative_probabiliy = norm.cdf(z)
+        d_cumulative_probabiliy = (norm.pdf(z) / std)[:, None] * (-d_mean - z[:, None] * d_std)
+        return cumulative_probabiliy * ei, \
+            d_cumulative_probabiliy * ei[:, None] + cumulative_probabiliy[:, None] * d_ei
+
+    @staticmethod
+    def _poi_and_gradient(x, gp_objective, xi):
+        y_max = gp_objective.y_train_.max()
+        mean, std, d_mean, d_std = UtilityFunction._posterior_and_gradient(x, gp_objective)
+        z = (mean - y_max - xi) / std
+        return norm.cdf(z), (norm.pdf(z) / std)[:, None] * (d_mean - z[:, None] * d_std)
+
+    @staticmethod
+    def _kernel_terms(x, gp):
+        """ Compute the kernel terms of the posterior of a fitted gaussian process at x:
+            k(x, X_train), its gradient w.r.t. x, K^-1 k(X_train, x) and the prior variance k(x, x).
+        """
+        x = np.atleast_2d(x)
+        k_trans = gp.kernel_(x, gp.X_train_)
+        d_k_trans = UtilityFunction._kernel_gradient(gp.kernel_, x, gp.X_train_)
+        k_inv_k = cho_solve((gp.L_, True), k_trans.T)
+        return k_trans, d_k_trans, k_inv_k, gp.kernel_.diag(x)
+
+    @staticmethod
+    def _posterior_and_gradient(x, gp, kernel_terms=None):
+        """ Compute the posterior mean and std of a fitted gaussian process, as gp.predict does,
+            together with their gradients w.r.t. each row of x, using a few matrix products
+            for all rows at once. The kernel terms can be shared by gaussian processes fitted
+            with a shared kernel.
+        """
+        if kernel_terms is None:
+            kernel_terms = UtilityFunction._kernel_terms(x, gp)
+        k_trans, d_k_trans, k_inv_k, prior_var = kernel_terms
+        alpha = gp.alpha_.reshape(-1)
+
+        mean = k_trans.dot(alpha)
+        d_mean = np.einsum('nmd,m->nd', d_k_trans, alpha)
+        var = prior_var - np.einsum('nm,mn->n', k_trans, k_inv_k)
+        std = np.sqrt(np.maximum(var, MIN_STD ** 2))
+        d_std = -np.einsum('nmd,mn->nd', d_k_trans, k_inv_k) / std[:, None]
+
+        # undo normalisation of y_train
+        y_train_mean = np.ravel(getattr(gp, '_y_train_mean', 0.))[0]
+        y_train_std = np.ravel(getattr(gp, '_y_train_std', 1.))[0]
+        return y_train_std * mean + y_train_mean, y_train_std * std, \
+            y_train_std * d_mean, y_train_std * d_std
+
+    @staticmethod
+    def _stationary_kernel(kernel):
+        """ Decompose a kernel into amplitude * base kernel (+ white noise) where base kernel is RBF or Matern.
+        Returns:
+            amplitude(float), base kernel
+        """
+        if isinstance(kernel, Sum):
+            if isinstance(kernel.k2, WhiteKernel):
+                return UtilityFunction._stationary_kernel(kernel.k1)
+            if isinstance(kernel.k1, WhiteKernel):
+                return UtilityFunction._stationary_kernel(kernel.k2)
+        if isinstance(kernel, Product):
+            if isinstance(kernel.k1, ConstantKernel):
+                amplitude, base = UtilityFunction._stationary_kernel(kernel.k2)
+                return kernel.k1.constant_value * amplitude, base
+            if isinstance(kernel.k2, ConstantKernel):
+                amplitude, base = UtilityFunction._stationary_kernel(kernel.k1)
+                return kernel.k2.constant_value * amplitude, base
+        if isinstance(kernel, Matern) and kernel.nu in [0.5, 1.5, 2.5, np.inf]:
+            return 1., kernel
+        if isinstance(kernel, RBF) and not isinstance(kernel, Matern):
+            return 1., kernel
+        raise NotImplementedError(f"Analytic gradient is not implemented for kernel {kernel}")
+
+    @staticmethod
+    def _kernel_gradient(kernel, x, X_train):
+        """ Compute the gradient of k(x, X_train) w.r.t. x.
+        Returns:
+            d_k(numpy 3d array): d_k[i, j, :] is the gradient of k(x[i], X_train[j]) w.r.t. x[i]
+        """
+        amplitude, base = UtilityFunction._stationary_kernel(kernel)
+        length_scale = np.asarray(base.length_scale, dtype=float)
+        scaled_diff = (x[:, None, :] - X_train[None, :, :]) / length_scale
+        r = np.sqrt(np.sum(scaled_diff ** 2, axis=2))
+
+        # d_k/d_x = - amplitude * g(r) * (x - x_train) / length_scale^2
+        nu = getattr(base, 'nu', np.inf)
+        if nu == 0.5:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                g = np.where(r > 0, np.exp(-r) / r, 0.)
+        elif nu == 1.5:
+            g = 3. * np.exp(-np.sqrt(3.) * r)
+        elif nu == 2.5:
+            g = 5. / 3. * (1. + np.sqrt(5.) * r) * np.exp(-np.sqrt(5.) * r)
+        else:
+            g = np.exp(-.5 * r ** 2)
+
+        return -amplitude * g[:, :, None] * scaled_diff / length_scale
+
+
+def acq_max(utility, bounds, utility_and_gradient=None):
     """ A function to find the maximum of the acquisition function
         It uses a combination of random sampling (cheap) and the 'L-BFGS-B'
         optimization method: 1) by sampling of "random_samples" number of random points,
         and 2) by running L-BFGS-B from "random_seeds" number of starting points.
+        If utility_and_gradient is given, all starting points are advanced together in a single
+        L-BFGS-B run over the stacked points using analytic gradients; otherwise L-BFGS-B
+        is run from each starting point separately with finite-difference gradients.
     Args:
         ac: The acquisition function object that return its point-wise value.
         gp_objective: A gaussian process fitted to the relevant data.
         y_max: The current maximum known value of the target function.
         bounds: The variables bounds to limit the search of the acq max.
+        utility_and_gradient: The acquisition function that return its point-wise value and gradient.
     Returns
         x_max: The arg max of the acquisition function.
     """
@@ -112,22 +350,132 @@ def acq_max(utility, bounds):
     # Explore the parameter space more throughly using L-BFGS-B
     x_seeds = np.random.uniform(bounds[:, 0], bounds[:, 1],
                                 size=(random_seeds, bounds.shape[0]))
-    for x_try in x_seeds:
-        # Find the minimum of minus the acquisition function
-        res = minimize(lambda x: -utility(x.reshape(1, -1)), x_try.reshape(1, -1),
-                       bounds=bounds,
-                       method="L-BFGS-B")
+    if utility_and_gradient is not None:
+        x_opts = acq_max_batched(utility_and_gradient, bounds, x_seeds)
+        ys = utility(x_opts)
+        ys[np.isnan(ys)] = -np.inf
 
         # Store it if better than previous minimum(maximum).
-        if max_acq is None or -res.fun[0] >= max_acq:
-            x_max = res.x
-            max_acq = -res.fun[0]
+        if max_acq is None or ys.max() >= max_acq:
+            x_max = x_opts[ys.argmax()]
+            max_acq = ys.max()
+    else:
+        for x_try in x_seeds:
+            # Find the minimum of minus the acquisition function
+            res = minimize(lambda x: -utility(x.reshape(1, -1)), x_try.reshape(1, -1),
+                           bounds=bounds,
+                           method="L-BFGS-B")
+
+            # Store it if better than previous minimum(maximum).
+            if max_acq is None or -res.fun[0] >= max_acq:
+                x_max = res.x
+                max_acq = -res.fun[0]
 
     # Clip output to make sure it lies within the bounds.
     # Due to floating point operations this is not always guaranteed.
     return np.clip(x_max, bounds[:, 0], bounds[:, 1])
 
 
+def acq_max_batched(utility_and_gradient, bounds, x_seeds):
+    """ A function to run L-BFGS-B from all starting points at once
+        The sum of the acquisition values over all points is maximized; since the points
+        do not interact, each point converges to a local maximum of its own, while every
+        iteration only costs one vectorized evaluation of the acquisition function and its gradient.
+    Args:
+        utility_and_gradient: The acquisition function that return its point-wise value and gradient.
+        bounds: The variables bounds to limit the search of the acq max.
+        x_seeds(numpy 2d array): starting points
+    Returns
+        x_opts(numpy 2d array): local maximum found from each starting point
+    """
+    n_seeds, n_dim = x_seeds.shape
+
+    def neg_utility(x_flat):
+        ys, dys = utility_and_gradient(x_flat.reshape(n_seeds, n_dim))
+        return -ys.sum(), -dys.ravel()
+
+    res = minimize(neg_utility, x_seeds.ravel(), jac=True,
+                   bounds=np.tile(bounds, (n_seeds, 1)),
+                   method="L-BFGS-B")
+    logger.debug(f'Batched L-BFGS-B finished after {res.nit} iterations: {res.message}')
+
+    return np.clip(res.x.reshape(n_seeds, n_dim), bounds[:, 0], bounds[:, 1])
+
+
+def acq_rank(utility, candidate_mat):
+    """ A function to rank a finite set of candidates by the acquisition function
+        All candidates are scored in a single vectorized call of the utility function,
+        so no random sampling or L-BFGS-B search over the continuous feature space is needed.
+    Args:
+        utility: The acquisition function that return its point-wise value.
+        candidate_mat(numpy 2d array): feature vectors of the candidates
+    Returns
+        order(numpy 1d array): indices of the candidates sorted by decreasing utility
+        ys(numpy 1d array): utility value of each candidate
+    """
+    ys = np.asarray(utility(candidate_mat), dtype=float)
+    # Undefined utility values (i.e. zero posterior std) are ranked last
+    ys[np.isnan(ys)] = -np.inf
+    logger.info(f'nonzeros in the utility function: {np.count_nonzero(ys)}')
+    order = np.argsort(-ys, kind='mergesort')
+
+    return order, ys
+
+
+def acq_rank_q(util, candidate_mat, q):
+    """ A function to select a batch of q candidates from one gaussian process fit (Kriging believer)
+        After each pick, the gaussian processes are conditioned on their posterior mean at the picked
+        candidate, so the next pick is the best candidate given that the previous ones will be sampled.
+    Args:
+        util(UtilityFunction): the acquisition function over the fitted gaussian processes
+        candidate_mat(numpy 2d array): feature vectors of the candidates
+        q(int): number of candidates to select
+    Returns
+        batch(list of tuples): (index, utility) of the selected candidates in selection order
+        order(numpy 1d array): indices of the candidates sorted by decreasing utility before conditioning
+        ys(numpy 1d array): utility value of each candidate before conditioning
+    """
+    order, ys = acq_rank(utility=util.utility, candidate_mat=candidate_mat)
+    batch = [(order[0], ys[order[0]])]
+    round_order, round_ys = order, ys
+    while len(batch) < min(q, len(candidate_mat)):
+        try:
+            util = util.condition_on_mean(candidate_mat[batch[-1][0]])
+            round_order, round_ys = acq_rank(utility=util.utility, candidate_mat=candidate_mat)
+        except np.linalg.LinAlgError:
+            # The picked candidate coincides with a sample; keep the ranking of the previous round
+            logger.debug(f"Unable to condition on candidate {batch[-1][0]}; reusing the previous ranking")
+        picked = {i for i, _ in batch}
+        i = next(i for i in round_order if i not in picked)
+        batch.append((i, round_ys[i]))
+
+    return batch, order, ys
+
+
+def acq_max_q(util, bounds, q):
+    """ A function to find a batch of q maxima of the acquisition function from one gaussian process
+        fit (Kriging believer), by conditioning the gaussian processes on their posterior mean at each
+        maximum found before searching for the next one.
+    Args:
+        util(UtilityFunction): the acquisition function over the fitted gaussian processes
+        bounds: The variables bounds to limit the search of the acq max.
+        q(int): number of points to find
+    Returns
+        x_maxes(numpy 2d array): the q points in selection order
+    """
+    x_maxes = []
+    while True:
+        x_maxes.append(acq_max(utility=util.utility, bounds=bounds,
+                               utility_and_gradient=util.utility_and_gradient if util.supports_gradient() else None))
+        if len(x_maxes) >= q:
+            return np.array(x_maxes)
+        try:
+            util = util.condition_on_mean(x_maxes[-1])
+        except np.linalg.LinAlgError:
+            logger.debug(f"Unable to condition on {x_maxes[-1]}; stopping the batch at {len(x_maxes)} points")
+            return np.array(x_maxes)
+
+
 def unique_rows(a):
     """ A functions to trim repeated rows that may appear when optimizing.
         This is necessary to avoid the sklearn GP object from breaking
@@ -148,7 +496,130 @@ def unique_rows(a):
     return ui[reorder]
 
 
-def get_fitted_gaussian_processor(X_train, y_train, constraint_upper, standardize_y=True, **gp_params):
+class GaussianProcessState(object):
+    """ An object to keep the kernel hyperparameters and Cholesky factor of a gaussian process
+        across the iterations of a sizing session. New observations are added with a rank-k update
+        of the Cholesky factor, and the hyperparameters are re-optimized only every refit_interval
+        updates, or when the log marginal likelihood per sample drifts by more than likelihood_drift.
+    """
+
+    def __init__(self, refit_interval=gp_refit_interval, likelihood_drift=gp_likelihood_drift):
+        self.refit_interval = refit_interval
+        self.likelihood_drift = likelihood_drift
+        self.kernel_ = None
+        self.X_train_ = None
+        self.L_ = None
+        self.num_updates = 0
+        self.lml_per_sample = None
+
+    def fit(self, gp, X_train, y_train):
+        """ Fit the gaussian process regressor, reusing the state from the previous fit when possible.
+        Args:
+            gp(GaussianProcessRegressor): regressor with its parameters set
+            X_train(numpy 2d array): feature vectors, starting with the ones of the previous fit
+            y_train(numpy 1d array): target values
+        Return:
+            gp(GaussianProcessRegressor): fitted regressor
+        """
+        X_train = np.asarray(X_train, dtype=float)
+        y_train = np.asarray(y_train, dtype=float)
+        if self.needs_refit(gp, X_train):
+            return self.refit(gp, X_train, y_train)
+
+        L = self.extend_cholesky(gp.alpha, X_train)
+        alpha = cho_solve((L, True), y_train)
+        # summed over the targets if y_train has multiple columns
+        n_outputs = y_train.size // len(y_train)
+        lml = -.5 * np.sum(y_train * alpha) - \
+            n_outputs * (np.log(np.diag(L)).sum() + .5 * len(y_train) * np.log(2 * np.pi))
+        if lml / y_train.size < self.lml_per_sample - self.likelihood_drift:
+            logger.debug(f"Log marginal likelihood per sample drifted from {self.lml_per_sample} "
+                         f"to {lml / y_train.size}; re-optimizing hyperparameters")
+            return self.refit(gp, X_train, y_train)
+
+        logger.debug(f"Added {len(X_train) - len(self.X_train_)} samples to the gaussian process "
+                     f"with kernel {self.kernel_}")
+        self.X_train_ = X_train
+        self.L_ = L
+        self.num_updates += 1
+
+        # Populate the fitted attributes as GaussianProcessRegressor.fit does
+        gp.kernel_ = self.kernel_
+        gp.X_train_ = X_train
+        gp.y_train_ = y_train
+        gp.L_ = L
+        gp.alpha_ = alpha
+        gp.log_marginal_likelihood_value_ = lml
+        gp.n_features_in_ = X_train.shape[1]
+        gp._y_train_mean = np.zeros(y_train.shape[1:] or 1)
+        gp._y_train_std = np.ones(y_train.shape[1:] or 1)
+        # predict(return_std=True) of scikit-learn before 0.23 caches the inverse of K from L_ here
+        gp._K_inv = None
+        return gp
+
+    def needs_refit(self, gp, X_train):
+        if self.kernel_ is None or self.num_updates >= self.refit_interval:
+            return True
+        if gp.normalize_y or not np.isscalar(gp.alpha):
+            return True
+        # The new samples can only be appended to the ones from the previous fit
+        n_prev = len(self.X_train_)
+        return len(X_train) < n_prev or not np.array_equal(X_train[:n_prev], self.X_train_)
+
+    def refit(self, gp, X_train, y_train):
+        if self.kernel_ is not None:
+            # Warm start the hyperparameter optimization from the previous optimum
+            gp.set_params(kernel=self.kernel_)
+        gp.fit(X_train, y_train)
+
+        self.kernel_ = gp.kernel_
+        self.X_train_ = X_train
+        self.L_ = gp.L_
+        self.num_updates = 0
+        self.lml_per_sample = gp.log_marginal_likelihood_value_ / y_train.size
+        return gp
+
+    def extend_cholesky(self, noise, X_train):
+        return extend_cholesky(self.kernel_, self.L_, self.X_train_, X_train, noise)
+
+
+def extend_cholesky(kernel, L, X_prev, X_train, noise):
+    """ Rank-k update of the Cholesky factor L of K(X_prev, X_prev) + noise * I
+        with the appended rows X_new = X_train[len(X_prev):]:
+        [[L, 0], [L_21, L_22]], where L_21 = (L^-1 K(X_prev, X_new))^T and
+        L_22 = cholesky(K(X_new, X_new) + noise * I - L_21 L_21^T)
+    """
+    n_prev = len(X_prev)
+    X_new = X_train[n_prev:]
+    if len(X_new) == 0:
+        return L
+
+    L_21 = solve_triangular(L, kernel(X_prev, X_new), lower=True).T
+    K_22 = kernel(X_new)
+    K_22[np.diag_indices_from(K_22)] += noise
+    L_22 = cholesky(K_22 - L_21.dot(L_21.T), lower=True)
+
+    L_ext = np.zeros((len(X_train), len(X_train)))
+    L_ext[:n_prev, :n_prev] = L
+    L_ext[n_prev:, :n_prev] = L_21
+    L_ext[n_prev:, n_prev:] = L_22
+    return L_ext
+
+
+def scale_target(y_train, constraint_upper):
+    """ Standardize the target values together with the constraint_upper, if given.
+    Return:
+        y_train(numpy 1d array): standardized target values
+        scaled_constraint_upper(float): standardized constraint_upper, or None
+    """
+    if constraint_upper is not None:
+        y_train = scale(np.hstack((y_train, constraint_upper)))
+        return y_train[:-1], y_train[-1]
+    return scale(y_train), None
+
+
+def get_fitted_gaussian_processor(X_train, y_train, constraint_upper, standardize_y=True,
+                                  gp_state=None, **gp_params):
     # Initialize gaussian process regressor
     gp = GaussianProcessRegressor()
     gp.set_params(**gp_params)
@@ -156,14 +627,7 @@ def get_fitted_gaussian_processor(X_train, y_train, constraint_upper, standardiz
     logger.debug(f"Fitting gaussian processor")
 
     if standardize_y:
-        if constraint_upper is not None:
-            y_train = scale(np.hstack((y_train, constraint_upper)))
-            scaled_constraint_upper = y_train[-1]
-            y_train = y_train[:-1]
-        else:
-            y_train = scale(y_train)
-            scaled_constraint_upper = None
-        gp.constraint_upper = scaled_constraint_upper
+        y_train, gp.constraint_upper = scale_target(y_train, constraint_upper)
     else:
         gp.constraint_upper = constraint_upper
 
@@ -173,15 +637,47 @@ def get_fitted_gaussian_processor(X_train, y_train, constraint_upper, standardiz
     if gp_params is None or gp_params.get('alpha') is None:
         # Find unique rows of X to avoid GP from breaking
         ur = unique_rows(X_train)
-        gp.fit(X_train[ur], y_train[ur])
-    else:
-        gp.fit(X_train, y_train)
+        X_train, y_train = X_train[ur], y_train[ur]
+
+    if gp_state is not None:
+        return gp_state.fit(gp, X_train, y_train)
+    gp.fit(X_train, y_train)
     return gp
 
 
+def get_fitted_shared_gaussian_processors(X_train, y_train, constraint_arr, constraint_upper,
+                                          standardize_y=True, gp_state=None, **gp_params):
+    """ Fit the gaussian processes of the objective and the constraint in one pass with a shared kernel:
+        the hyperparameters are optimized for both targets jointly, and the kernel Gram matrix
+        and its Cholesky factor are computed once for the two columns of targets.
+    Return:
+        gp_objective, gp_constraint: fitted regressors sharing kernel_, X_train_ and L_
+    """
+    if standardize_y:
+        y_train, objective_constraint_upper = scale_target(y_train, constraint_upper)
+        constraint_arr, constraint_upper = scale_target(constraint_arr, constraint_upper)
+    else:
+        objective_constraint_upper = constraint_upper
+
+    gp = get_fitted_gaussian_processor(X_train, np.column_stack((y_train, constraint_arr)), None,
+                                       standardize_y=False, gp_state=gp_state, **gp_params)
+
+    gp_objective, gp_constraint = copy.copy(gp), copy.copy(gp)
+    for i, gp_output in enumerate([gp_objective, gp_constraint]):
+        gp_output.alpha_ = gp.alpha_[:, i]
+        gp_output.y_train_ = gp.y_train_[:, i]
+        for attr in ['_y_train_mean', '_y_train_std']:
+            if np.size(getattr(gp, attr, 0.)) > 1:
+                setattr(gp_output, attr, np.ravel(getattr(gp, attr))[i])
+    gp_objective.constraint_upper = objective_constraint_upper
+    gp_constraint.constraint_upper = constraint_upper
+    return gp_objective, gp_constraint
+
+
 def get_candidate(feature_mat, objective_arr, bounds, acq,
                   constraint_arr=None, constraint_upper=None,
-                  kappa=5, xi=0.0, standardize_y=True, **gp_params):
+                  kappa=5, xi=0.0, standardize_y=True, candidates=None, gp_states=None,
+                  shared_kernel=shared_kernel, batch_size=1, **gp_params):
     """ Compute the next candidate based on Bayesian Optimization
     Args:
         feature_mat(numpy 2d array): feature vectors
@@ -189,9 +685,21 @@ def get_candidate(feature_mat, objective_arr, bounds, acq,
         bounds(array of tuples): the searching boundary of feature space
             i.e. bounds=[(x1_lo, x1_hi), (x2_lo, x2_hi), (x3_lo, x3_hi)]
         acq(str): kind of acquisition function
+        candidates(dict): optional map of candidate name to feature vector;
+            if given, only these candidates are scored instead of searching the feature space
+        gp_states(dict): optional map of 'objective' and 'constraint' to GaussianProcessState
+            kept from the previous call in the same session
+        shared_kernel(bool): fit the objective and constraint with a shared kernel in one pass;
+            the 'objective' gp_state is then used for both
+        batch_size(int): number of candidates to propose from this fit (see acq_rank_q and acq_max_q)
 
     Return:
-        argmax(vector): argmax of acquisition function
+        argmax(vector): argmax of acquisition function, or a 2d array of batch_size argmaxes if batch_size > 1
+        candidate_rank (list of tuples): if candidates is given, list of (utility, candidate name)
+            sorted by decreasing utility, i.e. [(0.526, 'nodetype1'), (0.353, 'nodetype2'), ...];
+            if batch_size > 1, the first batch_size entries are the batch in selection order
+        If gp_states is given, a tuple of the above and the updated gp_states is returned,
+        as the states are updated in a worker process.
     """
     # TODO: Put these into config file
     if gp_params is None:
@@ -201,12 +709,21 @@ def get_candidate(feature_mat, objective_arr, bounds, acq,
     # Set boundary
     bounds = np.asarray(bounds)
 
-    gp_objective = get_fitted_gaussian_processor(
-        feature_mat, objective_arr, constraint_upper, standardize_y=standardize_y, **gp_params)
-    if (constraint_arr is not None) and (constraint_upper is not None):
+    if shared_kernel and (constraint_arr is not None) and (constraint_upper is not None):
+        gp_objective, gp_constraint = get_fitted_shared_gaussian_processors(
+            feature_mat, objective_arr, constraint_arr, constraint_upper, standardize_y=standardize_y,
+            gp_state=gp_states['objective'] if gp_states else None, **gp_params)
+    elif (constraint_arr is not None) and (constraint_upper is not None):
+        gp_objective = get_fitted_gaussian_processor(
+            feature_mat, objective_arr, constraint_upper, standardize_y=standardize_y,
+            gp_state=gp_states['objective'] if gp_states else None, **gp_params)
         gp_constraint = get_fitted_gaussian_processor(
-            feature_mat, constraint_arr, constraint_upper, standardize_y=standardize_y, **gp_params)
+            feature_mat, constraint_arr, constraint_upper, standardize_y=standardize_y,
+            gp_state=gp_states['constraint'] if gp_states else None, **gp_params)
     else:
+        gp_objective = get_fitted_gaussian_processor(
+            feature_mat, objective_arr, constraint_upper, standardize_y=standardize_y,
+            gp_state=gp_states['objective'] if gp_states else None, **gp_params)
         gp_constraint, constraint_upper = None, None
 
     # Initialize utiliy function
@@ -214,8 +731,28 @@ def get_candidate(feature_mat, objective_arr, bounds, acq,
                            constraint_upper=gp_constraint.constraint_upper if gp_constraint else None,
                            xi=xi, kappa=kappa)
 
-    # Finding argmax of the acquisition function.
-    logger.debug("Computing argmax of acquisition function")
-    argmax = acq_max(utility=util.utility, bounds=bounds)
-
-    return argmax
+    if candidates is not None:
+        # Ranking the given candidates by the acquisition function.
+        logger.debug(f"Ranking {len(candidates)} candidates by acquisition function")
+        names = list(candidates.keys())
+        candidate_mat = np.array([candidates[n] for n in names])
+        if batch_size > 1:
+            batch, order, ys = acq_rank_q(util, candidate_mat, batch_size)
+            picked = {i for i, _ in batch}
+            result = [(float(y), names[i]) for i, y in batch] + \
+                [(float(ys[i]), names[i]) for i in order if i not in picked]
+        else:
+            order, ys = acq_rank(utility=util.utility, candidate_mat=candidate_mat)
+            result = [(float(ys[i]), names[i]) for i in order]
+    elif batch_size > 1:
+        logger.debug(f"Computing {batch_size} argmaxes of acquisition function")
+        result = acq_max_q(util, bounds, batch_size)
+    else:
+        # Finding argmax of the acquisition function.
+        logger.debug("Computing argmax of acquisition function")
+        result = acq_max(utility=util.utility, bounds=bounds,
+                         utility_and_gradient=util.utility_and_gradient if util.supports_gradient() else None)
+
+    if gp_states is not None:
+        return result, gp_states
+    return result
@@ -1,25 +1,106 @@
 import threading
+import time
+from collections import OrderedDict
+
+from config import get_config
+from logger import get_logger
+
+from .session_store import get_session_store
+from .session_worker_pool import SessionStatus, Status, get_shared_worker_pool
 from .sizing_session import SizingSession
 
+config = get_config()
+max_sessions = config.getint("BAYESIAN_OPTIMIZER_SESSION", "MAX_SESSIONS")
+session_idle_timeout = config.getint("BAYESIAN_OPTIMIZER_SESSION", "SESSION_IDLE_TIMEOUT_SECOND")
+version_check_interval = config.getfloat("BAYESIAN_OPTIMIZER_SESSION", "VERSION_CHECK_INTERVAL_SECOND")
+
+logger = get_logger(__name__, log_level=("BAYESIAN_OPTIMIZER_SESSION", "LOGLEVEL"))
+
 
 class BayesianOptimizerPool():
-    def __init__(self):
-        # store the bayesian optimizer session objects
+    def __init__(self, max_sessions=max_sessions, idle_timeout=session_idle_timeout,
+                 version_check_interval=version_check_interval):
+        # store the bayesian optimizer session objects, least recently used first
         self._create_lock = threading.Lock()
-        self.session_map = {}
+        self.session_map = OrderedDict()
+        self.last_access = {}
+        self.last_version_check = {}
+        self.version_check_interval = version_check_interval
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.num_evicted = 0
+        self.num_rehydrated = 0
+        # warm up the optimizer worker processes shared by the sessions
+        get_shared_worker_pool().start()
 
     def get_candidates(self, session_id, request_body):
-        bo_session = self.get_session(session_id)
+        # a session starts over with empty data, so there is nothing to rehydrate
+        bo_session = self.get_session(session_id, rehydrate=bool(request_body['data']), check_version=True)
+        if bo_session.has_jobs_running_elsewhere():
+            return SessionStatus(Status.BAD_REQUEST,
+                                 "Session has work in progress in another process; submit task later")
         return bo_session.get_candidates(request_body['appName'], request_body['data'])
 
     def get_status(self, session_id):
         bo_session = self.get_session(session_id)
         return bo_session.get_status()
 
-    def get_session(self, session_id):
+    def get_session(self, session_id, rehydrate=True, check_version=False):
+        """ Get the session from memory, rehydrating it from the session store if it's not there or if
+            another process has changed it since. The store is checked at most every version_check_interval
+            seconds per session, unless check_version is set, e.g. before submitting new jobs.
+        """
         with self._create_lock:
+            now = time.time()
             session = self.session_map.get(session_id)
+            if session and not session.has_work_in_progress():
+                if not rehydrate:
+                    session = None
+                elif check_version or now - self.last_version_check.get(session_id, 0) >= self.version_check_interval:
+                    self.last_version_check[session_id] = now
+                    if get_session_store().version(session_id) != session.version:
+                        # another process has served the session since; reuse the gaussian process states only
+                        logger.debug(f"[{session_id}] Session changed in the session store")
+                        stale_session, session = session, SizingSession.rehydrate(session_id)
+                        # the states are only valid on the encodings of the same catalog snapshot
+                        if session:
+                            if session.catalog is stale_session.catalog:
+                                session.gp_states = stale_session.gp_states
+                            self.session_map[session_id] = session
             if not session:
-                session = SizingSession(session_id)
+                session = SizingSession.rehydrate(session_id) if rehydrate else None
+                if session:
+                    self.num_rehydrated += 1
+                else:
+                    session = SizingSession(session_id)
                 self.session_map[session_id] = session
-        return session
\ No newline at end of file
+            self.session_map.move_to_end(session_id)
+            self.last_access[session_id] = now
+            self.last_version_check.setdefault(session_id, now)
+            self.evict_sessions(keep=session_id)
+        return session
+
+    def evict_sessions(self, keep=None):
+        """ Evict the sessions that are done or idle for longer than idle_timeout, and the least
+            recently used ones beyond max_sessions. Sessions with work in progress are kept.
+            Evicted sessions can be rehydrated from their sizing documents.
+        """
+        now = time.time()
+        num_over = len(self.session_map) - self.max_sessions
+        for session_id, session in list(self.session_map.items()):
+            if session_id == keep or session.has_work_in_progress():
+                continue
+            if session.done or now - self.last_access[session_id] > self.idle_timeout or num_over > 0:
+                logger.debug(f"[{session_id}] Evicting session")
+                del self.session_map[session_id]
+                del self.last_access[session_id]
+                self.last_version_check.pop(session_id, None)
+                self.num_evicted += 1
+                num_over -= 1
+
+    def get_stats(self):
+        with self._create_lock:
+            return {"liveSessions": len(self.session_map),
+                    "bytesHeld": sum(s.memory_usage() for s in self.session_map.values()),
+                    "evictedSessions": self.num_evicted,
+                    "rehydratedSessions": self.num_rehydrated}
@@ -0,0 +1,96 @@
+import json
+import sqlite3
+import threading
+from contextlib import closing
+from uuid import uuid4
+
+from api_service.db import metricdb
+from config import get_config
+from logger import get_logger
+
+config = get_config()
+sizing_collection = config.get("ANALYZER", "SIZING_COLLECTION")
+session_store_type = config.get("BAYESIAN_OPTIMIZER_SESSION", "SESSION_STORE")
+session_store_path = config.get("BAYESIAN_OPTIMIZER_SESSION", "SESSION_STORE_PATH")
+
+logger = get_logger(__name__, log_level=("BAYESIAN_OPTIMIZER_SESSION", "LOGLEVEL"))
+
+
+# Store of the state of the sizing sessions outside of the process memory, so a session can be served
+# by any gunicorn worker or replica, and resumed after a restart.
+# The state of a session is a json-serializable dict; each save assigns it a new version,
+# so the processes caching a session can tell if another process has changed it since.
+class MongoSessionStore():
+    """ Keeps the session state in the sizing document of each session.
+    """
+
+    def load(self, session_id):
+        """ Return: (state, version), or (None, None) if no state is stored for the session
+        """
+        doc = metricdb[sizing_collection].find_one(
+            {'sessionId': session_id}, {'sessionState': 1, 'sessionStateVersion': 1})
+        if doc is None:
+            return None, None
+        return doc.get('sessionState'), doc.get('sessionStateVersion')
+
+    def version(self, session_id):
+        doc = metricdb[sizing_collection].find_one({'sessionId': session_id}, {'sessionStateVersion': 1})
+        return doc.get('sessionStateVersion') if doc else None
+
+    def save(self, session_id, state):
+        version = uuid4().hex
+        metricdb[sizing_collection].update_one(
+            {'sessionId': session_id},
+            {'$set': {'sessionState': state, 'sessionStateVersion': version}}, upsert=True)
+        return version
+
+
+class LocalSessionStore():
+    """ Keeps the session state in a local sqlite file shared by the processes of a host,
+        as a stand-in for MongoSessionStore.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._execute("CREATE TABLE IF NOT EXISTS sessions "
+                      "(session_id TEXT PRIMARY KEY, state TEXT, version TEXT)")
+
+    def _execute(self, query, params=()):
+        with self._lock, closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            return conn.execute(query, params).fetchone()
+
+    def load(self, session_id):
+        row = self._execute("SELECT state, version FROM sessions WHERE session_id = ?", (session_id,))
+        if row is None:
+            return None, None
+        return json.loads(row[0]), row[1]
+
+    def version(self, session_id):
+        row = self._execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,))
+        return row[0] if row else None
+
+    def save(self, session_id, state):
+        version = uuid4().hex
+        self._execute("INSERT OR REPLACE INTO sessions (session_id, state, version) VALUES (?, ?, ?)",
+                      (session_id, json.dumps(state), version))
+        return version
+
+
+_session_store = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store():
+    global _session_store
+    with _session_store_lock:
+        if _session_store is None:
+            if session_store_type == 'mongo':
+                _session_store = MongoSessionStore()
+            elif session_store_type == 'local':
+                logger.info(f"Storing sizing sessions in {session_store_path}")
+                _session_store = LocalSessionStore(session_store_path)
+            else:
+                raise NotImplementedError(f"Session store {session_store_type} has not been implemented, "
+                                          "please choose one of mongo or local.")
+        return _session_store
@@ -1,4 +1,25 @@
-from concurrent.futures import ProcessPoolExecutor
+import importlib
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from api_service.util import get_nodetype_catalog
+from config import get_config
+from logger import get_logger
+
+config = get_config()
+max_workers = config.getint("BAYESIAN_OPTIMIZER_SESSION", "MAX_WORKERS")
+max_active_sessions = config.getint("BAYESIAN_OPTIMIZER_SESSION", "MAX_ACTIVE_SESSIONS")
+worker_idle_timeout = config.getint("BAYESIAN_OPTIMIZER_SESSION", "WORKER_IDLE_TIMEOUT_SECOND")
+
+logger = get_logger(__name__, log_level=("BAYESIAN_OPTIMIZER_SESSION", "LOGLEVEL"))
+
+# modules imported by each worker process when it starts, so the first job does not pay for them
+WARM_UP_MODULES = ("sizing_service.bayesian_optimizer",)
+
 
 class FuncArgs():
     def __init__(self, function, *args, **kwargs):
@@ -26,32 +47,222 @@ class SessionStatus():
             "data": self.data
         }
 
-# Worker pool that is dedicated to each Bayesian optimizer session.
+def preload_nodetype_catalog():
+    # loaded before the worker processes are forked, so they share the snapshot of the parent process
+    try:
+        get_nodetype_catalog()
+    except Exception as e:
+        logger.warning(f"Failed to preload the nodetype catalog: {e}")
+
+
+def warm_up(modules):
+    for module in modules:
+        importlib.import_module(module)
+    return time.time()
+
+
+# Pool of worker processes shared by all Bayesian optimizer sessions.
+# Jobs are queued per session and dispatched round-robin across the sessions, with at most
+# max_workers_per_session jobs of a session running at a time, so one session cannot starve the others.
+# At most max_active_sessions sessions can have jobs queued or running; further sessions are turned away.
+# The worker processes are started and warmed up ahead of the first job, and shut down
+# after idle_timeout seconds without any job; they are started again on the next job.
+# preload, if given, is called in this process before the worker processes are started.
+class SharedWorkerPool():
+    def __init__(self, workers, max_active_sessions, idle_timeout, warm_up_modules=WARM_UP_MODULES, preload=None):
+        self.workers = workers
+        self.preload = preload
+        self.max_active_sessions = max_active_sessions
+        self.idle_timeout = idle_timeout
+        self.warm_up_modules = warm_up_modules
+        self._lock = threading.RLock()
+        # Queued (future, FuncArgs) of each session, in round-robin order
+        self._queues = OrderedDict()
+        # Number of running jobs and the limit of running jobs of each session
+        self._running = {}
+        self._limits = {}
+        self._executor = None
+        self._idle_timer = None
+
+    def start(self):
+        with self._lock:
+            self._get_executor()
+            self._schedule_idle_shutdown()
+
+    def shutdown(self):
+        with self._lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            if self._executor is not None:
+                logger.info(f"Shutting down {self.workers} optimizer worker processes")
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def active_sessions(self):
+        with self._lock:
+            return set(self._queues) | set(self._running)
+
+    def submit_funcs(self, session_id, funcargs_list, max_workers_per_session):
+        """ Queue the jobs of a session.
+        Return:
+            list of futures, one per job; or None if the pool has max_active_sessions other sessions
+        """
+        with self._lock:
+            active_sessions = self.active_sessions()
+            if session_id not in active_sessions and len(active_sessions) >= self.max_active_sessions:
+                logger.warning(f"[{session_id}] Rejecting jobs: {len(active_sessions)} sessions are active")
+                return None
+
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            self._limits[session_id] = max_workers_per_session
+            if session_id not in self._queues:
+                # A session without queued jobs goes ahead of the ones served already
+                self._queues[session_id] = deque()
+                self._queues.move_to_end(session_id, last=False)
+            queue = self._queues[session_id]
+            futures = []
+            for funcargs in funcargs_list:
+                future = Future()
+                queue.append((future, funcargs))
+                futures.append(future)
+            self._dispatch()
+            return futures
+
+    def _get_executor(self):
+        if self._executor is None:
+            logger.info(f"Starting {self.workers} optimizer worker processes")
+            if self.preload is not None:
+                self.preload()
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            for _ in range(self.workers):
+                self._executor.submit(warm_up, self.warm_up_modules)
+        return self._executor
+
+    def _dispatch(self):
+        # Called with the lock held
+        while sum(self._running.values()) < self.workers:
+            session_id = next((s for s in self._queues
+                               if self._running.get(s, 0) < self._limits[s]), None)
+            if session_id is None:
+                break
+            # Move the session to the end of the round-robin order
+            queue = self._queues.pop(session_id)
+            future, funcargs = queue.popleft()
+            if queue:
+                self._queues[session_id] = queue
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            self._running[session_id] = self._running.get(session_id, 0) + 1
+            executor = self._get_executor()
+            try:
+                worker_future = executor.submit(funcargs.function, *funcargs.args, **funcargs.kwargs)
+            except BrokenProcessPool as e:
+                self._on_done(session_id, future, executor, None, error=e)
+                continue
+            worker_future.add_done_callback(partial(self._on_done, session_id, future, executor))
+
+    def _on_done(self, session_id, future, executor, worker_future, error=None):
+        if error is None:
+            error = worker_future.exception()
+        if error is None:
+            future.set_result(worker_future.result())
+        else:
+            logger.error(f"[{session_id}] Optimizer job failed: {error!r}")
+            future.set_exception(error)
+
+        with self._lock:
+            if isinstance(error, BrokenProcessPool) and self._executor is executor:
+                # A worker process died; the next job starts a new pool. Late jobs of a pool
+                # replaced already leave the current one alone.
+                executor.shutdown(wait=False)
+                self._executor = None
+            self._running[session_id] -= 1
+            if self._running[session_id] == 0:
+                del self._running[session_id]
+                if session_id not in self._queues:
+                    del self._limits[session_id]
+            self._dispatch()
+            if not self._running and not self._queues:
+                self._schedule_idle_shutdown()
+
+    def _schedule_idle_shutdown(self):
+        # Called with the lock held
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+        self._idle_timer = threading.Timer(self.idle_timeout, self._shutdown_if_idle)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+    def _shutdown_if_idle(self):
+        with self._lock:
+            if not self._running and not self._queues:
+                self.shutdown()
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_shared_worker_pool():
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = SharedWorkerPool(max_workers, max_active_sessions, worker_idle_timeout,
+                                            preload=preload_nodetype_catalog)
+        return _shared_pool
+
+
+# Worker pool handle of each Bayesian optimizer session on top of the shared worker pool.
 # The pool assumes each session has one or more stages, and it only expects one stage to run at a time;
 # if a task is submitted while the previous stage is still running, an error is returned.
 class SessionWorkerPool():
-    def __init__(self, workers):
+    def __init__(self, session_id, workers, shared_pool=None):
+        self.session_id = session_id
+        # Maximum number of jobs of this session running at a time
+        self.workers = workers
         # Map for storing the future objects for python concurrent tasks
         self.future_list = []
         # Pool of worker processes for handling jobs
-        self.worker_pool = ProcessPoolExecutor(max_workers=workers)
+        self.worker_pool = shared_pool or get_shared_worker_pool()
 
     def submit_data(self, function, data, *args, **kwargs):
-        if self.get_status().status == Status.RUNNING:
+        return self.submit_funcs([FuncArgs(function, i) for i in data])
+
+    def submit_funcs(self, funcargs_list, done_callback=None):
+        """ Submit the tasks of a stage; done_callback, if given, is called once all of them are done.
+        """
+        if self.has_work_in_progress():
             return SessionStatus(Status.BAD_REQUEST, "Session has work in progress; submit task later")
 
-        self.future_list = [self.worker_pool.submit(
-            function, i) for i in data]
-        return SessionStatus(Status.SUBMITTED)
+        future_list = self.worker_pool.submit_funcs(self.session_id, funcargs_list, self.workers)
+        if future_list is None:
+            return SessionStatus(Status.BAD_REQUEST, "Too many sessions have work in progress; submit task later")
+        self.future_list = future_list
+        if done_callback is not None:
+            remaining = [len(future_list)]
+            lock = threading.Lock()
 
-    def submit_funcs(self, funcargs_list):
-        if self.get_status().status == Status.RUNNING:
-            return SessionStatus(Status.BAD_REQUEST, "Session has work in progress; submit task later")
+            def on_done(future):
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] > 0:
+                        return
+                done_callback()
 
-        self.future_list = [self.worker_pool.submit(
-            f.function, *f.args, **f.kwargs) for f in funcargs_list]
+            for future in future_list:
+                future.add_done_callback(on_done)
         return SessionStatus(Status.SUBMITTED)
 
+    def has_work_in_progress(self):
+        return any(not future.done() for future in self.future_list)
+
+    def clear(self):
+        self.future_list = []
+
     def get_status(self):
         if not self.future_list:
             return SessionStatus(Status.BAD_REQUEST, "Session has no work in progress")
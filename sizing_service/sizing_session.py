@@ -1,20 +1,24 @@
 from __future__ import division, print_function
 
+import os
+import socket
+import sys
 import threading
+import time
 
 import numpy as np
 import pandas as pd
-import copy
 
 from api_service.db import metricdb
 from config import get_config
 from logger import get_logger
 
-from .bayesian_optimizer import get_candidate
+from .bayesian_optimizer import GaussianProcessState, get_candidate
+from .session_store import get_session_store
 from .session_worker_pool import FuncArgs, Status, SessionStatus, SessionWorkerPool
 from state.apps import (get_app_by_name, get_slo_type, get_slo_value, get_budget)
-from api_service.util import (get_all_nodetypes, compute_cost, decode_nodetype, encode_nodetype,
-                              get_price, get_raw_features, get_feature_bounds, get_resource_requests)
+from api_service.util import (get_all_nodetypes, compute_cost, get_nodetype_catalog, get_price,
+                              get_resource_requests)
 
 config = get_config()
 sizing_collection = config.get("ANALYZER", "SIZING_COLLECTION")
@@ -24,6 +28,12 @@ max_samples = config.getint("BAYESIAN_OPTIMIZER_SESSION", "MAX_SAMPLES")
 min_improvement = config.getfloat("BAYESIAN_OPTIMIZER_SESSION", "MIN_IMPROVEMENT")
 BO_objectives = config.get("BAYESIAN_OPTIMIZER_SESSION", "BO_OBJECTIVES").split(',')
 num_workers = config.getint("BAYESIAN_OPTIMIZER_SESSION", "MAX_WORKERS_PER_SESSION")
+candidate_mode = config.get("BAYESIAN_OPTIMIZER_SESSION", "CANDIDATE_MODE")
+batch_size = config.getint("BAYESIAN_OPTIMIZER_SESSION", "BATCH_SIZE")
+job_timeout = config.getint("BAYESIAN_OPTIMIZER_SESSION", "JOB_TIMEOUT_SECOND")
+
+# identity of this process as the owner of the optimizer jobs it runs
+process_id = f"{socket.gethostname()}:{os.getpid()}"
 
 pd.set_option('display.width', 1000)  # widen the display
 np.set_printoptions(precision=3)
@@ -41,15 +51,30 @@ class SizingSession():
 
     def __init__(self, session_id):
         self.session_id = session_id
+        self.app_name = None
 
-        # A single worker pool for this session
-        self.pool = SessionWorkerPool(num_workers)
+        # Handle of this session on the worker pool shared by all sessions
+        self.pool = SessionWorkerPool(session_id, num_workers)
         # Map for caching sample data throughout each sizing session
         self.sample_dataframe = None
         # Map for optimal perf_over_cost value from all samples evaluted
         self.optimal_poc = None
         # Map for caching all the available nodetypes for each session
         self.available_nodetype_set = None
+        # Nodetype catalog snapshot the session is pinned to, so refreshes don't change the nodetypes
+        # and encodings under it
+        self.catalog = None
+        # Map for keeping the gaussian process states of each objective function throughout the session
+        self.gp_states = {}
+        # Flag for the session having met its termination condition
+        self.done = False
+        # Sample data reported by the client, for rebuilding the sample dataframe from the session store
+        self.samples = []
+        # Status of the last optimizer jobs, as saved in the session store
+        self.job = None
+        # Version of the state in the session store this session is in sync with
+        self.version = None
+        self.__job_lock = threading.Lock()
 
     def get_candidates(self, app_name, sample_data):
         """ The public method to asychronously start the jobs for generating candidates.
@@ -62,19 +87,8 @@ class SizingSession():
         if not sample_data or len(sample_data) == 0:
             assert self.available_nodetype_set is None,\
                 "Incoming sample_data can only be empty at the beginning of a session"
-            # initialize with all available nodetypes (defensive copy)
-            self.available_nodetype_set = set(copy.deepcopy(get_all_nodetypes()).keys())
-
-            # update available nodetypes with app container resource requests
-            min_resources = get_resource_requests(app_name)
-            excluded_nodetypes = []
-            for nodetype_name in self.available_nodetype_set:
-                raw_features = get_raw_features(nodetype_name)
-                if raw_features[0] < min_resources['cpu'] or raw_features[2] < min_resources['mem']:
-                    excluded_nodetypes.append(nodetype_name)
-            logger.debug(
-                f"[{self.session_id}] Nodetypes to be excluded due to insufficient resources: {excluded_nodetypes} ")
-            self.update_available_nodetype_set(excluded_nodetypes)
+            self.app_name = app_name
+            self.initialize_available_nodetype_set(app_name)
 
             try:
                 self.initialize_sizing_doc(app_name)
@@ -86,10 +100,8 @@ class SizingSession():
             # draw inital samples
             logger.debug(f"[{self.session_id}] Generating {num_init_samples} random initial samples")
             functions = []
-            functions.append(
-                FuncArgs(SizingSession.generate_initial_samples, num_init_samples, self.available_nodetype_set))
-            with self.__instance_lock:
-                return self.pool.submit_funcs(functions)
+            functions.append(self.initial_samples_job())
+            return self.submit_jobs(functions)
 
         # Pre-process sample data and remove unavailable nodetypes
         logger.debug(f"[{self.session_id}] Received non-empty sample data; preprocessing...")
@@ -98,18 +110,18 @@ class SizingSession():
         self.update_available_nodetype_set(unavailable_nodetypes)
 
         sample_data = list(filter(lambda d: d['qosValue'] != 0., sample_data))
+        self.app_name = app_name
+        self.samples.extend({'instanceType': d['instanceType'], 'qosValue': d['qosValue']} for d in sample_data)
         if not sample_data or len(sample_data) == 0:
             logger.debug(
                 f"[{self.session_id}] All nodetypes suggested previously are unavailable; regenerating...")
             functions = []
-            functions.append(
-                FuncArgs(SizingSession.generate_initial_samples, num_init_samples, self.available_nodetype_set))
-            with self.__instance_lock:
-                return self.pool.submit_funcs(functions)
+            functions.append(self.initial_samples_job())
+            return self.submit_jobs(functions)
 
 
         # Update sample dataframe and check termination
-        new_sample_dataframe = SizingSession.create_sample_dataframe(app_name, sample_data)
+        new_sample_dataframe = SizingSession.create_sample_dataframe(app_name, sample_data, self.catalog)
         # Store the sizing run result to the database
         self.update_sizing_run(new_sample_dataframe)
         self.update_available_nodetype_set(new_sample_dataframe['nodetype'].values)
@@ -122,6 +134,10 @@ class SizingSession():
             logger.info(
                 f"[{self.session_id}] Sizing analysis is done; final recommendations:\n{recommendations}")
             self.store_final_result(recommendations)
+            self.done = True
+            with self.__job_lock:
+                self.job = {'status': Status.DONE}
+                self.save()
             #functions = []
             #functions.append(FuncArgs(self.store_final_result, recommendations))
             #return self.pool.submit_funcs(functions)
@@ -130,29 +146,89 @@ class SizingSession():
         # Dispatch the optimizers for multiple objective functions in parallel
         functions = []
         logger.debug(f"Objective functions used: {BO_objectives}")
+        candidates = None
+        if candidate_mode == 'discrete':
+            # score only the available nodetypes instead of searching the continuous feature space
+            candidates = {n: self.catalog.encode(n) for n in self.available_nodetype_set}
         for obj in BO_objectives:
             training_data = SizingSession.make_optimizer_training_data(
                 self.sample_dataframe, obj)
             logger.debug(f"[{self.session_id}] Dispatching optimizer for objective {obj} \
                 with training data:\n{training_data}")
+            gp_states = self.gp_states.get(obj) or {'objective': GaussianProcessState(),
+                                                    'constraint': GaussianProcessState()}
             functions.append(
                 FuncArgs(get_candidate, \
                          training_data.feature_mat, \
                          training_data.objective_arr, \
-                         get_feature_bounds(normalized=True), \
+                         self.catalog.get_feature_bounds(normalized=True), \
                          acq='cei' if training_data.has_constraint() else 'ei', \
                          constraint_arr=training_data.constraint_arr, \
-                         constraint_upper=training_data.constraint_upper))
+                         constraint_upper=training_data.constraint_upper, \
+                         candidates=candidates, \
+                         gp_states=gp_states, \
+                         batch_size=batch_size))
 
-        with self.__instance_lock:
-            return self.pool.submit_funcs(functions)
+        return self.submit_jobs(functions)
+
+    def submit_jobs(self, functions):
+        """ Submit the optimizer jobs of the next stage and save the session with the job running,
+            so other processes serving this session report it as running until this process saves the result.
+        """
+        with self.__job_lock:
+            with self.__instance_lock:
+                status = self.pool.submit_funcs(functions, done_callback=self.on_jobs_done)
+            if status.status == Status.SUBMITTED:
+                self.job = {'status': Status.RUNNING, 'owner': process_id, 'submittedAt': time.time()}
+                self.save()
+        return status
+
+    def on_jobs_done(self):
+        # Collect the results right away rather than on the next poll, which may go to another process
+        threading.Thread(target=self.get_status, daemon=True).start()
 
     def get_status(self):
         """ The public method to get the state of current optimization jobs of a session.
         """
+        with self.__job_lock:
+            if not self.pool.future_list:
+                return self.get_job_status()
+
+            try:
+                status = self.collect_status()
+            except Exception as e:
+                logger.exception(f"[{self.session_id}] Failed to collect the results of the optimizer jobs")
+                status = SessionStatus(status=Status.SERVER_ERROR, error=str(e))
+            if status.status in [Status.DONE, Status.SERVER_ERROR]:
+                self.pool.clear()
+                self.job = status.to_dict()
+                self.save()
+            return status
+
+    def get_job_status(self):
+        """ Get the status of the optimizer jobs from the session store, as they may have run in another process.
+        """
+        job = self.job
+        if job is None:
+            return SessionStatus(Status.BAD_REQUEST, "Session has no work in progress")
+        if job['status'] == Status.RUNNING:
+            if job['owner'] == process_id or time.time() - job['submittedAt'] > job_timeout:
+                # The process running the jobs has been restarted, or did not save their results
+                return SessionStatus(status=Status.SERVER_ERROR,
+                                     error="Optimizer jobs were lost; submit the last samples again")
+            return SessionStatus(Status.RUNNING)
+        return SessionStatus(job['status'], job.get('data'), job.get('error'))
+
+    def collect_status(self):
         status = self.pool.get_status()
         if status.status == Status.DONE:
             candidates = status.data
+            if candidates and type(candidates[0]) is tuple:
+                # optimizer results come back with the updated gaussian process states
+                with self.__instance_lock:
+                    for obj, (_, gp_states) in zip(BO_objectives, candidates):
+                        self.gp_states[obj] = gp_states
+                candidates = [c for c, _ in candidates]
             if not candidates or len(candidates) == 0:
                 logger.debug(f"[{self.session_id}] No more candidate suggested.")
             else:
@@ -161,19 +237,157 @@ class SizingSession():
                     status.data = candidates[0]
                     # TESTING: Return only the first candidate
                     #status.data = [candidates[0][0]]
+                elif type(candidates[0]) is list:
+                    # candidates are nodetypes already ranked by the optimizer
+                    status.data = self.filter_candidates(
+                        [c for c in candidates if c], picks_per_list=batch_size)
                 else:
-                    # candidates are feature vectors; need to be decoded into nodetypes
+                    # candidates are feature vectors, or batches of them; need to be decoded into nodetypes
                     # TESTING: Return only the first candidate
                     #candidates = [candidates[0]]
+                    feature_vectors = [x for c in candidates if c is not None for x in np.atleast_2d(c)]
+                    # the closest len(feature_vectors) nodetypes of each are enough to pick distinct ones
                     status.data = self.filter_candidates(
-                        [decode_nodetype(c, list(self.available_nodetype_set))
-                            for c in candidates if c is not None])
+                        [self.catalog.nearest(x, self.available_nodetype_set, k=len(feature_vectors))
+                            for x in feature_vectors])
                 logger.debug(
                     f"[{self.session_id}] New candidates suggested for the next sizing run: {status.data}")
                 self.store_sizing_run(status.data)
 
         return status
 
+    def initialize_available_nodetype_set(self, app_name):
+        # initialize with all available nodetypes of the current catalog snapshot, which the session is pinned to
+        self.catalog = get_nodetype_catalog()
+        self.available_nodetype_set = set(self.catalog.names)
+
+        # update available nodetypes with app container resource requests
+        min_resources = get_resource_requests(app_name)
+        excluded_nodetypes = []
+        for nodetype_name in self.available_nodetype_set:
+            raw_features = self.catalog.get_raw_features(nodetype_name)
+            if raw_features[0] < min_resources['cpu'] or raw_features[2] < min_resources['mem']:
+                excluded_nodetypes.append(nodetype_name)
+        logger.debug(
+            f"[{self.session_id}] Nodetypes to be excluded due to insufficient resources: {excluded_nodetypes} ")
+        self.update_available_nodetype_set(excluded_nodetypes)
+
+    def pin_catalog(self, version):
+        """ Pin the session to the catalog snapshot of version, if this process still holds it. Otherwise
+            the session moves to the current snapshot: the nodetypes missing from it become unavailable, and
+            the gaussian process states are dropped so the optimizers refit them on the current encodings.
+        """
+        self.catalog = get_nodetype_catalog(version=version)
+        if self.catalog.version != version:
+            if version is not None:
+                logger.info(f"[{self.session_id}] Nodetype catalog version {version} is no longer held; "
+                            f"moving the session to version {self.catalog.version}")
+            self.gp_states = {}
+            if self.available_nodetype_set is not None:
+                self.available_nodetype_set &= set(self.catalog.names)
+
+    def known_samples(self, samples):
+        """ Samples of the nodetypes in the catalog snapshot of the session.
+        """
+        return [s for s in samples if s['instanceType'] in self.catalog.positions]
+
+    def initial_samples_job(self):
+        instance_families = {n: self.catalog.nodetype_map[n]['instanceFamily'] for n in self.available_nodetype_set}
+        return FuncArgs(SizingSession.generate_initial_samples, num_init_samples, self.available_nodetype_set,
+                        instance_families=instance_families)
+
+    def has_work_in_progress(self):
+        return self.pool.has_work_in_progress()
+
+    def has_jobs_running_elsewhere(self):
+        """ Whether the saved job state says another process is still running the optimizer jobs of this session,
+            so they must not be submitted again until it saves their results or they time out.
+        """
+        job = self.job
+        return job is not None and job['status'] == Status.RUNNING and job['owner'] != process_id \
+            and time.time() - job['submittedAt'] <= job_timeout
+
+    def memory_usage(self):
+        """ Estimate the number of bytes held by the session state.
+        """
+        nbytes = sys.getsizeof(self.available_nodetype_set or ())
+        nbytes += sum(sys.getsizeof(n) for n in self.available_nodetype_set or ())
+        if self.sample_dataframe is not None:
+            nbytes += int(self.sample_dataframe.memory_usage(deep=True).sum())
+        for gp_states in self.gp_states.values():
+            for gp_state in gp_states.values():
+                for arr in [gp_state.X_train_, gp_state.L_]:
+                    nbytes += arr.nbytes if arr is not None else 0
+        return nbytes
+
+    def save(self):
+        """ Save the session state to the session store.
+        """
+        state = {'appName': self.app_name,
+                 'samples': self.samples,
+                 'availableNodetypes': sorted(self.available_nodetype_set or []),
+                 'optimalPoc': None if self.optimal_poc is None else float(self.optimal_poc),
+                 'done': self.done,
+                 'job': self.job,
+                 'catalogVersion': self.catalog.version if self.catalog else None}
+        self.version = get_session_store().save(self.session_id, state)
+
+    @staticmethod
+    def from_state(session_id, state, version):
+        session = SizingSession(session_id)
+        session.app_name = state['appName']
+        session.samples = state['samples']
+        session.available_nodetype_set = set(state['availableNodetypes'])
+        session.pin_catalog(state.get('catalogVersion'))
+        samples = session.known_samples(state['samples'])
+        if samples:
+            session.sample_dataframe = SizingSession.create_sample_dataframe(state['appName'], samples, session.catalog)
+        session.optimal_poc = state['optimalPoc']
+        session.done = state['done']
+        session.job = state['job']
+        session.version = version
+        return session
+
+    @staticmethod
+    def rehydrate(session_id):
+        """ Rebuild a session from the session store, i.e. after it was evicted from memory or
+            served by another process. A session without a stored state is rebuilt from its sizing document:
+            the samples are the results of the finished sizing runs, and the nodetypes suggested
+            in any sizing run are no longer available. The gaussian process states are not stored;
+            the optimizers refit them in the next round.
+        Return:
+            session (SizingSession): the rebuilt session, or None if the session is unknown
+        """
+        state, version = get_session_store().load(session_id)
+        if state is not None:
+            logger.info(f"[{session_id}] Session rehydrated from the session store")
+            return SizingSession.from_state(session_id, state, version)
+
+        sizing_doc = metricdb[sizing_collection].find_one({'sessionId': session_id})
+        if sizing_doc is None:
+            return None
+
+        session = SizingSession(session_id)
+        app_name = sizing_doc['appName']
+        session.initialize_available_nodetype_set(app_name)
+        suggested_nodetypes, sample_data = [], []
+        for sizing_run in sizing_doc['sizingRuns']:
+            for result in sizing_run['results']:
+                suggested_nodetypes.append(result['nodetype'])
+                if result['status'] == "done" and result['qosValue'] != 0.:
+                    sample_data.append({'instanceType': result['nodetype'], 'qosValue': result['qosValue']})
+        session.update_available_nodetype_set(suggested_nodetypes)
+        session.app_name = app_name
+        session.samples = sample_data
+        sample_data = session.known_samples(sample_data)
+        if sample_data:
+            session.sample_dataframe = SizingSession.create_sample_dataframe(app_name, sample_data, session.catalog)
+            session.optimal_poc = session.compute_optimum()
+        session.done = sizing_doc['status'] == "complete"
+
+        logger.info(f"[{session_id}] Session rehydrated from the sizing document with {len(sample_data)} samples")
+        return session
+
     def update_available_nodetype_set(self, exclude_keys):
         with self.__instance_lock:
             assert self.available_nodetype_set is not None,\
@@ -226,11 +440,12 @@ class SizingSession():
                 old_opt_poc = {optimal_poc}, new_opt_poc = {new_opt_poc}")
             return True
 
-    def filter_candidates(self, candidate_rank_list):
+    def filter_candidates(self, candidate_rank_list, picks_per_list=1):
         """ This method filters the recommended candidates before returning to the client
             and avoid returning duplicate result by greedily select the closest solutions as possible
         Args:
             candidate_rank_list: list of rank-ordered candidates
+            picks_per_list: number of nodetypes to select from each list, i.e. the batch size of an optimizer
         Return:
             result (list): list of suggested nodetypes
         """
@@ -246,11 +461,14 @@ class SizingSession():
         # Get the closest candidate greedily
         result = []
         for l in candidate_rank_list:
+            picks = 0
             for row in l:
                 nodetype = row[1]
                 if nodetype not in result:
                     result.append(nodetype)
-                    break
+                    picks += 1
+                    if picks == picks_per_list:
+                        break
 
         logger.debug(f"[{self.session_id}] Filtered candidates: {result}")
         assert len(set(result)) == len(result), "Filtered candidates cannot have duplicates"
@@ -258,19 +476,18 @@ class SizingSession():
 
 
     @staticmethod
-    def generate_initial_samples(num_samples, available_nodetypes=None):
+    def generate_initial_samples(num_samples, available_nodetypes=None, instance_families=None):
         """ This method randomly select a 'instanceFamily',
             and randomly select a 'nodetype' from that family repeatly
+            instance_families maps the nodetype names to their family, as in the catalog snapshot of the session;
+            the current catalog of the process is used if not given.
         """
-        all_nodetypes = get_all_nodetypes()
-        node_values = []
-        if available_nodetypes:
-            for nodetype in available_nodetypes:
-                node_values.append(all_nodetypes[nodetype])
-        else:
-            node_values = list(all_nodetypes.values())
-
-        dataframe = pd.DataFrame.from_dict(node_values)
+        if instance_families is None:
+            all_nodetypes = get_all_nodetypes()
+            instance_families = {n: all_nodetypes[n]['instanceFamily'] for n in all_nodetypes}
+        names = list(available_nodetypes) if available_nodetypes else list(instance_families)
+        dataframe = pd.DataFrame({'name': names,
+                                  'instanceFamily': [instance_families[n] for n in names]})
         instance_families = list(set(dataframe['instanceFamily']))
         available = list(instance_families)
         # check if there is any instance's instanceFamily field is empty string
@@ -368,14 +585,16 @@ class SizingSession():
             raise UserWarning("Unexpected error")
 
     @staticmethod
-    def create_sample_dataframe(app_name, sample_data):
+    def create_sample_dataframe(app_name, sample_data, catalog=None):
         """ Convert input sample data to dataframe of training samples.
         Args:
             app_name(str): Name of the target application
             sample_data(list): List of reported sample data per instance type
+            catalog(NodetypeCatalog): Catalog snapshot to encode the nodetypes with; the current one if None
         Returns:
                 dfs(dataframe): sample data organized in dataframe
         """
+        catalog = catalog or get_nodetype_catalog()
         slo_type = get_slo_type(app_name)
         assert slo_type in ['throughput', 'latency'], \
             f'slo type should be either throughput or latency, but got {slo_type}'
@@ -388,8 +607,8 @@ class SizingSession():
                                'qos_value': [qos_value],
                                'slo_type': [slo_type],
                                'nodetype': [nodetype],
-                               'feature': [encode_nodetype(nodetype)],
-                               'cost': [compute_cost(get_price(nodetype), slo_type, qos_value)],
+                               'feature': [catalog.encode(nodetype)],
+                               'cost': [compute_cost(get_price(nodetype, catalog.nodetype_map), slo_type, qos_value)],
                                'slo_value': [get_slo_value(app_name)],
                                'budget': [get_budget(app_name)]})
             dfs.append(df)
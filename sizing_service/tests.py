@@ -1,22 +1,32 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import gc
 import json
+import os
+import tempfile
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from time import sleep
+from time import sleep, time
 from unittest import TestCase
+from unittest.mock import patch
 
 import numpy as np
 import pandas as pd
 from bayes_opt import BayesianOptimization as BO_ref
+from scipy.optimize import approx_fprime
 from sklearn.gaussian_process.kernels import Matern
 from concurrent.futures import ThreadPoolExecutor
 
 from .bayesian_optimizer_pool import BayesianOptimizerPool as BOP
 from .sizing_session import SizingSession
-from .bayesian_optimizer import (UtilityFunction, get_candidate,
-                                         get_fitted_gaussian_processor)
-from api_service.util import decode_nodetype, get_all_nodetypes, get_feature_bounds, encode_nodetype
+from .session_store import LocalSessionStore
+from .session_worker_pool import FuncArgs, SessionWorkerPool, SharedWorkerPool, Status
+from .bayesian_optimizer import (GaussianProcessState, UtilityFunction, get_candidate,
+                                         get_fitted_gaussian_processor, get_fitted_shared_gaussian_processors)
+from api_service.util import (NodetypeCatalog, NodetypeCatalogCache, decode_nodetype, get_all_nodetypes, get_feature_bounds,
+                              encode_nodetype)
 from api_service.app import app as api_service_app
 from api_service.db import metricdb
 from logger import get_logger
@@ -205,6 +215,167 @@ class BayesianOptimizerTest(TestCase):
                                   constraint_arr=c_train, constraint_upper=2.)
         logger.debug(f"argmax of acquisition cei:\n{candidate}")
 
+    def testGetCandidateDiscreteFlow(self):
+        """ Flow dummy data through get_candidate with a finite set of candidates
+        """
+        # Preparing dummy data
+        n_dimension, n_sample, n_candidate = 5, 4, 50
+        lo, hi = 0, 1
+
+        X_train, y_train = np.random.rand(n_sample, n_dimension), np.random.rand(n_sample)
+        bounds = [(lo, hi)] * n_dimension  # boundary for of searching space
+        candidates = {f'nodetype{i}': x for i, x in enumerate(np.random.rand(n_candidate, n_dimension))}
+
+        candidate_rank = get_candidate(X_train, y_train, bounds, acq='ei', candidates=candidates)
+        logger.debug(f"ranked candidates of acquisition EI:\n {candidate_rank}")
+
+        self.assertEqual(sorted(n for _, n in candidate_rank), sorted(candidates.keys()))
+        utilities = [u for u, _ in candidate_rank]
+        self.assertEqual(utilities, sorted(utilities, reverse=True))
+
+    def testGetCandidateBatchFlow(self):
+        """ Flow dummy data through get_candidate proposing a batch of candidates from one fit
+        """
+        # Preparing dummy data
+        n_dimension, n_sample, n_candidate, batch_size = 5, 4, 50, 3
+        lo, hi = 0, 1
+
+        X_train, y_train, c_train = np.random.rand(
+            n_sample, n_dimension), np.random.rand(n_sample), np.random.rand(n_sample)
+        bounds = [(lo, hi)] * n_dimension  # boundary for of searching space
+        candidates = {f'nodetype{i}': x for i, x in enumerate(np.random.rand(n_candidate, n_dimension))}
+
+        candidate_rank = get_candidate(X_train, y_train, bounds, acq='cei', constraint_arr=c_train,
+                                       constraint_upper=.5, candidates=candidates, batch_size=batch_size)
+        logger.debug(f"ranked candidates of a batch of acquisition CEI:\n {candidate_rank}")
+        self.assertEqual(sorted(n for _, n in candidate_rank), sorted(candidates.keys()))
+
+        argmaxes = get_candidate(X_train, y_train, bounds, acq='ei', batch_size=batch_size)
+        self.assertEqual(argmaxes.shape, (batch_size, n_dimension))
+        self.assertTrue(((argmaxes >= lo) & (argmaxes <= hi)).all())
+
+        # Conditioning on the posterior mean keeps the mean and collapses the std at the picked point
+        gp = get_fitted_gaussian_processor(X_train, y_train, None, alpha=1e-10, kernel=Matern(nu=2.5))
+        # left by predict(return_std=True) of scikit-learn before 0.23
+        gp._K_inv = np.eye(n_sample)
+        util = UtilityFunction(kind='ucb', gp_objective=gp).condition_on_mean(argmaxes[0])
+        self.assertIsNone(util.gp_objective._K_inv)
+        mean, std = util.gp_objective.predict(argmaxes[:1], return_std=True)
+        np.testing.assert_allclose(mean, gp.predict(argmaxes[:1]), rtol=1e-6)
+        self.assertLess(std[0], 1e-3)
+        np.testing.assert_array_equal(gp._K_inv, np.eye(n_sample))
+
+    def testUtilityGradient(self):
+        """ Check the analytic gradient of each acquisition function against finite differences
+        """
+        # Preparing dummy data
+        n_dimension, n_sample = 5, 6
+        X_train, y_train, c_train = np.random.rand(
+            n_sample, n_dimension), np.random.rand(n_sample), np.random.rand(n_sample)
+        gp_params = {"alpha": 1e-10, "kernel": Matern(nu=2.5)}
+
+        gp_objective = get_fitted_gaussian_processor(X_train, y_train, None, **gp_params)
+        gp_constraint = get_fitted_gaussian_processor(X_train, c_train, .5, **gp_params)
+        for kind in ['ucb', 'ei', 'cei', 'poi']:
+            util = UtilityFunction(kind=kind, gp_objective=gp_objective, gp_constraint=gp_constraint,
+                                   constraint_upper=gp_constraint.constraint_upper)
+            self.assertTrue(util.supports_gradient())
+
+            x = np.random.rand(10, n_dimension)
+            ys, dys = util.utility_and_gradient(x)
+            dys_numeric = np.array([approx_fprime(x_i, lambda z: util.utility(z.reshape(1, -1))[0], 1e-7)
+                                    for x_i in x])
+            np.testing.assert_allclose(ys, util.utility(x), rtol=1e-6, err_msg=f"{kind}(x) comparison failed")
+            np.testing.assert_allclose(dys, dys_numeric, rtol=1e-3, atol=1e-5,
+                                       err_msg=f"gradient of {kind}(x) comparison failed")
+
+    def testGaussianProcessStateUpdate(self):
+        """ Check the rank-k update of a gaussian process state against a fit from scratch
+        """
+        # Preparing dummy data
+        n_dimension, n_sample = 5, 8
+        X_train, y_train = np.random.rand(n_sample, n_dimension), np.random.rand(n_sample)
+        gp_params = {"alpha": 1e-10, "n_restarts_optimizer": 5, "kernel": Matern(nu=2.5), "random_state": 0}
+
+        gp_state = GaussianProcessState(refit_interval=5, likelihood_drift=np.inf)
+        get_fitted_gaussian_processor(X_train[:5], y_train[:5], None, standardize_y=False,
+                                      gp_state=gp_state, **gp_params)
+        gp_impl = get_fitted_gaussian_processor(X_train, y_train, None, standardize_y=False,
+                                                gp_state=gp_state, **gp_params)
+        self.assertEqual(gp_state.num_updates, 1)
+
+        # Reference fit with the same hyperparameters
+        gp_ref = get_fitted_gaussian_processor(X_train, y_train, None, standardize_y=False,
+                                               **dict(gp_params, kernel=gp_state.kernel_, optimizer=None))
+
+        x = np.random.rand(100, n_dimension)
+        mu_ref, std_ref = gp_ref.predict(x, return_std=True)
+        mu_impl, std_impl = gp_impl.predict(x, return_std=True)
+        np.testing.assert_allclose(gp_impl.L_, gp_ref.L_, atol=1e-8)
+        np.testing.assert_allclose(mu_impl, mu_ref, atol=1e-6, err_msg="mu(x) comparison failed")
+        np.testing.assert_allclose(std_impl, std_ref, atol=1e-6, err_msg="std(x) comparison failed")
+        self.assertAlmostEqual(gp_impl.log_marginal_likelihood_value_,
+                               gp_ref.log_marginal_likelihood_value_, places=6)
+
+    def testGaussianProcessStateUpdatePredictStd(self):
+        """ An incrementally updated gaussian process predicts its std like a fitted one, without
+            reusing the inverse of K cached by the regressor it was filled in
+        """
+        n_dimension, n_sample = 5, 8
+        X_train, y_train = np.random.rand(n_sample, n_dimension), np.random.rand(n_sample)
+        gp_params = {"alpha": 1e-10, "kernel": Matern(nu=2.5), "random_state": 0}
+
+        gp_state = GaussianProcessState(refit_interval=5, likelihood_drift=np.inf)
+        gp = get_fitted_gaussian_processor(X_train[:5], y_train[:5], None, standardize_y=False,
+                                           gp_state=gp_state, **gp_params)
+        for n in [6, 8]:
+            # left by predict(return_std=True) of scikit-learn before 0.23
+            gp._K_inv = np.eye(n - 1)
+            gp = gp_state.fit(gp, X_train[:n], y_train[:n])
+            self.assertIsNone(gp._K_inv)
+            gp_ref = get_fitted_gaussian_processor(X_train[:n], y_train[:n], None, standardize_y=False,
+                                                   **dict(gp_params, kernel=gp_state.kernel_, optimizer=None))
+            x = np.random.rand(20, n_dimension)
+            np.testing.assert_allclose(gp.predict(x, return_std=True)[1], gp_ref.predict(x, return_std=True)[1],
+                                       atol=1e-6)
+        self.assertEqual(gp_state.num_updates, 2)
+
+    def testSharedKernelFit(self):
+        """ Check the shared-kernel fit of objective and constraint against separate fits with the same kernel
+        """
+        # Preparing dummy data
+        n_dimension, n_sample = 5, 6
+        X_train, y_train, c_train = np.random.rand(
+            n_sample, n_dimension), np.random.rand(n_sample), np.random.rand(n_sample)
+        gp_params = {"alpha": 1e-10, "n_restarts_optimizer": 5, "kernel": Matern(nu=2.5), "random_state": 0}
+
+        gp_objective, gp_constraint = get_fitted_shared_gaussian_processors(
+            X_train, y_train, c_train, .5, **gp_params)
+        self.assertIs(gp_objective.L_, gp_constraint.L_)
+
+        # Reference fits with the same hyperparameters
+        ref_params = dict(gp_params, kernel=gp_objective.kernel_, optimizer=None)
+        gp_objective_ref = get_fitted_gaussian_processor(X_train, y_train, .5, **ref_params)
+        gp_constraint_ref = get_fitted_gaussian_processor(X_train, c_train, .5, **ref_params)
+        self.assertAlmostEqual(gp_constraint.constraint_upper, gp_constraint_ref.constraint_upper)
+
+        x = np.random.rand(100, n_dimension)
+        for gp_impl, gp_ref in [(gp_objective, gp_objective_ref), (gp_constraint, gp_constraint_ref)]:
+            mu_ref, std_ref = gp_ref.predict(x, return_std=True)
+            mu_impl, std_impl = gp_impl.predict(x, return_std=True)
+            np.testing.assert_allclose(mu_impl, mu_ref, atol=1e-8, err_msg="mu(x) comparison failed")
+            np.testing.assert_allclose(std_impl, std_ref, atol=1e-8, err_msg="std(x) comparison failed")
+
+        util = UtilityFunction(kind='cei', gp_objective=gp_objective, gp_constraint=gp_constraint,
+                               constraint_upper=gp_constraint.constraint_upper)
+        util_ref = UtilityFunction(kind='cei', gp_objective=gp_objective_ref, gp_constraint=gp_constraint_ref,
+                                   constraint_upper=gp_constraint_ref.constraint_upper)
+        np.testing.assert_allclose(util.utility(x), util_ref.utility(x), atol=1e-8,
+                                   err_msg="cei(x) comparison failed")
+        ys, dys = util.utility_and_gradient(x)
+        ys_ref, dys_ref = util_ref.utility_and_gradient(x)
+        np.testing.assert_allclose(dys, dys_ref, atol=1e-8, err_msg="gradient of cei(x) comparison failed")
+
     def testReferenceImplementation(self):
         """ Check for numeric correctness against reference implementation
         """
@@ -358,7 +529,257 @@ class PredictionTest(TestCase):
             logger.debug('Client connection closed')
 
 
+class SessionEvictionTest(TestCase):
+    def testSessionEviction(self):
+        """ Done, idle and least recently used sessions are evicted unless they have work in progress
+        """
+        pool = BOP(max_sessions=2, idle_timeout=60)
+        for session_id in ['first', 'second', 'third']:
+            pool.get_session(session_id, rehydrate=False)
+        self.assertEqual(list(pool.session_map), ['second', 'third'])
+
+        pool.session_map['second'].done = True
+        pool.get_session('third', rehydrate=False)
+        self.assertEqual(list(pool.session_map), ['third'])
+
+        pool.last_access['third'] -= 120
+        pool.get_session('fourth', rehydrate=False)
+        self.assertEqual(list(pool.session_map), ['fourth'])
+
+        stats = pool.get_stats()
+        self.assertEqual(stats['liveSessions'], 1)
+        self.assertEqual(stats['evictedSessions'], 3)
+        self.assertGreater(stats['bytesHeld'], 0)
+
+
+class SessionStoreTest(TestCase):
+    def testLocalSessionStore(self):
+        """ Session state saved by one process can be loaded by another, with a new version per save
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = str(Path(tmpdir) / 'sessions.sqlite')
+            state = {'appName': 'redis', 'samples': [], 'availableNodetypes': ['c4.large', 'm4.large'],
+                     'optimalPoc': None, 'done': False, 'job': None}
+            self.assertEqual(LocalSessionStore(path).load('session'), (None, None))
+
+            version = LocalSessionStore(path).save('session', state)
+            self.assertEqual(LocalSessionStore(path).load('session'), (state, version))
+            self.assertNotEqual(LocalSessionStore(path).save('session', state), version)
+
+    def testJobStatusFromStore(self):
+        """ A session served by another process reports the status of the jobs saved in the store
+        """
+        state = {'appName': 'redis', 'samples': [], 'availableNodetypes': ['c4.large', 'm4.large'],
+                 'optimalPoc': None, 'done': False,
+                 'job': {'status': Status.RUNNING, 'owner': 'otherhost:1', 'submittedAt': time()}}
+        session = SizingSession.from_state('session', state, 'v1')
+        self.assertEqual(session.available_nodetype_set, {'c4.large', 'm4.large'})
+        self.assertEqual(session.get_status().status, Status.RUNNING)
+
+        state['job']['submittedAt'] -= 1e6
+        self.assertEqual(SizingSession.from_state('session', state, 'v2').get_status().status, Status.SERVER_ERROR)
+
+        state['job'] = {'status': Status.DONE, 'data': ['c4.large'], 'error': None}
+        status = SizingSession.from_state('session', state, 'v3').get_status()
+        self.assertEqual((status.status, status.data), (Status.DONE, ['c4.large']))
+
+    def testRunningJobsAreNotSubmittedAgain(self):
+        """ A session rehydrated while another process runs its jobs turns away new candidate requests
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = LocalSessionStore(str(Path(tmpdir) / 'sessions.sqlite'))
+            state = {'appName': 'redis', 'samples': [], 'availableNodetypes': ['c4.large', 'm4.large'],
+                     'optimalPoc': None, 'done': False,
+                     'job': {'status': Status.RUNNING, 'owner': 'otherhost:1', 'submittedAt': time()}}
+            store.save('session', state)
+            with patch('sizing_service.bayesian_optimizer_pool.get_session_store', return_value=store), \
+                    patch('sizing_service.sizing_session.get_session_store', return_value=store):
+                pool = BOP()
+                request_body = {'appName': 'redis', 'data': [{'instanceType': 'c4.large', 'qosValue': 1.}]}
+                status = pool.get_candidates('session', request_body)
+                self.assertEqual(status.status, Status.BAD_REQUEST)
+                self.assertFalse(pool.session_map['session'].has_work_in_progress())
+
+    def testVersionCheckInterval(self):
+        """ The session store is checked for changes at most once per interval, except before submitting jobs
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = LocalSessionStore(str(Path(tmpdir) / 'sessions.sqlite'))
+            state = {'appName': 'redis', 'samples': [], 'availableNodetypes': ['c4.large', 'm4.large'],
+                     'optimalPoc': None, 'done': False, 'job': None}
+            store.save('session', state)
+            with patch('sizing_service.bayesian_optimizer_pool.get_session_store', return_value=store), \
+                    patch('sizing_service.sizing_session.get_session_store', return_value=store):
+                pool = BOP(version_check_interval=60)
+                session = pool.get_session('session')
+                store.save('session', dict(state, availableNodetypes=['c4.large']))
+                self.assertIs(pool.get_session('session'), session)
+
+                rehydrated = pool.get_session('session', check_version=True)
+                self.assertIsNot(rehydrated, session)
+                self.assertEqual(rehydrated.available_nodetype_set, {'c4.large'})
+                self.assertIs(pool.session_map['session'], rehydrated)
+
+    def testRehydratedSessionOnNewCatalogIsKept(self):
+        """ A session rehydrated on another catalog snapshot replaces the cached one, without its
+            gaussian process states
+        """
+        def catalog(version=None, region='us-east-1'):
+            nodetype = {'cpuConfig': {'vCPU': 2, 'clockSpeed': {'value': 2.3}}, 'memoryConfig': {'size': {'value': 4.}},
+                        'networkConfig': {'performance': 'Low'}, 'instanceFamily': 'c4'}
+            return NodetypeCatalog({'c4.large': nodetype, 'm4.large': nodetype}, version='v1')
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = LocalSessionStore(str(Path(tmpdir) / 'sessions.sqlite'))
+            state = {'appName': 'redis', 'samples': [], 'availableNodetypes': ['c4.large', 'm4.large'],
+                     'optimalPoc': None, 'done': False, 'job': None, 'catalogVersion': 'v1'}
+            store.save('session', state)
+            with patch('sizing_service.bayesian_optimizer_pool.get_session_store', return_value=store), \
+                    patch('sizing_service.sizing_session.get_session_store', return_value=store), \
+                    patch('sizing_service.sizing_session.get_nodetype_catalog', side_effect=catalog):
+                pool = BOP()
+                session = pool.get_session('session')
+                session.gp_states = {'perf_over_cost': {}}
+                store.save('session', dict(state, availableNodetypes=['c4.large']))
+
+                rehydrated = pool.get_session('session', check_version=True)
+                self.assertIsNot(rehydrated, session)
+                self.assertIs(pool.session_map['session'], rehydrated)
+                self.assertEqual(rehydrated.gp_states, {})
+                self.assertIs(pool.get_session('session'), rehydrated)
+
+
+def finish_time_after(seconds):
+    sleep(seconds)
+    return time()
+
+
+def exit_worker():
+    os._exit(1)
+
+
+class SessionWorkerPoolTest(TestCase):
+    def testFairQueuing(self):
+        """ A job of a session submitted later runs before the backlog of a busy session
+        """
+        shared_pool = SharedWorkerPool(workers=1, max_active_sessions=2, idle_timeout=60, warm_up_modules=())
+        busy_pool, other_pool = SessionWorkerPool('busy', 1, shared_pool), SessionWorkerPool('other', 1, shared_pool)
+
+        busy_pool.submit_funcs([FuncArgs(finish_time_after, .2) for _ in range(3)])
+        other_pool.submit_funcs([FuncArgs(finish_time_after, .2)])
+        while busy_pool.get_status().status != Status.DONE or other_pool.get_status().status != Status.DONE:
+            sleep(.1)
+        busy_times, other_times = busy_pool.get_status().data, other_pool.get_status().data
+        self.assertLess(other_times[0], busy_times[1])
+        shared_pool.shutdown()
+
+    def testAdmissionLimitAndIdleShutdown(self):
+        """ Sessions beyond the admission limit are turned away, and idle workers are shut down
+        """
+        shared_pool = SharedWorkerPool(workers=2, max_active_sessions=1, idle_timeout=.5, warm_up_modules=())
+        first_pool, second_pool = SessionWorkerPool('first', 1, shared_pool), SessionWorkerPool('second', 1, shared_pool)
+
+        self.assertEqual(first_pool.submit_funcs([FuncArgs(finish_time_after, .2)]).status, Status.SUBMITTED)
+        self.assertEqual(second_pool.submit_funcs([FuncArgs(finish_time_after, 0)]).status, Status.BAD_REQUEST)
+        while first_pool.get_status().status != Status.DONE:
+            sleep(.1)
+        self.assertEqual(second_pool.submit_funcs([FuncArgs(finish_time_after, 0)]).status, Status.SUBMITTED)
+        while second_pool.get_status().status != Status.DONE:
+            sleep(.1)
+
+        sleep(1)
+        self.assertEqual(shared_pool.active_sessions(), set())
+        self.assertIsNone(shared_pool._executor)
+
+    def testBrokenPoolIsReplaced(self):
+        """ A dead worker process breaks its pool only: the next jobs run on a new one, which late
+            failures of the jobs of the broken pool leave alone
+        """
+        shared_pool = SharedWorkerPool(workers=1, max_active_sessions=1, idle_timeout=60, warm_up_modules=())
+        session_pool = SessionWorkerPool('session', 1, shared_pool)
+
+        session_pool.submit_funcs([FuncArgs(exit_worker)])
+        while session_pool.has_work_in_progress():
+            sleep(.1)
+        self.assertIsInstance(session_pool.future_list[0].exception(), BrokenProcessPool)
+        session_pool.clear()
+        self.assertEqual(session_pool.submit_funcs([FuncArgs(finish_time_after, 0)]).status, Status.SUBMITTED)
+        while session_pool.get_status().status != Status.DONE:
+            sleep(.1)
+
+        # a job of a previous pool failing after the pool was replaced
+        executor = shared_pool._executor
+        broken_future = Future()
+        broken_future.set_exception(BrokenProcessPool())
+        future = Future()
+        future.set_running_or_notify_cancel()
+        with shared_pool._lock:
+            shared_pool._running['session'] = 1
+            shared_pool._limits['session'] = 1
+        shared_pool._on_done('session', future, object(), broken_future)
+        self.assertIsInstance(future.exception(), BrokenProcessPool)
+        self.assertIs(shared_pool._executor, executor)
+        self.assertGreater(executor.submit(finish_time_after, 0).result(timeout=10), 0)
+        shared_pool.shutdown()
+
+
 class UtilTest(TestCase):
+    def testNodetypeCatalogNearest(self):
+        """ Masked nearest-neighbour queries of the catalog match sorting all available nodetypes by distance
+        """
+        nodetype_map = {f'nodetype{i}': {'cpuConfig': {'vCPU': 2 ** (i % 7), 'clockSpeed': {'value': 2.3 + i % 3}},
+                                         'memoryConfig': {'size': {'value': 4. * (i % 11 + 1)}},
+                                         'networkConfig': {'performance': 'High' if i % 2 else 'Low'}}
+                        for i in range(200)}
+        catalog = NodetypeCatalog(nodetype_map)
+        available_nodetypes = [f'nodetype{i}' for i in range(0, 200, 3)]
+        for x in np.random.rand(10, 5):
+            candidate_rank = sorted((float(np.linalg.norm(catalog.encode(n) - x)), n) for n in available_nodetypes)
+            np.testing.assert_allclose([d for d, _ in catalog.nearest(x, available_nodetypes)],
+                                       [d for d, _ in candidate_rank])
+            self.assertEqual(catalog.nearest(x, available_nodetypes, k=3), catalog.nearest(x, available_nodetypes)[:3])
+
+    def testNodetypeCatalogSnapshotIsReadOnly(self):
+        nodetype = {'name': 'nodetype0', 'cpuConfig': {'vCPU': 2, 'clockSpeed': {'value': 2.3}},
+                    'memoryConfig': {'size': {'value': 4.}}, 'networkConfig': {'performance': 'Low'}}
+        catalog = NodetypeCatalog({'nodetype0': nodetype}, version='v1')
+        with self.assertRaises(TypeError):
+            catalog.nodetype_map['nodetype0']['cpuConfig']['vCPU'] = 4
+        with self.assertRaises(ValueError):
+            catalog.encode('nodetype0')[0] = 0.
+        self.assertEqual(catalog.nodetype_map['nodetype0']['cpuConfig']['vCPU'], 2)
+
+    def testSessionPinnedToCatalogSnapshot(self):
+        """ A session keeps the catalog snapshot it started with across refreshes while it holds it,
+            and moves to the current one without the dropped nodetypes and gaussian process states otherwise
+        """
+        def nodetype(vcpu, mem):
+            return {'cpuConfig': {'vCPU': vcpu, 'clockSpeed': {'value': 2.3}}, 'memoryConfig': {'size': {'value': mem}},
+                    'networkConfig': {'performance': 'Low'}, 'instanceFamily': 'm4'}
+        v1_map = {'small': nodetype(2, 4.), 'large': nodetype(8, 32.)}
+        v2_map = {'small': nodetype(2, 4.), 'xlarge': nodetype(16, 64.)}
+        cache = NodetypeCatalogCache(refresh_interval=3600)
+        state = {'appName': 'redis', 'samples': [], 'availableNodetypes': ['small', 'large'],
+                 'optimalPoc': None, 'done': False, 'job': None, 'catalogVersion': 'v1'}
+        with patch('api_service.util.fetch_nodetypes', side_effect=[(v1_map, 'v1'), (v2_map, 'v2')]), \
+                patch('sizing_service.sizing_session.get_nodetype_catalog',
+                      side_effect=lambda region='us-east-1', version=None: cache.get(region, version)):
+            session = SizingSession.from_state('session', state, 'version')
+            encoding = session.catalog.encode('small').copy()
+            cache.refresh('us-east-1')
+
+            session.gp_states = {'perf_over_cost': {}}
+            self.assertEqual(SizingSession.from_state('other', state, 'version').catalog.version, 'v1')
+            np.testing.assert_array_equal(session.catalog.encode('small'), encoding)
+            self.assertEqual(len(session.catalog.nearest(encoding, session.available_nodetype_set)), 2)
+
+            del session
+            gc.collect()
+            session = SizingSession.from_state('session', state, 'version')
+            self.assertEqual(session.catalog.version, 'v2')
+            self.assertEqual(session.available_nodetype_set, {'small'})
+            self.assertEqual(session.gp_states, {})
+
     def testGetBounds(self):
         pass
 
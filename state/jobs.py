@@ -15,3 +15,6 @@ def get_job_states():
 
 def save_job_state(job_name, job_state):
     jobdb[job_collection].update_one({"job_name": job_name}, {"$set": job_state}, True)
+
+def delete_job_state(job_name):
+    jobdb[job_collection].delete_one({"job_name": job_name})
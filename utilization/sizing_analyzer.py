@@ -1,17 +1,26 @@
 import json
 import ast
 import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import datetime
 
-from influxdb import DataFrameClient
+from influxdb import DataFrameClient, InfluxDBClient
+from influxdb.resultset import ResultSet
 
 from api_service.db import resultdb
+from utilization.usage_rollups import RollupStore, UsageHistogram
 from logger import get_logger
 from config import get_config
 
 NANOSECONDS_PER_SECOND = 1000000000
+SIZING_ANALYSES = ["node_cpu", "node_memory", "container_cpu", "container_memory"]
+
+logger = get_logger(__name__, log_level=("UTILIZATION", "LOGLEVEL"))
 
 class Status():
     SUCCESS = "success"
@@ -31,43 +40,109 @@ class JobStatus():
             "data": self.data
         }
 
-def get_daily_timepair(current_date):
+def get_daily_timepair(current_date, days=1):
     today = datetime.datetime.combine(current_date, datetime.datetime.min.time())
-    yesterday = today + datetime.timedelta(days=-1)
-    return yesterday.timestamp() * NANOSECONDS_PER_SECOND, today.timestamp() * NANOSECONDS_PER_SECOND
+    start_day = today + datetime.timedelta(days=-days)
+    return start_day.timestamp() * NANOSECONDS_PER_SECOND, today.timestamp() * NANOSECONDS_PER_SECOND
+
+def get_analysis_timepair(config, current_date):
+    return get_daily_timepair(current_date, int(config.get("UTILIZATION", "ANALYSIS_WINDOW_DAYS")))
 
 def node_cpu_job(config, job_config, current_date):
     analyzer = SizingAnalyzer(config)
-    yesterday, today = get_daily_timepair(current_date)
-    status = analyzer.analyze_node_cpu(yesterday, today)
+    start_time, end_time = get_analysis_timepair(config, current_date)
+    status = analyzer.analyze_node_cpu(start_time, end_time)
     print("Node cpu finished with status: " + str(status.to_dict()))
     return status.error
 
 def node_memory_job(config, job_config, current_date):
     analyzer = SizingAnalyzer(config)
-    yesterday, today = get_daily_timepair(current_date)
-    status = analyzer.analyze_node_memory(yesterday, today)
+    start_time, end_time = get_analysis_timepair(config, current_date)
+    status = analyzer.analyze_node_memory(start_time, end_time)
     print("Node memory finished with status: " + str(status.to_dict()))
     return status.error
 
 def container_cpu_job(config, job_config, current_date):
     analyzer = SizingAnalyzer(config)
-    yesterday, today = get_daily_timepair(current_date)
-    status = analyzer.analyze_container_cpu(yesterday, today)
+    start_time, end_time = get_analysis_timepair(config, current_date)
+    status = analyzer.analyze_container_cpu(start_time, end_time)
     print("Container cpu finished with status: " + str(status.to_dict()))
     return status.error
 
 def container_memory_job(config, job_config, current_date):
     analyzer = SizingAnalyzer(config)
-    yesterday, today = get_daily_timepair(current_date)
-    status = analyzer.analyze_container_memory(yesterday, today)
+    start_time, end_time = get_analysis_timepair(config, current_date)
+    status = analyzer.analyze_container_memory(start_time, end_time)
     print("Container memory finished with status: " + str(status.to_dict()))
     return status.error
 
+def sizing_job(config, job_config, current_date):
+    start_time, end_time = get_analysis_timepair(config, current_date)
+    statuses = run_sizing_analyses(config, start_time, end_time)
+    errors = []
+    for analysis, status in statuses.items():
+        print("Sizing analysis %s finished with status: %s" % (analysis, str(status.to_dict())))
+        if status.error:
+            errors.append("%s: %s" % (analysis, status.error))
+    return "; ".join(errors) or None
+
+def run_sizing_analyses(config, start_time, end_time, analyses=SIZING_ANALYSES):
+    """ Run the sizing analyses in parallel. The settings queries of all of them are planned first,
+        so they are fetched concurrently and only once while the analyses summarize their usage.
+        An analysis failing with an exception gets an error status, without affecting the others.
+    Returns: an ordered dict of the JobStatus of each analysis
+    """
+    statuses = OrderedDict((analysis, None) for analysis in analyses)
+    query_workers = int(config.get("UTILIZATION", "QUERY_WORKERS"))
+    with ThreadPoolExecutor(max_workers=query_workers) as query_pool, \
+            ThreadPoolExecutor(max_workers=len(analyses)) as analysis_pool:
+        query_results = QueryResults(query_pool)
+        analyzers = OrderedDict()
+        for analysis in analyses:
+            try:
+                analyzer = SizingAnalyzer(config, query_results)
+                for query in analyzer.settings_queries(analysis, start_time, end_time).values():
+                    analyzer.fetch_influx_metric(query)
+                analyzers[analysis] = analyzer
+            except Exception as e:
+                logger.exception("Unable to start sizing analysis %s" % analysis)
+                statuses[analysis] = JobStatus(status=Status.DB_ERROR, error=str(e))
+
+        futures = OrderedDict((analysis, analysis_pool.submit(
+            getattr(analyzer, "analyze_" + analysis), start_time, end_time))
+            for analysis, analyzer in analyzers.items())
+        for analysis, future in futures.items():
+            try:
+                statuses[analysis] = future.result()
+            except Exception as e:
+                logger.exception("Sizing analysis %s failed" % analysis)
+                statuses[analysis] = JobStatus(status=Status.DB_ERROR, error=str(e))
+        return statuses
+
+
+class QueryResults(object):
+    """ Results of the influxDB queries prefetched for the analyses of a sizing run: each query is
+        fetched only once, concurrently with the others on the executor, and read from its future.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def fetch(self, query, read):
+        """ Returns: the future of the result of query, submitting read to the executor if it's the first fetch
+        """
+        with self.lock:
+            if query not in self.futures:
+                self.futures[query] = self.executor.submit(read)
+            return self.futures[query]
+
 
 class SizingAnalyzer(object):
-    def __init__(self, config):
+    def __init__(self, config, query_results=None):
         self.config = config
+        self.query_results = query_results
         self.logger = get_logger(__name__, log_level=("UTILIZATION", "LOGLEVEL"))
 
         self.percentiles = ast.literal_eval(config.get("UTILIZATION", "PERCENTILES"))
@@ -82,6 +157,15 @@ class SizingAnalyzer(object):
         output_db = config.get("INFLUXDB", "SIZING_OUTPUT_DB_NAME")
         self.resultdb = resultdb
         self.results_collection = config.get("UTILIZATION", "SIZING_RESULTS_COLLECTION")
+        self.relative_accuracy = float(config.get("UTILIZATION", "HISTOGRAM_RELATIVE_ACCURACY"))
+        self.max_bins = int(config.get("UTILIZATION", "HISTOGRAM_MAX_BINS"))
+        self.ingest_chunk = int(config.get("UTILIZATION", "INGEST_CHUNK_SECOND")) * NANOSECONDS_PER_SECOND
+        self.query_chunk_size = int(config.get("UTILIZATION", "QUERY_CHUNK_SIZE"))
+        self.rollup_store = RollupStore(
+            resultdb, config.get("UTILIZATION", "SIZING_ROLLUPS_COLLECTION"), self.relative_accuracy,
+            int(config.get("UTILIZATION", "ROLLUP_PERIOD_SECOND")) * NANOSECONDS_PER_SECOND,
+            int(config.get("UTILIZATION", "ROLLUP_RETENTION_DAYS")) * 86400, self.max_bins)
+        self.rollup_delay = int(config.get("UTILIZATION", "ROLLUP_DELAY_SECOND")) * NANOSECONDS_PER_SECOND
 
         self.influx_client_input = DataFrameClient(
             influx_host,
@@ -108,46 +192,19 @@ class SizingAnalyzer(object):
             self.scaling_factor = scaling_factor
 
         self.base_metric = 'usage'
-
-        self.logger.info("-- [node_cpu] Query influxdb for raw metrics data --")
-        output_filter = "derivative(sum(value), 1s) as usage"
-        time_filter = "time > %d AND time <= %d" % (start_time, end_time)
-        tags_filter = "AND mode=~ /(user|system)/"
         group_tags = self.config.get("UTILIZATION", "NODE_GROUP_TAGS")
-        group_by_tags = group_tags + ",time(1ms)"
+        settings_queries = self.settings_queries("node_cpu", start_time, end_time)
 
-        metric_name = "node_cpu"
+        self.logger.info("-- [node_cpu] Compute summary stats --")
         try:
-            node_cpu_usage_dict = self.query_influx_metric(
-                metric_name, output_filter, time_filter, tags_filter, group_by_tags)
+            node_cpu_summary, cluster_summary = self.summarize_usage("node_cpu", start_time, end_time, self.ingest_node_cpu)
         except Exception as e:
             return JobStatus(status=Status.DB_ERROR, error=str(e))
-
-        self.logger.info("-- [node_cpu] Compute summary stats --")
-        node_cpu_summary = pd.DataFrame()
-        new_metric = "node_cpu_usage"
-        for k, df in node_cpu_usage_dict.items():
-            group_key = dict((x, y) for x, y in k[1])
-            #df.drop(df.index[(df.usage > MAX_CORES) | (df.usage < 0)], inplace=True)
-            try:
-                self.influx_client_output.write_points(df, new_metric, group_key)
-            except Exception as e:
-                return JobStatus(status=Status.DB_ERROR,
-                                 error="Unable to write query result for %s to influxDB: %s" %
-                                 (new_metric, str(e)))
-            node_key = "instance="+group_key['instance']
-            node_cpu_summary[node_key, self.base_metric] = df.usage.describe(
-                self.percentiles).drop(['count','std', 'min'])
-
-        node_cpu_summary.rename(
-            index={'50%': "median", '95%': "p95", '99%': "p99"}, inplace=True)
         self.logger.debug("Computed node cpu usage summary:\n %s" % node_cpu_summary.to_json())
 
         self.logger.info("-- [node_cpu] Query influxdb for current node configs --")
-        metric_name = "machine_cpu_cores"
         try:
-            node_cpu_size_dict = self.query_influx_metric(
-                metric_name, "value", time_filter, "", group_tags)
+            node_cpu_size_dict = self.read_influx_metric(*settings_queries["machine_cpu_cores"])
         except Exception as e:
             return JobStatus(status=Status.DB_ERROR, error=str(e))
         current_cpu_sizes = self.get_node_sizes(node_cpu_size_dict, "node_cpu_size")
@@ -168,7 +225,8 @@ class SizingAnalyzer(object):
                 "end_time": end_time,
                 "labels": group_tags.split(","),
                 "config": {},
-                "results": results
+                "results": results,
+                "cluster_summary_stats": self.construct_cluster_summary("cpu", cluster_summary)
         }
         try:
             self.store_analysis_results(sizing_result_doc)
@@ -178,6 +236,24 @@ class SizingAnalyzer(object):
         return JobStatus(status=Status.SUCCESS,
                          data=sizing_result_doc)
 
+    def ingest_node_cpu(self, start_time, end_time):
+        self.logger.info("-- [node_cpu] Query influxdb for raw metrics data --")
+        output_filter = "derivative(sum(value), 1s) as usage"
+        time_filter = "time > %d AND time <= %d" % (start_time, end_time)
+        tags_filter = "AND mode=~ /(user|system)/"
+        group_by_tags = self.config.get("UTILIZATION", "NODE_GROUP_TAGS") + ",time(1ms)"
+
+        histograms = {}
+        for k, df in self.query_influx_metric(
+                "node_cpu", output_filter, time_filter, tags_filter, group_by_tags):
+            group_key = dict((x, y) for x, y in k[1])
+            #df.drop(df.index[(df.usage > MAX_CORES) | (df.usage < 0)], inplace=True)
+            self.write_output_points(df, "node_cpu_usage", group_key)
+            node_key = "instance=" + group_key['instance']
+            self.add_usage(histograms, node_key, 'usage', df.usage)
+
+        return histograms
+
 
     def analyze_node_memory(self, start_time, end_time, stat_type=None, scaling_factor=None, base_metric=None):
         if stat_type is not None:
@@ -191,75 +267,19 @@ class SizingAnalyzer(object):
         else:
             self.base_metric = self.config.get("UTILIZATION", "MEMORY_BASE_METRIC")
 
-        self.logger.info("-- [node_memory] Query influxdb for raw metrics data --")
-        output_filter = "value/1024/1024/1024"
-        time_filter = "time > %d AND time <= %d" % (start_time, end_time)
         group_tags = self.config.get("UTILIZATION", "NODE_GROUP_TAGS")
+        settings_queries = self.settings_queries("node_memory", start_time, end_time)
 
-        metric_name_active = "node_memory_Active"
-        try:
-            node_mem_active_dict = self.query_influx_metric(
-                metric_name_active, output_filter, time_filter, "", group_tags)
-        except Exception as e:
-            return JobStatus(status=Status.DB_ERROR, error=str(e))
-
-        metric_name_total = "node_memory_MemTotal"
-        try:
-            node_mem_total_dict = self.query_influx_metric(
-                metric_name_total, output_filter, time_filter, "", group_tags)
-        except Exception as e:
-            return JobStatus(status=Status.DB_ERROR, error=str(e))
-
-        metric_name_free = "node_memory_MemFree"
+        self.logger.info("-- [node_memory] Compute summary stats --")
         try:
-            node_mem_free_dict = self.query_influx_metric(
-                metric_name_free, output_filter, time_filter, "", group_tags)
+            node_mem_summary, cluster_summary = self.summarize_usage("node_memory", start_time, end_time, self.ingest_node_memory)
         except Exception as e:
             return JobStatus(status=Status.DB_ERROR, error=str(e))
-
-        self.logger.info("-- [node_memory] Compute summary stats --")
-        node_mem_summary = pd.DataFrame()
-        new_metric = "node_memory_active"
-        for k, df_active in node_mem_active_dict.items():
-            group_key = dict((x, y) for x, y in k[1])
-            try:
-                self.influx_client_output.write_points(
-                    df_active, new_metric, group_key)
-            except Exception as e:
-                return JobStatus(status=Status.DB_ERROR,
-                                 error="Unable to write query result for %s to influxDB: %s" %
-                                 (new_metric, str(e)))
-            node_key = "instance=" + group_key['instance']
-            node_mem_summary[node_key, 'active'] = df_active.value.describe(
-                self.percentiles).drop(['count','std', 'min'])
-
-        new_metric = "node_memory_usage"
-        for k in node_mem_total_dict.keys():
-            group_key = dict((x, y) for x, y in k[1])
-            df_total = node_mem_total_dict[k]
-            k_free = (metric_name_free, k[1])
-            df_free = node_mem_free_dict[k_free]
-
-            df_usage = df_total - df_free
-            try:
-                self.influx_client_output.write_points(
-                    df_usage, new_metric, group_key)
-            except Exception as e:
-                return JobStatus(status=Ststus.DB_ERROR,
-                                 error="Unable to write query result for %s to influxDB: %s" %
-                                 (new_metric, str(e)))
-            node_key = "instance=" + group_key['instance']
-            node_mem_summary[node_key, 'usage'] = df_usage.value.describe(
-                self.percentiles).drop(['count','std', 'min'])
-
-        node_mem_summary.rename(
-            index={'50%': "median", '95%': "p95", '99%': "p99"}, inplace=True)
         self.logger.debug("Computed node memory usage summary:\n %s" % node_mem_summary.to_json())
 
         self.logger.info("-- [node_memory] Query influxdb for current node configs --")
         try:
-            node_mem_size_dict = self.query_influx_metric(
-                "machine_memory_bytes", output_filter, time_filter, "", group_tags)
+            node_mem_size_dict = self.read_influx_metric(*settings_queries["machine_memory_bytes"])
         except Exception as e:
             return JobStatus(status=Status.DB_ERROR, error=str(e))
         current_mem_sizes = self.get_node_sizes(node_mem_size_dict, "node_memory_size")
@@ -280,7 +300,8 @@ class SizingAnalyzer(object):
                 "end_time": end_time,
                 "labels": group_tags.split(","),
                 "config": {},
-                "results": results
+                "results": results,
+                "cluster_summary_stats": self.construct_cluster_summary("memory", cluster_summary)
         }
 
         try:
@@ -291,6 +312,37 @@ class SizingAnalyzer(object):
         return JobStatus(status=Status.SUCCESS,
                          data=sizing_result_doc)
 
+    def ingest_node_memory(self, start_time, end_time):
+        self.logger.info("-- [node_memory] Query influxdb for raw metrics data --")
+        output_filter = "value/1024/1024/1024"
+        time_filter = "time > %d AND time <= %d" % (start_time, end_time)
+        group_tags = self.config.get("UTILIZATION", "NODE_GROUP_TAGS")
+
+        histograms = {}
+        for k, df_active in self.query_influx_metric(
+                "node_memory_Active", output_filter, time_filter, "", group_tags):
+            group_key = dict((x, y) for x, y in k[1])
+            self.write_output_points(df_active, "node_memory_active", group_key)
+            node_key = "instance=" + group_key['instance']
+            self.add_usage(histograms, node_key, 'active', df_active.value)
+
+        # the free memory is matched with the total memory of each node as it is read
+        metric_name_free = "node_memory_MemFree"
+        node_mem_free_dict = dict(self.query_influx_metric(
+            metric_name_free, output_filter, time_filter, "", group_tags))
+        for k, df_total in self.query_influx_metric(
+                "node_memory_MemTotal", output_filter, time_filter, "", group_tags):
+            group_key = dict((x, y) for x, y in k[1])
+            k_free = (metric_name_free, k[1])
+            df_free = node_mem_free_dict[k_free]
+
+            df_usage = df_total - df_free
+            self.write_output_points(df_usage, "node_memory_usage", group_key)
+            node_key = "instance=" + group_key['instance']
+            self.add_usage(histograms, node_key, 'usage', df_usage.value)
+
+        return histograms
+
 
     def analyze_container_cpu(self, start_time, end_time, stat_type=None, scaling_factor=None):
         if stat_type is not None:
@@ -300,75 +352,25 @@ class SizingAnalyzer(object):
             self.scaling_factor = scaling_factor
 
         self.base_metric = 'usage'
-
-        self.logger.info("-- [container_cpu] Query influxdb for raw metrics data --")
-        output_filter = "derivative(sum(value), 1s) as usage"
-        time_filter = "time > %d AND time <= %d" % (start_time, end_time)
-        tags_filter = "AND image!=''"
         group_tags = self.config.get("UTILIZATION", "CONTAINER_GROUP_TAGS")
-        group_by_tags = group_tags + ",pod_name,time(1ms)"
+        settings_queries = self.settings_queries("container_cpu", start_time, end_time)
 
-        metric_name_usr = "container_cpu_user_seconds_total"
-        try:
-            container_cpu_user_dict = self.query_influx_metric(
-                metric_name_usr, output_filter, time_filter, tags_filter, group_by_tags)
-        except Exception as e:
-            return JobStatus(status=Status.DB_ERROR, error=str(e))
-
-        metric_name_sys = "container_cpu_system_seconds_total"
+        self.logger.info("-- [container_cpu] Compute summary stats --")
         try:
-            container_cpu_sys_dict = self.query_influx_metric(
-                metric_name_sys, output_filter, time_filter, tags_filter, group_by_tags)
+            container_cpu_summary, cluster_summary = self.summarize_usage(
+                "container_cpu", start_time, end_time, self.ingest_container_cpu)
         except Exception as e:
             return JobStatus(status=Status.DB_ERROR, error=str(e))
-
-        self.logger.info("-- [container_cpu] Compute summary stats --")
-        df_usage = pd.DataFrame()
-        container_cpu_usage_dict = {}
-        for k_user, df_user in container_cpu_user_dict.items():
-            group_key = k_user[1]
-            df_sys = container_cpu_sys_dict[(metric_name_sys, group_key)]
-            df_usage = (df_user + df_sys).astype('float32')
-
-            if group_key not in container_cpu_usage_dict.keys():
-                container_cpu_usage_dict[group_key] = df_usage
-            else:
-                df_comb = pd.merge_asof(container_cpu_usage_dict[group_key], df_usage,
-                                        left_index=True, right_index=True,
-                                        suffixes=('_1', '_2'), direction='nearest')
-                container_cpu_usage_dict[group_key].usage = df_comb[['usage_1', 'usage_2']].max(axis=1)
-
-        container_cpu_summary = pd.DataFrame()
-        output_metric = "container_cpu_usage"
-        for k, df_usage in container_cpu_usage_dict.items():
-            group_key = dict((x, y) for x, y in k)
-            df_usage = df_usage.dropna()
-            try:
-                self.influx_client_output.write_points(df_usage, output_metric, group_key)
-            except Exception as e:
-                return JobStatus(status=Status.DB_ERROR,
-                                 error="Unable to write query result for %s to influxDB: %s" %
-                                 (output_metric, str(e)))
-            image_key = "image=" + group_key['image']
-            container_cpu_summary[image_key, self.base_metric] = df_usage.usage.describe(
-                self.percentiles).drop(['count','std', 'min'])
-
-        container_cpu_summary.rename(
-            index={'50%': "median", '95%': "p95", '99%': "p99"}, inplace=True)
         self.logger.debug("Computed container cpu usage summary:\n %s" % container_cpu_summary.to_json())
 
         self.logger.info("-- [container_cpu] Query influxdb for current requests and limits --")
-        output_filter = "sum(value) as value"
-        group_by_tags = group_tags + ",pod_name,time(5s)"
         try:
-            cpu_quota_dict = self.query_influx_metric(
-                "container_spec_cpu_quota", output_filter, time_filter, tags_filter, group_by_tags)
+            cpu_quota_dict = self.read_influx_metric(*settings_queries["container_spec_cpu_quota"])
         except Exception as e:
             return JobStatus(status=Status.DB_ERROR, error=str(e))
 
         try:
-            cpu_period_dict = self.query_influx_metric(
-                "container_spec_cpu_period", output_filter, time_filter, tags_filter, group_by_tags)
+            cpu_period_dict = self.read_influx_metric(*settings_queries["container_spec_cpu_period"])
         except Exception as e:
             return JobStatus(status=Status.DB_ERROR, error=str(e))
 
@@ -397,7 +399,8 @@ class SizingAnalyzer(object):
                 "end_time": end_time,
                 "labels": group_tags.split(","),
                 "config": {},
-                "results": results
+                "results": results,
+                "cluster_summary_stats": self.construct_cluster_summary("cpu", cluster_summary)
         }
 
         try:
@@ -408,6 +411,43 @@ class SizingAnalyzer(object):
         return JobStatus(status=Status.SUCCESS,
                          data=sizing_result_doc)
 
+    def ingest_container_cpu(self, start_time, end_time):
+        self.logger.info("-- [container_cpu] Query influxdb for raw metrics data --")
+        output_filter = "derivative(sum(value), 1s) as usage"
+        time_filter = "time > %d AND time <= %d" % (start_time, end_time)
+        tags_filter = "AND image!=''"
+        group_by_tags = self.config.get("UTILIZATION", "CONTAINER_GROUP_TAGS") + ",pod_name,time(1ms)"
+
+        metric_name_sys = "container_cpu_system_seconds_total"
+        container_cpu_sys_dict = dict(self.query_influx_metric(
+            metric_name_sys, output_filter, time_filter, tags_filter, group_by_tags))
+
+        container_cpu_usage_dict = {}
+        for k_user, df_user in self.query_influx_metric(
+                "container_cpu_user_seconds_total", output_filter, time_filter, tags_filter, group_by_tags):
+            group_key = k_user[1]
+            df_sys = container_cpu_sys_dict[(metric_name_sys, group_key)]
+            df_usage = (df_user + df_sys).astype('float32')
+
+            if group_key not in container_cpu_usage_dict.keys():
+                container_cpu_usage_dict[group_key] = df_usage
+            else:
+                df_comb = pd.merge_asof(container_cpu_usage_dict[group_key], df_usage,
+                                        left_index=True, right_index=True,
+                                        suffixes=('_1', '_2'), direction='nearest')
+                container_cpu_usage_dict[group_key].usage = df_comb[['usage_1', 'usage_2']].max(axis=1)
+
+        histograms = {}
+        for k, df_usage in container_cpu_usage_dict.items():
+            group_key = dict((x, y) for x, y in k)
+            df_usage = df_usage.dropna()
+            self.write_output_points(df_usage, "container_cpu_usage", group_key)
+            # the usage of all the pods of an image is summarized together
+            image_key = "image=" + group_key['image']
+            self.add_usage(histograms, image_key, 'usage', df_usage.usage)
+
+        return histograms
+
 
     def analyze_container_memory(self, start_time, end_time, stat_type=None, scaling_factor=None, base_metric=None):
         if stat_type is not None:
@@ -421,66 +461,21 @@ class SizingAnalyzer(object):
         else:
             self.base_metric = self.config.get("UTILIZATION", "MEMORY_BASE_METRIC")
 
-        self.logger.info("-- [container_memory] Query influxdb for raw metrics data --")
-        output_filter = "max(value)/1024/1024 as value"
-        time_filter = "time > %d AND time <= %d" % (start_time, end_time)
-        tags_filter = "AND image!=''"
         group_tags = self.config.get("UTILIZATION", "CONTAINER_GROUP_TAGS")
-        group_by_tags = group_tags + ",time(5s)"
-
-        metric_name = "container_memory_working_set_bytes"
-        try:
-            container_mem_active_dict = self.query_influx_metric(
-                metric_name, output_filter, time_filter, tags_filter, group_by_tags)
-        except Exception as e:
-            return JobStatus(status=Status.DB_ERROR, error=str(e))
+        settings_queries = self.settings_queries("container_memory", start_time, end_time)
 
-        metric_name = "container_memory_usage_bytes"
+        self.logger.info("-- [container_memory] Compute summary stats --")
         try:
-            container_mem_usage_dict = self.query_influx_metric(
-                metric_name, output_filter, time_filter, tags_filter, group_by_tags)
+            container_mem_summary, cluster_summary = self.summarize_usage(
+                "container_memory", start_time, end_time, self.ingest_container_memory)
         except Exception as e:
             return JobStatus(status=Status.DB_ERROR, error=str(e))
-
-        self.logger.info("-- [container_memory] Compute summary stats --")
-        container_mem_summary = pd.DataFrame()
-        output_metric = "container_memory_active"
-        for k, df_active in container_mem_active_dict.items():
-            group_key = dict((x, y) for x, y in k[1])
-            df_active = df_active.dropna()
-            try:
-                self.influx_client_output.write_points(df_active, output_metric, group_key)
-            except Exception as e:
-                return JobStatus(status=Status.DB_ERROR,
-                                 error="Unable to write query result for %s to influxDB: %s" %
-                                 (output_metric, str(e)))
-            image_key = "image=" + group_key['image']
-            container_mem_summary[image_key, 'active'] = df_active.value.describe(
-                self.percentiles).drop(['count','std', 'min'])
-
-        output_metric = "container_memory_usage"
-        for k, df_usage in container_mem_usage_dict.items():
-            group_key = dict((x, y) for x, y in k[1])
-            df_usage = df_usage.dropna()
-            try:
-                self.influx_client_output.write_points(df_usage, output_metric, group_key)
-            except Exception as e:
-                return JobStatus(status=Status.DB_ERROR,
-                                 error="Unable to write query result for %s to influxDB: %s" %
-                                 (output_metric, str(e)))
-            image_key = "image=" + group_key['image']
-            container_mem_summary[image_key, 'usage'] = df_usage.value.describe(
-                self.percentiles).drop(['count','std', 'min'])
-
-        container_mem_summary.rename(
-            index={'50%': "median", '95%': "p95", '99%': "p99"}, inplace=True)
-        self.logger.debug("Computed container memory usage summary:\n %s" % 
+        self.logger.debug("Computed container memory usage summary:\n %s" %
                           container_mem_summary.to_json())
 
         self.logger.info("-- [container_memory] Query influxdb for current requests and limits --")
         try:
-            mem_settings_dict = self.query_influx_metric(
-                "container_spec_memory_limit_bytes", output_filter, time_filter, tags_filter, group_by_tags)
+            mem_settings_dict = self.read_influx_metric(*settings_queries["container_spec_memory_limit_bytes"])
         except Exception as e:
             return JobStatus(status=Status.DB_ERROR, error=str(e))
 
@@ -498,11 +493,6 @@ class SizingAnalyzer(object):
                          recommended_mem_settings)
 
         self.logger.info("-- [container_memory] Store analysis results in mongodb --")
-        this_config = {
-            "stat_type": self.stat_type,
-            "scaling_factor": self.scaling_factor,
-            "base_metric": self.base_metric
-        }
         results = self.construct_analysis_results(
             "memory", container_mem_summary, recommended_mem_settings, current_mem_settings)
         sizing_result_doc = {
@@ -513,7 +503,8 @@ class SizingAnalyzer(object):
                 "end_time": end_time,
                 "labels": group_tags.split(","),
                 "config": {},
-                "results": results
+                "results": results,
+                "cluster_summary_stats": self.construct_cluster_summary("memory", cluster_summary)
         }
         try:
             self.store_analysis_results(sizing_result_doc)
@@ -523,20 +514,173 @@ class SizingAnalyzer(object):
         return JobStatus(status=Status.SUCCESS,
                          data=sizing_result_doc)
 
+    def ingest_container_memory(self, start_time, end_time):
+        self.logger.info("-- [container_memory] Query influxdb for raw metrics data --")
+        output_filter = "max(value)/1024/1024 as value"
+        time_filter = "time > %d AND time <= %d" % (start_time, end_time)
+        tags_filter = "AND image!=''"
+        group_by_tags = self.config.get("UTILIZATION", "CONTAINER_GROUP_TAGS") + ",time(5s)"
+
+        histograms = {}
+        for k, df_active in self.query_influx_metric(
+                "container_memory_working_set_bytes", output_filter, time_filter, tags_filter, group_by_tags):
+            group_key = dict((x, y) for x, y in k[1])
+            df_active = df_active.dropna()
+            self.write_output_points(df_active, "container_memory_active", group_key)
+            image_key = "image=" + group_key['image']
+            self.add_usage(histograms, image_key, 'active', df_active.value)
+
+        for k, df_usage in self.query_influx_metric(
+                "container_memory_usage_bytes", output_filter, time_filter, tags_filter, group_by_tags):
+            group_key = dict((x, y) for x, y in k[1])
+            df_usage = df_usage.dropna()
+            self.write_output_points(df_usage, "container_memory_usage", group_key)
+            image_key = "image=" + group_key['image']
+            self.add_usage(histograms, image_key, 'usage', df_usage.value)
+
+        return histograms
+
+
+    def summarize_usage(self, analysis, start_time, end_time, ingest):
+        """ Summarize the usage of analysis over [start_time, end_time] by merging its stored rollups;
+            the periods of the window without a rollup are ingested from the raw metrics with ingest,
+            one chunk of time at a time, and rolled up once they ended at least self.rollup_delay ago,
+            as the metrics of the latest points may not all be written yet. The rollups are only a cache:
+            if they can't be read or stored, the usage is summarized from the raw metrics all the same.
+        Returns: (a summary dataframe with a (group key, metric type) column per usage histogram,
+                  a cluster summary dataframe with a metric type column merging the histograms of all groups)
+        """
+        histograms = {}
+        now = time.time() * NANOSECONDS_PER_SECOND
+        group_tags = self.config.get(
+            "UTILIZATION", "NODE_GROUP_TAGS" if analysis.startswith("node_") else "CONTAINER_GROUP_TAGS")
+        try:
+            periods = self.rollup_store.plan(analysis, start_time, end_time, group_tags)
+        except Exception as e:
+            self.logger.error("Unable to read %s usage rollups from MongoDB: %s" % (analysis, str(e)))
+            periods = self.rollup_store.split_missing(start_time, end_time, end_time)
+        for period_start, period_end, period_histograms in periods:
+            if period_histograms is None:
+                self.logger.info("Ingesting %s usage from %d to %d" % (analysis, period_start, period_end))
+                period_histograms = {}
+                chunk_start = period_start
+                while chunk_start < period_end:
+                    chunk_end = min(chunk_start + self.ingest_chunk, period_end)
+                    self.merge_histograms(period_histograms, ingest(chunk_start, chunk_end))
+                    chunk_start = chunk_end
+                if period_end <= now - self.rollup_delay:
+                    try:
+                        self.rollup_store.save(analysis, period_start, period_end, period_histograms, group_tags)
+                    except Exception as e:
+                        # the rollup is only a cache of the histograms ingested above
+                        self.logger.error("Unable to store %s usage rollup in MongoDB: %s" % (analysis, str(e)))
+
+            self.merge_histograms(histograms, period_histograms)
+
+        cluster_histograms = {}
+        for (group_key, metric_type), histogram in histograms.items():
+            self.merge_histograms(cluster_histograms, {metric_type: histogram.copy()})
+
+        return self.to_summary(histograms), self.to_summary(cluster_histograms)
+
+    def merge_histograms(self, histograms, new_histograms):
+        for key, histogram in new_histograms.items():
+            if key in histograms:
+                histograms[key].merge(histogram)
+            else:
+                histograms[key] = histogram
+
+    def to_summary(self, histograms):
+        summary = pd.DataFrame()
+        for key, histogram in sorted(histograms.items()):
+            if histogram.count:
+                summary[key] = pd.Series(histogram.summary(self.percentiles))
+        return summary
+
+    def settings_queries(self, analysis, start_time, end_time):
+        """ Plan the queries of the current settings of analysis. Only their latest values are used,
+            so they are queried over the last rollup period of the window.
+        Returns: an ordered dict of the query_influx_metric arguments of each settings metric
+        """
+        time_filter = "time > %d AND time <= %d" % (max(start_time, end_time - self.rollup_store.period), end_time)
+        node_tags = self.config.get("UTILIZATION", "NODE_GROUP_TAGS")
+        container_tags = self.config.get("UTILIZATION", "CONTAINER_GROUP_TAGS")
+        tags_filter = "AND image!=''"
+
+        queries = OrderedDict()
+        if analysis == "node_cpu":
+            queries["machine_cpu_cores"] = ("value", time_filter, "", node_tags)
+        elif analysis == "node_memory":
+            queries["machine_memory_bytes"] = ("value/1024/1024/1024", time_filter, "", node_tags)
+        elif analysis == "container_cpu":
+            for metric_name in ["container_spec_cpu_quota", "container_spec_cpu_period"]:
+                queries[metric_name] = ("sum(value) as value", time_filter, tags_filter,
+                                        container_tags + ",pod_name,time(5s)")
+        elif analysis == "container_memory":
+            queries["container_spec_memory_limit_bytes"] = (
+                "max(value)/1024/1024 as value", time_filter, tags_filter, container_tags + ",time(5s)")
+        else:
+            raise ValueError("Unknown sizing analysis %s" % analysis)
+
+        return OrderedDict((metric_name, (metric_name,) + query) for metric_name, query in queries.items())
+
+    def fetch_influx_metric(self, query):
+        return self.query_results.fetch(query, lambda: dict(self.query_influx_metric(*query)))
+
+    def read_influx_metric(self, *query):
+        """ Read the whole result of a query_influx_metric query as a dict, from its prefetched
+            result if the analyzer has the query results of a sizing run.
+        """
+        if self.query_results is None:
+            return dict(self.query_influx_metric(*query))
+        return self.fetch_influx_metric(query).result()
+
+    def add_usage(self, histograms, group_key, metric_type, values):
+        key = (group_key, metric_type)
+        if key not in histograms:
+            histograms[key] = UsageHistogram(self.relative_accuracy, self.max_bins)
+        histograms[key].add(values.values)
+
+    def write_output_points(self, df, output_name, group_key):
+        try:
+            self.influx_client_output.write_points(df, output_name, group_key)
+        except Exception as e:
+            err_msg = ("Unable to write query result for %s to influxDB: %s" % (output_name, str(e)))
+            self.logger.error(err_msg)
+            raise Exception(err_msg)
 
     def query_influx_metric(self, metric_name, output_filter, time_filter, tags_filter, group_by_tags):
+        """ Lazily read the result of a query of metric_name, with chunked responses of up to
+            query_chunk_size points from influxDB.
+        Returns: a generator of the (series key, dataframe) items of DataFrameClient.query,
+                 yielding the dataframe of each group as soon as all its points have been read
+        """
+        influx_query = "SELECT %s FROM %s WHERE %s %s GROUP BY %s" % \
+                       (output_filter, metric_name, time_filter, tags_filter, group_by_tags)
+        self.logger.debug("Running influxDB read query: %s" % influx_query)
         try:
-            influx_query = "SELECT %s FROM %s WHERE %s %s GROUP BY %s" % \
-                           (output_filter, metric_name, time_filter, tags_filter, group_by_tags)
-            self.logger.debug("Running influxDB read query: %s" % influx_query)
-            metric_dict = self.influx_client_input.query(influx_query)
+            # DataFrameClient can't convert chunked responses, so each chunk is converted on its own
+            result_sets = InfluxDBClient.query(
+                self.influx_client_input, influx_query, chunked=True, chunk_size=self.query_chunk_size)
+            if isinstance(result_sets, ResultSet):
+                # influxdb-python before 5.3 merges all the chunks in a single result set
+                result_sets = [result_sets]
+            key, frames = None, []
+            for result_set in result_sets:
+                for chunk_key, df in self.influx_client_input._to_dataframe(result_set, dropna=True).items():
+                    # the points of a group are consecutive, but may be split over several chunks
+                    if chunk_key != key:
+                        if frames:
+                            yield key, pd.concat(frames)
+                        key, frames = chunk_key, []
+                    frames.append(df)
+            if frames:
+                yield key, pd.concat(frames)
         except Exception as e:
             err_msg = "Unable to fetch %s from influxDB: %s" % (metric_name, str(e))
             self.logger.error(err_msg)
             raise Exception(err_msg)
 
-        return metric_dict
-
     def get_node_sizes(self, node_size_dict, output_name):
         current_sizes = {}
 
@@ -693,6 +837,10 @@ class SizingAnalyzer(object):
 
         return results
 
+    def construct_cluster_summary(self, resource_type, cluster_summary):
+        return {resource_type + "_" + metric_type: cluster_summary[metric_type].to_dict()
+                for metric_type in cluster_summary}
+
     def store_analysis_results(self, sizing_result_doc):
         sizing_result_doc["config"] = {
             "stat_type": self.stat_type,
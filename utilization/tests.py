@@ -0,0 +1,435 @@
+import json
+import re
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+from influxdb import DataFrameClient, InfluxDBClient
+from influxdb.resultset import ResultSet
+
+from config import get_config
+from logger import get_logger
+from utilization.sizing_analyzer import NANOSECONDS_PER_SECOND, SIZING_ANALYSES, JobStatus, SizingAnalyzer, \
+    Status, run_sizing_analyses
+from utilization.usage_rollups import RollupStore, UsageHistogram
+
+config = get_config()
+
+
+class FakeCursor(object):
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction):
+        return FakeCursor(sorted(self.docs, key=lambda doc: doc[key], reverse=direction < 0))
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+class FakeCollection(object):
+    """ In-memory collection supporting the queries of RollupStore """
+
+    def __init__(self):
+        self.docs = []
+        self.indexes = {}
+
+    def matches(self, doc, query):
+        for key, condition in query.items():
+            if isinstance(condition, dict):
+                if "$gte" in condition and not doc[key] >= condition["$gte"]:
+                    return False
+                if "$lte" in condition and not doc[key] <= condition["$lte"]:
+                    return False
+            elif doc.get(key) != condition:
+                return False
+        return True
+
+    def find(self, query):
+        return FakeCursor([doc for doc in self.docs if self.matches(doc, query)])
+
+    def update_one(self, query, update, upsert=False):
+        doc = next((doc for doc in self.docs if self.matches(doc, query)), None)
+        if doc is None:
+            doc = dict(query)
+            self.docs.append(doc)
+        doc.update(update["$set"])
+
+    def create_index(self, key, **kwargs):
+        self.indexes[key] = kwargs
+
+
+def make_analyzer(period, ingest_chunk):
+    """ Returns: a SizingAnalyzer without database clients, storing its rollups in a FakeCollection """
+    analyzer = SizingAnalyzer.__new__(SizingAnalyzer)
+    analyzer.config = config
+    analyzer.query_results = None
+    analyzer.logger = get_logger(__name__, log_level=("TEST", "LOGLEVEL"))
+    analyzer.percentiles = [.5, .95, .99]
+    analyzer.relative_accuracy = 0.01
+    analyzer.max_bins = 2048
+    analyzer.ingest_chunk = ingest_chunk
+    analyzer.rollup_delay = 0
+    analyzer.rollup_store = RollupStore({"rollups": FakeCollection()}, "rollups", 0.01, period)
+    analyzer.write_output_points = lambda df, output_name, group_key: None
+    return analyzer
+
+
+def make_node_cpu_query(counters):
+    """ Returns: a fake query_influx_metric computing the derivative of the cumulative cpu
+        of each node of { node -> series } over the queried time range, like influxDB does,
+        and the list of the time ranges it was queried over """
+    time_ranges = []
+
+    def query_influx_metric(metric_name, output_filter, time_filter, tags_filter, group_by_tags):
+        start_time, end_time = map(int, re.match(r"time > (\d+) AND time <= (\d+)", time_filter).groups())
+        time_ranges.append((start_time, end_time))
+        for node, counter in sorted(counters.items()):
+            counter = counter[(counter.index > start_time) & (counter.index <= end_time)]
+            usage = (counter.diff() / (counter.index.to_series().diff() / NANOSECONDS_PER_SECOND)).dropna()
+            if len(usage):
+                yield (metric_name, (("instance", node),)), pd.DataFrame({"usage": usage})
+
+    return query_influx_metric, time_ranges
+
+
+class FakeChunkedResponse(object):
+    """ Streamed response of a chunked influxDB query, one JSON line per chunk """
+
+    def __init__(self, chunks):
+        self._msgpack = None
+        self.chunks = chunks
+
+    def iter_lines(self):
+        for series in self.chunks:
+            yield json.dumps({"results": [{"statement_id": 0, "series": series, "partial": True}]}).encode()
+
+
+def merge_chunked_response(response, raise_errors=True):
+    """ _read_chunked_response of influxdb-python before 5.3, merging all the chunks in one result set """
+    result_set = {}
+    for line in response.iter_lines():
+        for result in json.loads(line.decode()).get("results", []):
+            for key in result:
+                if isinstance(result[key], list):
+                    result_set.setdefault(key, []).extend(result[key])
+    return ResultSet(result_set, raise_errors=raise_errors)
+
+
+class UsageHistogramTest(TestCase):
+    def testQuantileAccuracy(self):
+        """ Assert that the percentiles of a usage histogram are within
+        its relative accuracy of the exact ones of pandas. """
+        values = pd.Series(np.concatenate([np.random.lognormal(0, 2, 10000), np.zeros(500)]))
+        histogram = UsageHistogram(0.01)
+        histogram.add(values.values)
+
+        self.assertEqual(histogram.count, len(values))
+        self.assertAlmostEqual(histogram.mean(), values.mean())
+        self.assertEqual(histogram.max, values.max())
+        for q in [0., .01, .25, .5, .9, .95, .99, 1.]:
+            expected = values.quantile(q, interpolation="lower")
+            self.assertLessEqual(abs(histogram.quantile(q) - expected), 0.01 * expected + 1e-12)
+
+    def testMerge(self):
+        """ Assert that merging the histograms of two sets of values gives
+        the histogram of all the values, without changing the merged one. """
+        first, second = np.random.rand(1000) * 10, np.random.rand(500) * 100
+        histogram, other, expected = UsageHistogram(0.01), UsageHistogram(0.01), UsageHistogram(0.01)
+        histogram.add(first)
+        other.add(second)
+        expected.add(np.concatenate([first, second]))
+        other_dict = other.to_dict()
+
+        histogram.merge(other)
+        merged, expected = histogram.to_dict(), expected.to_dict()
+        # the sum only differs by rounding errors
+        self.assertAlmostEqual(merged.pop("sum"), expected.pop("sum"))
+        self.assertEqual(merged, expected)
+        self.assertEqual(other.to_dict(), other_dict)
+        with self.assertRaises(ValueError):
+            histogram.merge(UsageHistogram(0.05))
+
+    def testMaxBins(self):
+        """ Assert that collapsing the lowest bins keeps the count and the high percentiles. """
+        # values over 3 orders of magnitude need about 350 bins; the 256 highest span the top 2.3
+        values = 10 ** (np.random.rand(10000) * 3)
+        histogram = UsageHistogram(0.01, max_bins=256)
+        histogram.add(values)
+
+        self.assertLessEqual(len(histogram.bins), 256)
+        self.assertEqual(sum(histogram.bins.values()) + histogram.zero_count, len(values))
+        for q in [.95, .99]:
+            expected = pd.Series(values).quantile(q, interpolation="lower")
+            self.assertLessEqual(abs(histogram.quantile(q) - expected), 0.01 * expected)
+
+    def testDictRoundTrip(self):
+        """ Assert that a histogram rebuilt from its dict has the same summary,
+        including an empty histogram. """
+        histogram = UsageHistogram(0.01)
+        histogram.add(np.concatenate([np.random.rand(100), [0., np.nan]]))
+        restored = UsageHistogram.from_dict(histogram.to_dict())
+
+        self.assertEqual(restored.to_dict(), histogram.to_dict())
+        self.assertEqual(restored.summary([.5, .95]), histogram.summary([.5, .95]))
+        empty = UsageHistogram.from_dict(UsageHistogram(0.01).to_dict())
+        self.assertEqual(empty.count, 0)
+        self.assertTrue(np.isnan(empty.quantile(.5)))
+
+
+class RollupStoreTest(TestCase):
+    def make_store(self, docs=()):
+        collection = FakeCollection()
+        collection.docs.extend(docs)
+        return RollupStore({"rollups": collection}, "rollups", 0.01, 100, retention_second=3600), collection
+
+    def make_doc(self, start_time, end_time, analysis="node_cpu", relative_accuracy=0.01, max_bins=2048,
+                 group_tags="instance"):
+        histogram = UsageHistogram(relative_accuracy, max_bins)
+        histogram.add([start_time])
+        return {"analysis": analysis, "group_tags": group_tags, "relative_accuracy": relative_accuracy,
+                "max_bins": max_bins, "start_time": start_time, "end_time": end_time,
+                "histograms": [{"group": "node-1", "metric": "usage", "histogram": histogram.to_dict()}]}
+
+    def testPlanSplitsMissingPeriodsOnGrid(self):
+        """ Assert that a window without rollups is split in periods
+        on a grid ending at the end of the window. """
+        store, _ = self.make_store()
+        self.assertEqual(store.plan("node_cpu", 50, 380),
+                         [(50, 80, None), (80, 180, None), (180, 280, None), (280, 380, None)])
+        self.assertEqual(store.plan("node_cpu", 100, 300), [(100, 200, None), (200, 300, None)])
+        self.assertEqual(store.plan("node_cpu", 300, 300), [])
+
+    def testPlanUsesStoredRollups(self):
+        """ Assert that the stored rollups of the analysis are used, the periods
+        between them are ingested, and overlapping or other rollups are skipped. """
+        store, _ = self.make_store([
+            self.make_doc(180, 280),
+            self.make_doc(200, 300),
+            self.make_doc(280, 380, analysis="node_memory"),
+            self.make_doc(280, 380, max_bins=256),
+            self.make_doc(280, 380, group_tags="instance,zone"),
+            self.make_doc(0, 80, relative_accuracy=0.05),
+            self.make_doc(20, 120)])
+        periods = store.plan("node_cpu", 50, 380, "instance")
+
+        self.assertEqual([(start, end) for start, end, _ in periods],
+                         [(50, 80), (80, 180), (180, 280), (280, 380)])
+        self.assertEqual([histograms is None for _, _, histograms in periods], [True, True, False, True])
+        self.assertEqual(periods[2][2][("node-1", "usage")].max, 180)
+
+    def testSave(self):
+        """ Assert that saved rollups are planned back, replaced when saved
+        again and given the creation time the retention index expires them on. """
+        store, collection = self.make_store()
+        histogram = UsageHistogram(0.01)
+        histogram.add([1., 2.])
+        store.save("node_cpu", 100, 200, {("node-1", "usage"): histogram}, "instance")
+        store.save("node_cpu", 100, 200, {("node-1", "usage"): histogram}, "instance")
+
+        self.assertEqual(collection.indexes, {"created_at": {"expireAfterSeconds": 3600}})
+        self.assertEqual(len(collection.docs), 1)
+        self.assertIn("created_at", collection.docs[0])
+        periods = store.plan("node_cpu", 100, 200, "instance")
+        self.assertEqual(len(periods), 1)
+        self.assertEqual(periods[0][2][("node-1", "usage")].to_dict(), histogram.to_dict())
+        self.assertEqual(store.plan("node_cpu", 100, 200, "instance,zone"), [(100, 200, None)])
+
+
+class SummarizeUsageTest(TestCase):
+    def setUp(self):
+        self.interval = 10 * NANOSECONDS_PER_SECOND
+        self.period = 400 * NANOSECONDS_PER_SECOND
+        times = np.arange(1, 81) * self.interval
+        self.counters = {node: pd.Series(np.cumsum(np.random.rand(80) * scale) * 10, index=times)
+                         for node, scale in [("node-1", 1.), ("node-2", 4.)]}
+        # the usage of each sample, from the previous one
+        self.usage = {node: counter.diff().values / 10 for node, counter in self.counters.items()}
+
+    def histogram(self, values):
+        histogram = UsageHistogram(0.01)
+        histogram.add(values)
+        return histogram
+
+    def assertHistogramEqual(self, histogram, expected):
+        histogram, expected = histogram.to_dict(), expected.to_dict()
+        self.assertAlmostEqual(histogram.pop("sum"), expected.pop("sum"))
+        self.assertEqual(histogram, expected)
+
+    def summarize(self, ingest_chunk):
+        analyzer = make_analyzer(self.period, ingest_chunk)
+        analyzer.query_influx_metric, time_ranges = make_node_cpu_query(self.counters)
+        summaries = analyzer.summarize_usage("node_cpu", 0, 2 * self.period, analyzer.ingest_node_cpu)
+        rollups = [analyzer.rollup_store.load_histograms(doc) for doc in analyzer.rollup_store.collection.docs]
+        return summaries, rollups, time_ranges
+
+    def testChunkedIngestion(self):
+        """ Assert that ingesting the periods in chunks gives the histograms of
+        ingesting them in a single pass, except for the derivative of the first
+        sample of each chunk, which has no previous sample in its query. """
+        _, single_rollups, single_ranges = self.summarize(self.period)
+        _, chunked_rollups, chunked_ranges = self.summarize(self.period // 4)
+
+        self.assertEqual(single_ranges, [(0, self.period), (self.period, 2 * self.period)])
+        self.assertEqual(len(chunked_ranges), 8)
+        for i, (single, chunked) in enumerate(zip(single_rollups, chunked_rollups)):
+            # samples 40 * i + 1 to 40 * i + 40 are in period i, 10 per chunk
+            first = 40 * i
+            for node, usage in self.usage.items():
+                self.assertHistogramEqual(single[("instance=" + node, "usage")],
+                                          self.histogram(usage[first + 1:first + 40]))
+                chunk_starts = [first + 10, first + 20, first + 30]
+                self.assertHistogramEqual(chunked[("instance=" + node, "usage")],
+                                          self.histogram(np.delete(usage[first + 1:first + 40],
+                                                                   [j - first - 1 for j in chunk_starts])))
+                self.assertEqual(single[("instance=" + node, "usage")].count -
+                                 chunked[("instance=" + node, "usage")].count, 3)
+
+    def testUnavailableRollups(self):
+        """ Assert that the usage is summarized from the raw metrics when
+        the rollups can't be read or stored. """
+        expected, _, _ = self.summarize(self.period)
+
+        class FailingCollection(FakeCollection):
+            def find(self, query):
+                raise Exception("find failed")
+
+            def update_one(self, query, update, upsert=False):
+                raise Exception("update failed")
+
+        analyzer = make_analyzer(self.period, self.period)
+        analyzer.rollup_store.collection = FailingCollection()
+        analyzer.query_influx_metric, time_ranges = make_node_cpu_query(self.counters)
+        summary, cluster_summary = analyzer.summarize_usage(
+            "node_cpu", 0, 2 * self.period, analyzer.ingest_node_cpu)
+
+        self.assertEqual(time_ranges, [(0, self.period), (self.period, 2 * self.period)])
+        pd.testing.assert_frame_equal(summary, expected[0])
+        pd.testing.assert_frame_equal(cluster_summary, expected[1])
+
+    def testClusterSummary(self):
+        """ Assert that the cluster summary merges the histograms of all the
+        groups, while the summary of each group only covers its own usage. """
+        (summary, cluster_summary), _, _ = self.summarize(self.period)
+        # the first sample of each period has no previous sample in its query
+        node_usage = {node: np.delete(usage, [0, 40]) for node, usage in self.usage.items()}
+
+        for node, usage in node_usage.items():
+            expected = pd.Series(self.histogram(usage).summary([.5, .95, .99]))
+            pd.testing.assert_series_equal(summary[("instance=" + node, "usage")], expected, check_names=False)
+        expected = pd.Series(self.histogram(np.concatenate(list(node_usage.values()))).summary([.5, .95, .99]))
+        pd.testing.assert_series_equal(cluster_summary["usage"], expected, check_names=False)
+
+        analyzer = make_analyzer(self.period, self.period)
+        self.assertEqual(analyzer.construct_cluster_summary("cpu", cluster_summary),
+                         {"cpu_usage": cluster_summary["usage"].to_dict()})
+
+
+class QueryInfluxMetricTest(TestCase):
+    def setUp(self):
+        def series(node, minutes):
+            return {"name": "node_cpu", "tags": {"instance": node}, "columns": ["time", "usage"],
+                    "values": [["2017-01-01T00:%02d:00Z" % minute, float(minute)] for minute in minutes]}
+
+        # the points of node-1 and node-2 are both split over two chunks of 2 points
+        self.chunks = [[series("node-1", [0, 1])],
+                       [series("node-1", [2]), series("node-2", [0])],
+                       [series("node-2", [1, 2])]]
+        self.requests = []
+        self.analyzer = make_analyzer(NANOSECONDS_PER_SECOND, NANOSECONDS_PER_SECOND)
+        self.analyzer.query_chunk_size = 2
+        self.analyzer.influx_client_input = DataFrameClient("localhost", 8086, "user", "password", "db")
+
+    def request(self, url, method, params, data, stream, expected_response_code):
+        self.requests.append(params)
+        return FakeChunkedResponse(self.chunks)
+
+    def query(self):
+        with patch.object(self.analyzer.influx_client_input, "request", self.request):
+            return [(key, list(df.usage)) for key, df in self.analyzer.query_influx_metric(
+                "node_cpu", "derivative(sum(value), 1s) as usage", "time > 0 AND time <= 1", "", "instance")]
+
+    def testChunkedResponse(self):
+        """ Assert that the points of each group are read in chunks of
+        query_chunk_size points, and merged across the chunks. """
+        self.assertEqual(self.query(), [(("node_cpu", (("instance", "node-1"),)), [0., 1., 2.]),
+                                        (("node_cpu", (("instance", "node-2"),)), [0., 1., 2.])])
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.requests[0]["chunked"], "true")
+        self.assertEqual(self.requests[0]["chunk_size"], 2)
+
+    def testMergedChunkedResponse(self):
+        """ Assert that a chunked response merged in a single result set, as
+        influxdb-python does before 5.3, gives the same groups. """
+        with patch.object(InfluxDBClient, "_read_chunked_response", staticmethod(merge_chunked_response)):
+            self.assertEqual(self.query(), [(("node_cpu", (("instance", "node-1"),)), [0., 1., 2.]),
+                                            (("node_cpu", (("instance", "node-2"),)), [0., 1., 2.])])
+
+
+class RunSizingAnalysesTest(TestCase):
+    def setUp(self):
+        self.queries = []
+        self.barrier = threading.Barrier(len(SIZING_ANALYSES), timeout=5)
+
+    def query_influx_metric(self, analyzer, *query):
+        self.queries.append(query)
+        time.sleep(0.05)
+        yield (query[0], (("instance", "node-1"),)), pd.DataFrame({"value": [1.]})
+
+    def fake_analysis(self, analysis, failing):
+        def analyze(analyzer, start_time, end_time):
+            # times out unless all the analyses run at the same time
+            self.barrier.wait()
+            data = {name: analyzer.read_influx_metric(*query) for name, query
+                    in analyzer.settings_queries(analysis, start_time, end_time).items()}
+            if analysis in failing:
+                raise Exception("Unable to fetch %s" % analysis)
+            return JobStatus(status=Status.SUCCESS, data=data)
+        return analyze
+
+    def run_analyses(self, failing=()):
+        def init(analyzer, config, query_results=None):
+            analyzer.__dict__.update(make_analyzer(NANOSECONDS_PER_SECOND, NANOSECONDS_PER_SECOND).__dict__)
+            analyzer.query_results = query_results
+
+        patches = [patch.object(SizingAnalyzer, "__init__", init),
+                   patch.object(SizingAnalyzer, "query_influx_metric",
+                                lambda analyzer, *query: self.query_influx_metric(analyzer, *query))]
+        patches += [patch.object(SizingAnalyzer, "analyze_" + analysis, self.fake_analysis(analysis, failing))
+                    for analysis in SIZING_ANALYSES]
+        for p in patches:
+            p.start()
+        try:
+            return run_sizing_analyses(config, 0, 10 * NANOSECONDS_PER_SECOND)
+        finally:
+            for p in reversed(patches):
+                p.stop()
+
+    def testQueriesFetchedOnce(self):
+        """ Assert that the analyses run concurrently, and that each settings
+        query is fetched only once, by the prefetch the analyses then read. """
+        statuses = self.run_analyses()
+        analyzer = make_analyzer(NANOSECONDS_PER_SECOND, NANOSECONDS_PER_SECOND)
+        planned = [query for analysis in SIZING_ANALYSES for query
+                   in analyzer.settings_queries(analysis, 0, 10 * NANOSECONDS_PER_SECOND).values()]
+
+        self.assertEqual(list(statuses), SIZING_ANALYSES)
+        for analysis, status in statuses.items():
+            self.assertEqual(status.status, Status.SUCCESS, status.error)
+        self.assertEqual(sorted(statuses["container_cpu"].data),
+                         ["container_spec_cpu_period", "container_spec_cpu_quota"])
+        self.assertEqual(sorted(self.queries), sorted(planned))
+
+    def testFailingAnalysis(self):
+        """ Assert that an analysis raising an exception gets an error status,
+        while the other analyses complete. """
+        statuses = self.run_analyses(failing=["container_cpu"])
+
+        self.assertEqual(list(statuses), SIZING_ANALYSES)
+        self.assertEqual(statuses["container_cpu"].status, Status.DB_ERROR)
+        self.assertEqual(statuses["container_cpu"].error, "Unable to fetch container_cpu")
+        for analysis in ["node_cpu", "node_memory", "container_memory"]:
+            self.assertEqual(statuses[analysis].status, Status.SUCCESS, statuses[analysis].error)
@@ -0,0 +1,203 @@
+import datetime
+import math
+from collections import OrderedDict
+
+import numpy as np
+
+# values at or below this are counted in the zero bin of a histogram
+MIN_POSITIVE_VALUE = 1e-9
+DEFAULT_MAX_BINS = 2048
+
+
+def percentile_name(percentile):
+    """ Name of a percentile in the usage summaries, e.g. median for .5 and p95 for .95.
+    """
+    if percentile == .5:
+        return "median"
+    return "p%g" % (percentile * 100)
+
+
+class UsageHistogram(object):
+    """ Mergeable histogram of usage values over logarithmically sized bins, so the percentiles it
+        estimates are within relative_accuracy of the exact ones; histograms of different nodes or
+        periods with the same relative_accuracy can be merged without losing accuracy.
+        Zero and negative values are counted together in a single zero bin.
+        At most max_bins bins are kept, so the memory of a histogram is bounded whatever the number of values
+        added to it: beyond that the lowest bins are collapsed together, which only affects the accuracy of
+        the lowest percentiles.
+    """
+
+    def __init__(self, relative_accuracy, max_bins=DEFAULT_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        positive = values[values > MIN_POSITIVE_VALUE]
+        self.zero_count += len(values) - len(positive)
+        indexes, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64),
+                                    return_counts=True)
+        for index, count in zip(indexes.tolist(), counts.tolist()):
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.collapse()
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge usage histograms of relative accuracy %g and %g" %
+                             (self.relative_accuracy, other.relative_accuracy))
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.zero_count += other.zero_count
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.collapse()
+        return self
+
+    def collapse(self):
+        if len(self.bins) <= self.max_bins:
+            return
+        indexes = sorted(self.bins)
+        lowest = indexes[len(indexes) - self.max_bins]
+        self.bins[lowest] += sum(self.bins.pop(index) for index in indexes[:len(indexes) - self.max_bins])
+
+    def copy(self):
+        histogram = UsageHistogram(self.relative_accuracy, self.max_bins)
+        return histogram.merge(self)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return math.nan
+
+        # same rank as the linear interpolation of pandas' quantile, rounded to a sample
+        rank = q * (self.count - 1)
+        value = 0.
+        if rank >= self.zero_count:
+            seen = self.zero_count
+            for index in sorted(self.bins):
+                seen += self.bins[index]
+                if seen > rank:
+                    value = 2 * self.gamma ** index / (self.gamma + 1)
+                    break
+        return min(max(value, self.min), self.max)
+
+    def mean(self):
+        return self.sum / self.count if self.count else math.nan
+
+    def summary(self, percentiles):
+        """ Returns: the mean, percentiles and max of the values, named like the usage summaries.
+        """
+        summary = OrderedDict([("mean", self.mean())])
+        for percentile in percentiles:
+            summary[percentile_name(percentile)] = self.quantile(percentile)
+        summary["max"] = self.max if self.count else math.nan
+        return summary
+
+    def to_dict(self):
+        indexes = sorted(self.bins)
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "max_bins": self.max_bins,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "zero_count": self.zero_count,
+            "bin_indexes": indexes,
+            "bin_counts": [self.bins[i] for i in indexes]
+        }
+
+    @classmethod
+    def from_dict(cls, doc):
+        histogram = cls(doc["relative_accuracy"], doc.get("max_bins", DEFAULT_MAX_BINS))
+        histogram.count = doc["count"]
+        histogram.sum = doc["sum"]
+        if histogram.count:
+            histogram.min = doc["min"]
+            histogram.max = doc["max"]
+        histogram.zero_count = doc["zero_count"]
+        histogram.bins = dict(zip(doc["bin_indexes"], doc["bin_counts"]))
+        return histogram
+
+
+class RollupStore(object):
+    """ Stores the usage histograms of each analysis per period, keyed by (group key, metric type),
+        so an analysis window only needs the raw metrics of the periods that haven't been rolled up yet.
+        Rollups are removed by MongoDB retention_second after they are stored, if given.
+        Rollups are only reused by the stores with the same relative_accuracy and max_bins,
+        and by the analyses grouping the metrics by the same tags.
+    """
+
+    def __init__(self, db, collection, relative_accuracy, period, retention_second=None, max_bins=DEFAULT_MAX_BINS):
+        self.collection = db[collection]
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.period = int(period)
+        if retention_second is not None:
+            self.collection.create_index("created_at", expireAfterSeconds=int(retention_second))
+
+    def plan(self, analysis, start_time, end_time, group_tags=""):
+        """ Cover [start_time, end_time] with the stored rollups of analysis and the periods missing between them,
+            which are split on a grid of self.period ending at end_time.
+        Returns: a list of (period start, period end, histograms or None if the period has no rollup)
+        """
+        start_time, end_time = int(start_time), int(end_time)
+        docs = self.collection.find(dict(
+            self.rollup_key(analysis, group_tags),
+            start_time={"$gte": start_time},
+            end_time={"$lte": end_time})).sort("start_time", 1)
+
+        periods = []
+        covered_until = start_time
+        for doc in docs:
+            # skip rollups overlapping the ones already chosen
+            if doc["start_time"] < covered_until:
+                continue
+            periods.extend(self.split_missing(covered_until, doc["start_time"], end_time))
+            periods.append((doc["start_time"], doc["end_time"], self.load_histograms(doc)))
+            covered_until = doc["end_time"]
+        periods.extend(self.split_missing(covered_until, end_time, end_time))
+        return periods
+
+    def split_missing(self, start_time, end_time, grid_end_time):
+        periods = []
+        while end_time > start_time:
+            # the grid boundary right before end_time
+            boundary = grid_end_time - ((grid_end_time - end_time) // self.period + 1) * self.period
+            period_start = max(start_time, boundary)
+            periods.append((period_start, end_time, None))
+            end_time = period_start
+        return periods[::-1]
+
+    def rollup_key(self, analysis, group_tags):
+        return {"analysis": analysis, "group_tags": group_tags,
+                "relative_accuracy": self.relative_accuracy, "max_bins": self.max_bins}
+
+    def load_histograms(self, doc):
+        return {(h["group"], h["metric"]): UsageHistogram.from_dict(h["histogram"]) for h in doc["histograms"]}
+
+    def save(self, analysis, start_time, end_time, histograms, group_tags=""):
+        self.collection.update_one(
+            dict(self.rollup_key(analysis, group_tags), start_time=int(start_time), end_time=int(end_time)),
+            {"$set": {"created_at": datetime.datetime.utcnow(),
+                      "histograms": [{"group": group_key, "metric": metric_type, "histogram": h.to_dict()}
+                                     for (group_key, metric_type), h in histograms.items()]}},
+            upsert=True)